@@ -5,10 +5,12 @@ import time
 
 from sl_atlas.AtlasApi import AtlasApi
 from sl_report.report import Report
-from sl_async.slorch import extract_slow_queries_from_file
+from sl_async.slorch import extract_slow_queries_from_files
+from sl_async.slag import merge_results, OTHER_SHAPE_ID
+from sl_json.registry import get_registry_path, load_shape_registry, update_shape_registry, save_shape_registry
 from sl_config.config import Config
 from sl_plot.graphs import createAndInsertGraphs, plot_all_metricsForProcess
-from sl_utils.utils import convertToHumanReadable
+from sl_utils.utils import convertToHumanReadable, expand_log_files
 import concurrent.futures
 
 import sys
@@ -44,7 +46,8 @@ def process_row(index, row,report,columns):
     report.add_json(row['command_shape'])
     if config.get_template("initial_empty_page",True) :
         report.addpage()
-    report.table(row.drop(columns=['command_shape']), [col for col in columns if col != 'command_shape'])
+    report.table(row.drop(columns=['command_shape']), [col for col in columns if col not in ('command_shape', 'shape_id')
+                                                        and not col.endswith(('_sketch', '_hll'))])
 
 
 
@@ -106,6 +109,13 @@ def addToReport(result,prefix,report,config,process=None):
 
 
 def addCommandShapAnalysis(command_shape_stats, config, report):
+    # rows of the shapes out of the top shapes (extract.top_shapes), not a query shape
+    other_stats = command_shape_stats[command_shape_stats['shape_id'] == OTHER_SHAPE_ID]
+    command_shape_stats = command_shape_stats[command_shape_stats['shape_id'] != OTHER_SHAPE_ID]
+    if other_stats.shape[0] > 0:
+        duration = convertToHumanReadable("durationMillis", other_stats['durationMillis_total'].sum(), True)
+        report.chapter_body(f"{other_stats['slow_query'].sum()} slow queries of the shapes out of the top "
+                            f"{config.TOP_SHAPES} shapes by duration and by count, total duration {duration}")
     if config.MINIMUM_DURATION_FOR_QUERYSHAPE > 0:
         command_shape_stats = command_shape_stats[
             command_shape_stats['durationMillis_total'] >= (1000 * config.MINIMUM_DURATION_FOR_QUERYSHAPE)]
@@ -289,17 +299,73 @@ def generate_cluster_report(atlasApi, cluster, config, report):
         report.write(f"{config.REPORT_FILE_PATH}/slow_report{name}")
 
 
+def addFilesBreakdownToReport(results, report):
+    report.subChapter_title("Breakdown by file")
+    rows = []
+    for file, result in results.items():
+        global_stats = result["groupByCommandShape"].get("global", None)
+        has_stats = global_stats is not None and global_stats.shape[0] > 0
+        rows.append({
+            "file": file,
+            "slow_query": result.get("countOfSlow", 0),
+            "durationMillis": convertToHumanReadable("durationMillis",
+                                                     global_stats['durationMillis_total'].sum() if has_stats else 0, True),
+            "query_shape": (global_stats['shape_id'] != OTHER_SHAPE_ID).sum() if has_stats else 0,
+        })
+    report.add_table(rows, ["file", "slow_query", "durationMillis", "query_shape"],
+                     ["File", "Slow queries", "Total duration", "Query shapes"])
+
+
 def file_retrieval_mode(config,report):
-    for file in config.LOGS_FILENAME:
+    files = expand_log_files(config.INPUT_PATH, config.LOGS_FILENAME)
+    log_files = {file: (f"{config.INPUT_PATH}/{file}", f"{config.OUTPUT_FILE_PATH}/slow_queries_{file.replace('/', '_')}")
+                 for file in files}
+    follow = None
+    if config.FOLLOW_LOGS:
+        follow = {"poll_interval": config.FOLLOW_POLL_INTERVAL,
+                  "flush_interval": config.FOLLOW_FLUSH_INTERVAL,
+                  "idle_timeout": config.FOLLOW_IDLE_TIMEOUT}
+    registry_path = get_registry_path(config.OUTPUT_FILE_PATH) if config.SHAPE_REGISTRY else None
+    registry = None if registry_path is None else load_shape_registry(registry_path)
+    results = extract_slow_queries_from_files(log_files, config.MAX_CHUNK_SIZE, config.SAVE_BY_CHUNK,
+                                              workers=config.PARALLEL_WORKERS,
+                                              batch_size=config.EXTRACT_BATCH_SIZE,
+                                              parallel_files=config.PARALLEL_FILES,
+                                              follow=follow,
+                                              start_time=config.EXTRACT_START_TIME,
+                                              end_time=config.EXTRACT_END_TIME,
+                                              checkpoint=config.EXTRACT_CHECKPOINT,
+                                              decode_workers=config.DECODE_WORKERS,
+                                              aggregate_workers=config.AGGREGATE_WORKERS,
+                                              top_shapes=config.TOP_SHAPES,
+                                              by_query_hash=config.GROUP_BY_QUERY_HASH,
+                                              shape_registry=registry_path)
+    if registry is not None:
+        for result in results.values():
+            update_shape_registry(registry, result)
+        save_shape_registry(registry, registry_path)
+    for file, result in results.items():
+        file_name = file.replace('/', '_')
+        if config.GENERATE_ONE_PDF_PER_CLUSTER_FILE:
+            report = Report(config)
+        addToReport(result,
+                    f"{config.OUTPUT_FILE_PATH}/{file_name}",
+                    report,
+                    config)
+        if config.GENERATE_ONE_PDF_PER_CLUSTER_FILE:
+            report.write(f"{config.REPORT_FILE_PATH}/slow_report{file_name}")
+
+    if config.MERGE_FILES and len(results) > 1:
+        # cluster level view : all the files merged, the shape 'source' lists the files it comes from
         if config.GENERATE_ONE_PDF_PER_CLUSTER_FILE:
             report = Report(config)
-        addToReport(extract_slow_queries_from_file(f"{config.INPUT_PATH}/{file}", f"{config.OUTPUT_FILE_PATH}/slow_queries_{file}",
-                                         config.MAX_CHUNK_SIZE,config.SAVE_BY_CHUNK),
-                    f"{config.OUTPUT_FILE_PATH}/{file}",
+        addToReport(merge_results(results.values()),
+                    f"{config.OUTPUT_FILE_PATH}/all_files",
                     report,
                     config)
+        addFilesBreakdownToReport(results, report)
         if config.GENERATE_ONE_PDF_PER_CLUSTER_FILE:
-            report.write(f"{config.REPORT_FILE_PATH}/slow_report{file}")
+            report.write(f"{config.REPORT_FILE_PATH}/slow_report_all_files")
 
 
 def start_server():
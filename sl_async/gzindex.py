@@ -0,0 +1,112 @@
+import logging
+import os
+from datetime import datetime
+
+import msgspec
+
+from sl_json.json import get_time_from_prefix
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+gzindex_log = logging.getLogger("GzipIndex")
+
+encoder = msgspec.json.Encoder()
+decoder = msgspec.json.Decoder()
+
+
+class GzipIndex:
+    """
+    zran style index of a gzip file, kept in two sidecar files next to it:
+    - <file>.gzidx : the decompressor checkpoints (exported by indexed_gzip)
+    - <file>.gzidx.json : line aligned uncompressed offsets with the time of the line starting there
+    The first sequential read builds it, later reads can seek and split the file in ranges.
+    """
+    def __init__(self, file_path, spacing=4*1024*1024, point_spacing=16*1024*1024):
+        self.path = file_path
+        self.index_path = f"{file_path}.gzidx"
+        self.points_path = f"{file_path}.gzidx.json"
+        self.spacing = spacing
+        self.point_spacing = point_spacing
+        self.points = []  # [[uncompressed offset, iso time or None], ...] sorted by offset
+        self.uncompressed_size = None
+        self.loaded = False
+
+    @staticmethod
+    def available():
+        return indexed_gzip is not None
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_size, int(stat.st_mtime)
+
+    def load(self):
+        if not self.available() or not os.path.isfile(self.index_path) or not os.path.isfile(self.points_path):
+            return False
+        with open(self.points_path, 'rb') as in_file:
+            content = decoder.decode(in_file.read())
+        size, mtime = self._stat()
+        if content.get("size") != size or content.get("mtime") != mtime:
+            gzindex_log.info(f"index of {self.path} is outdated, it will be rebuilt")
+            return False
+        points = content.get("points", [])
+        if points and points[0][0] != 0:
+            gzindex_log.info(f"index of {self.path} was built by a resumed read, it will be rebuilt")
+            return False
+        self.points = points
+        self.uncompressed_size = content.get("uncompressed_size")
+        self.loaded = True
+        return True
+
+    def open(self):
+        if self.loaded:
+            return indexed_gzip.IndexedGzipFile(self.path, index_file=self.index_path)
+        return indexed_gzip.IndexedGzipFile(self.path, spacing=self.spacing)
+
+    def add_point(self, offset, line):
+        """Record the line starting at uncompressed offset, return the offset of the next point to record."""
+        dtime = get_time_from_prefix(line)
+        self.points.append([offset, None if dtime is None else dtime.isoformat()])
+        return offset + self.point_spacing
+
+    def save(self, gzip_file, uncompressed_size):
+        gzip_file.export_index(self.index_path)
+        size, mtime = self._stat()
+        with open(self.points_path, 'wb') as out_file:
+            out_file.write(encoder.encode({"size": size, "mtime": mtime,
+                                           "uncompressed_size": uncompressed_size,
+                                           "points": self.points}))
+        self.uncompressed_size = uncompressed_size
+        self.loaded = True
+        gzindex_log.info(f"index of {self.path} saved with {len(self.points)} points")
+
+    def find_range(self, start_time=None, end_time=None):
+        """Line aligned uncompressed [start,end) range covering the [start_time,end_time) window."""
+        start = 0
+        end = self.uncompressed_size
+        for offset, dtime in self.points:
+            if dtime is None:
+                continue
+            dtime = datetime.fromisoformat(dtime)
+            if start_time is not None and dtime < start_time:
+                start = offset
+            if end_time is not None and dtime >= end_time:
+                end = offset
+                break
+        return start, end
+
+    def split_ranges(self, parts, start=0, end=None):
+        """Split the uncompressed [start,end) range in at most `parts` line aligned ranges."""
+        end = self.uncompressed_size if end is None else end
+        offsets = [offset for offset, _ in self.points if start < offset < end]
+        bounds = [start]
+        for i in range(1, parts):
+            target = start + (end - start) * i // parts
+            candidates = [offset for offset in offsets if offset > bounds[-1]]
+            if not candidates:
+                break
+            bounds.append(min(candidates, key=lambda offset: abs(offset - target)))
+        bounds.append(end)
+        return list(zip(bounds[:-1], bounds[1:]))
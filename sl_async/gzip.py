@@ -1,15 +1,18 @@
+import asyncio
 import io
 import logging
 import os
 import struct
 import time
 import zlib
+from concurrent import futures
 
 import aiofile
 from aiofile import async_open
 
 from sl_async.slapi import SlSource, SourceFilter, SlDest, DefaultSourceFilter
-from sl_json.json import get_time_from_line
+from sl_async.slframe import LineFramer, MmapLineFramer
+from sl_json.json import get_time_from_prefix
 
 reader_log = logging.getLogger("BufferedGzipReader")
 writer_log = logging.getLogger("BufferedGzipWriter")
@@ -18,57 +21,222 @@ class BufferedGzipReader(SlSource):
 
     def __init__(self,
                  file_path,
-                 line_buffer_size=500,
-                 line_filter: SourceFilter =None):
-        super().__init__(path=file_path,max_queue_size=line_buffer_size)
-        self.line_filter=DefaultSourceFilter(self.queue) if line_filter is None else line_filter
+                 line_buffer_size=4096,
+                 line_filter: SourceFilter =None,
+                 start=0,
+                 end=None,
+                 gzip_index=None,
+                 batch_size=256,
+                 start_time=None,
+                 end_time=None,
+                 checkpoint_spacing=None):
+        super().__init__(path=file_path,max_queue_size=line_buffer_size,batch_size=batch_size)
+        self.line_filter=DefaultSourceFilter(self.channel, start_time=start_time, end_time=end_time) \
+            if line_filter is None else line_filter
+        # byte range [start,end) to read (plain text), uncompressed offsets for indexed gzip files
+        self.start=start
+        self.end=end
+        # GzipIndex, used to seek in gzip files (built during the first full read)
+        self.gzip_index=gzip_index
+        # send the (uncompressed) offset reached about every checkpoint_spacing bytes, None to never send it
+        self.checkpoint_spacing=checkpoint_spacing
+        self.next_mark=start if checkpoint_spacing is None else start + checkpoint_spacing
+
+    async def process_frame(self, framer, last=False):
+        start, end = framer.frame(last)
+        if end > start:
+            # filter on raw bytes, only the selected lines are decoded
+            await self.line_filter.process_block(framer.buffer, start, end)
+        return start, end
+
+    async def mark_offset(self, offset):
+        if self.checkpoint_spacing is not None and offset >= self.next_mark:
+            self.next_mark = offset + self.checkpoint_spacing
+            await self.line_filter.mark_offset(offset)
+
+    def past_end_time(self):
+        # the filter has seen a line after the end of the time window
+        return getattr(self.line_filter, "done", False)
 
     async def async_read_gzip_lines(self):
         decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # Set up the decompressor with gzip header support
+        framer = LineFramer()
+        skip = self.start  # no index to seek, decompress and drop what is before start
+        fed = 0  # uncompressed bytes received
+
+        def feed(data):
+            nonlocal skip, fed
+            fed += len(data)
+            if skip > 0:
+                dropped = min(skip, len(data))
+                skip -= dropped
+                data = data[dropped:]
+            framer.feed(data)
+
         async with async_open(self.path, mode='rb') as f:
-            buffer = b''  # Buffer to hold incomplete lines across chunks
             while True:
                 chunk = await f.read(64*1024)  # Read raw compressed data in chunks
                 if not chunk:
                     break
                 try:
-                    decompressed_data = decompressor.decompress(chunk)
+                    feed(decompressor.decompress(chunk))
+                    while decompressor.eof and decompressor.unused_data:
+                        # next member of a multi member gzip file
+                        unused_data = decompressor.unused_data
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        feed(decompressor.decompress(unused_data))
                 except zlib.error as err:
                     reader_log.warning("Decompression error occurred", exc_info=err)
                     break
-                buffer += decompressed_data  # Add decompressed data to buffer
-                lines = buffer.split(b'\n')  # Split the buffer into lines
-                buffer = lines[-1]  # Retain any incomplete line in the buffer
-                for line in lines[:-1]:
-                    await self.line_filter.process(line.decode('utf-8'))
-              #  dtime = get_time_from_line(lines[-2])
+                line_offset = fed - framer.end  # uncompressed offset of framer.buffer[0]
+                start, end = await self.process_frame(framer)
+                if end > start:
+                    await self.mark_offset(line_offset + end)
+                if self.past_end_time():
+                    reader_log.info(f"end of the time window reached in {self.path}")
+                    break
 
         # Flush any remaining data in the decompressor
             try:
-                remaining_data = decompressor.flush()
-                if remaining_data:
-                    buffer += remaining_data
+                feed(decompressor.flush())
             except zlib.error as err:
                 reader_log.warning("Final data flush error occurred", exc_info=err)
             # Process any remaining data in the buffer
-            if buffer:
-                await self.line_filter.process(buffer.decode('utf-8'))
+            await self.process_frame(framer, True)
+        framer.close()
+
+    async def async_read_indexed_gzip_lines(self):
+        # only a read from the beginning sees every access point, a resumed one does not save its index
+        building = not self.gzip_index.loaded and self.start == 0
+        framer = LineFramer()
+        with self.gzip_index.open() as f:
+            if self.start > 0:
+                f.seek(self.start)
+            pos = self.start
+            line_offset = self.start - framer.start  # uncompressed offset of framer.buffer[0]
+            next_point = self.start
+            while True:
+                size = 1024*1024 if self.end is None else min(1024*1024, self.end - pos)
+                if size <= 0:
+                    break
+                buffer_start = framer.start
+                read = await asyncio.to_thread(f.readinto, framer.reserve(size))
+                if not read:
+                    break
+                line_offset += buffer_start - framer.start  # pending line moved to the front
+                framer.commit(read)
+                pos += read
+                start, end = await self.process_frame(framer)
+                if building and end > start and line_offset + start >= next_point:
+                    next_point = self.gzip_index.add_point(line_offset + start,
+                                                           bytes(framer.buffer[start:framer.buffer.find(b'\n', start, end)]))
+                if end > start:
+                    await self.mark_offset(line_offset + end)
+                if not building and self.past_end_time():
+                    break
+            await self.process_frame(framer, True)
+            if building:
+                self.gzip_index.save(f, pos)
+        framer.close()
+
+    async def async_read_range_lines(self):
+        framer = MmapLineFramer(self.path, self.start, self.end)
+        try:
+            for start, end in framer:
+                await self.line_filter.process_block(framer.buffer, start, end)
+                await self.mark_offset(end)
+                if self.past_end_time():
+                    break
+        finally:
+            framer.close()
 
     async def task_fn(self):
         if self.path.endswith('.gz'):
-            await self.async_read_gzip_lines()
+            if self.gzip_index is not None:
+                await self.async_read_indexed_gzip_lines()
+            else:
+                await self.async_read_gzip_lines()
         else:
-            async with async_open(self.path, 'rt') as log_file:
-                async for line in log_file:
-                    await self.line_filter.process( line)
+            await self.async_read_range_lines()
+        await self.line_filter.flush()
         reader_log.info(f"read {self.path} complete")
-        await self.queue.put(None)
+        await self.channel.close()
 
     async def close(self):
         pass
 
 
 
+def split_file_ranges(file_path, parts, min_range_size=16*1024*1024, start=0, end=None):
+    """
+    Split the [start,end) byte range of a plain text file in at most `parts` byte ranges [start,end).
+    Each range starts right after a newline so a line is never shared by two ranges.
+    """
+    end = os.path.getsize(file_path) if end is None else end
+    size = end - start
+    parts = max(1, min(parts, size // min_range_size))
+    bounds = [start]
+    with open(file_path, 'rb') as f:
+        for i in range(1, parts):
+            f.seek(start + size * i // parts - 1)
+            f.readline()
+            pos = f.tell()
+            if pos >= end:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def find_time_offset(file_path, dtime, start=0, end=None):
+    """
+    Offset of the first line at or after dtime in the [start,end) range of a plain text log,
+    found by binary search on the raw {"t":{"$date":...}} prefix of the lines (mongod logs are time ordered).
+    """
+    end = os.path.getsize(file_path) if end is None else end
+    with open(file_path, 'rb') as f:
+        def timed_line_at(pos):
+            # first line starting at or after pos having a time: (offset, time)
+            f.seek(pos)
+            if pos > start:
+                f.readline()  # skip the partial line
+            while True:
+                line_start = f.tell()
+                line = f.readline() if line_start < end else b''
+                if not line:
+                    return end, None
+                line_time = get_time_from_prefix(line)
+                if line_time is not None:
+                    return line_start, line_time
+
+        low, high = start, end
+        while high - low > 64*1024:
+            middle = (low + high) // 2
+            line_start, line_time = timed_line_at(middle)
+            if line_time is None or line_time >= dtime:
+                high = middle
+            else:
+                low = middle
+        pos, _ = timed_line_at(low)
+        f.seek(pos)
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            line_time = get_time_from_prefix(line)
+            if line_time is not None and line_time >= dtime:
+                return pos
+            pos += len(line)
+    return end
+
+
+def find_time_range(file_path, start_time=None, end_time=None):
+    """Byte range [start,end) of a plain text log covering the [start_time,end_time) window, end None for the end of the file"""
+    start = 0 if start_time is None else find_time_offset(file_path, start_time)
+    end = None if end_time is None else find_time_offset(file_path, end_time, start)
+    return start, end
+
 
 FTEXT, FHCRC, FEXTRA, FNAME, FCOMMENT = 1, 2, 4, 8, 16
 
@@ -79,8 +247,10 @@ _COMPRESS_LEVEL_BEST = 9
 class BufferedGzipWriter(SlDest):
     GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'  # Gzip magic number and header
     GZIP_FOOTER_SIZE = 8
-    def __init__(self, file_path, max_queue_size=50):
-        super().__init__(path=self.modify_path(file_path), max_queue_size=max_queue_size)
+    def __init__(self, file_path, max_queue_size=4096, batch_size=256, resume_size=None):
+        super().__init__(path=self.modify_path(file_path), max_queue_size=max_queue_size, batch_size=batch_size)
+        # size of the file at the checkpoint to continue from, the rest is cut and a new gzip member is appended
+        self.resume_size=resume_size
 
         self.compresslevel=_COMPRESS_LEVEL_TRADEOFF
         self.compressor = zlib.compressobj(self.compresslevel,
@@ -96,7 +266,8 @@ class BufferedGzipWriter(SlDest):
         self._write_mtime = None
 
 
-    def modify_path(self, path):
+    @staticmethod
+    def modify_path(path):
         # Replace ':' with '_'
         path = path.replace(':', '_')
         # Check if path ends with '.gz', if not, append it
@@ -144,7 +315,11 @@ class BufferedGzipWriter(SlDest):
 
 
     async def task_fn(self):
-        self.file = await aiofile.async_open(self.path, 'wb')
+        if self.resume_size is not None and os.path.isfile(self.path):
+            os.truncate(self.path, self.resume_size)
+            self.file = await aiofile.async_open(self.path, 'ab')
+        else:
+            self.file = await aiofile.async_open(self.path, 'wb')
 
         # Write the Gzip header at the beginning of the file
         await self._write_gzip_header(6)
@@ -153,28 +328,49 @@ class BufferedGzipWriter(SlDest):
         await self.close()
 
     async def write(self, data):
-        await self.queue.put(data)
+        await self.channel.put(data)
+    async def write_all(self, data_list):
+        await self.channel.put_all(data_list)
     def queue_size(self):
-        return self.queue.qsize()
+        return self.channel.qsize()
+    async def checkpoint(self):
+        # the current gzip member is ended once the lines written so far are compressed
+        ack = futures.Future()
+        await self.channel.put_batch(ack)
+        return ack
     async def _writer_task(self):
-        while True:
-            data = await self.queue.get()
-            if data is None:  # Sentinel value for termination
-                break
+        async for batch in self.channel:  # ends on END_OF_STREAM
+            if batch.__class__ is futures.Future:
+                await self._end_member()
+                await self.file.flush()
+                batch.set_result(self.file.tell())
+                await self._start_member()
+                continue
             # Write data to the internal buffer
-            self.buffer.write(data.encode('utf-8'))
+            self.buffer.write(''.join(batch).encode('utf-8'))
             # Flush the buffer if size exceeds 4MB
             if self.buffer.tell() > 4 * 1024 * 1024:
                 await self._flush_buffer()
-            self.queue.task_done()
+        await self._end_member()
+        path_str=self.get_path()
+        writer_log.info(f"All writes to {path_str} finished")
+    async def _end_member(self):
         # Flush remaining data in the buffer, if any
         await self._flush_buffer()
         compressed_data = self.compressor.flush(zlib.Z_FINISH)
         await self.file.write(compressed_data)
         # Write the Gzip footer (CRC32 and input size)
         await self._build_gzip_footer()
-        path_str=self.get_path()
-        writer_log.info(f"All writes to {path_str} finished")
+    async def _start_member(self):
+        # gzip members can be concatenated, the next lines go to a new one
+        self.compressor = zlib.compressobj(self.compresslevel,
+                                         zlib.DEFLATED,
+                                         -zlib.MAX_WBITS,
+                                         zlib.DEF_MEM_LEVEL,
+                                         0)
+        self.crc32 = zlib.crc32(b"")
+        self.input_size = 0
+        await self._write_gzip_header(self.compresslevel)
     async def _flush_buffer(self):
         if self.buffer.tell() > 0:
             # Compress the buffer contents
@@ -192,14 +388,13 @@ class BufferedGzipWriter(SlDest):
         await self.file.write(struct.pack("<L", self.input_size & 0xFFFFFFFF))
 
     async def close(self):
-        if self.queue is not None:
-            await self.queue.put(None)  # Signal t      he writer_task to terminate
+        if self.channel is not None:
             # Close the compression stream
             if self.file is not None:
                 await self.file.close()
             writer_log.info(f"Closed Gzip writer {self.path}")
             self.buffer.close()
-        self.queue = None
+        self.channel = None
         self.compressor = None
         self.file = None
         await super().close()
\ No newline at end of file
@@ -1,11 +1,21 @@
 import logging
-import time
+import os
+from array import array
 from datetime import datetime, timedelta
 
+from concurrent import futures
+
+import numpy as np
 import pandas as pd
 
 from sl_async.st_parquet import write_parquet
-from sl_json.json import encoder, DF_COL
+from sl_json.json import encoder, decoder, new_decode_stats, merge_decode_stats, get_log_hour
+from sl_json.shape import shape_of
+from sl_json.columns import StringTable
+from sl_async.slsketch import SKETCH_COLUMNS, QUANTILES, CODE_BITS, CODE_MASK, sketch_columns, sketch_bins, \
+    reduce_bins, quantiles, encode_sketches, merge_sketches
+from sl_async.sldistinct import DISTINCT_LIMIT, TOP_EXAMPLES, new_registers, value_hashes, add_hashes, encode_hll, \
+    bound_values
 from sl_utils.utils import createDirs
 
 
@@ -73,26 +83,22 @@ def getCommanShapeAggOp():
         agg_operations.update(minMaxAvgTtl(column))
     return agg_operations
 
-total_algo_stand = 0
-total_algo_dd = 0
-# df['command_shape'].astype('category')
-# Use NumPy Operations: If possible, refactor the aggregation to use NumPy operations, which are generally faster as they are implemented in C.
-#
-def groupbyCommandShape(df):
-    global total_algo_stand
-    global total_algo_dd
-    #return df.groupby('command_shape').agg(**getCommanShapeAggOp()).reset_index()
-    start = time.time_ns()
-    result = df.groupby('command_shape').agg(**getCommanShapeAggOp()).reset_index()
-    end = time.time_ns()
-    total_algo_stand+=(end-start)
-
-#    start = time.time_ns()
-#    ddf = dd.from_pandas(df, npartitions=4)
-#    agg_result = ddf.groupby('command_shape').agg(**getCommanShapeAggOp()).compute().reset_index()
-#    end = time.time_ns()
-#    total_algo_dd+=(end-start)
-    return result
+def accumulated_columns():
+    """
+    Columns of the rows aggregated by ShapeAccumulator: the ones with a total, count, min or max
+    and the distinct values column by aggregation key
+    """
+    numeric, distinct = [], {}
+    for key, (column, operation) in getCommanShapeAggOp().items():
+        if operation is distinct_values:
+            distinct[key] = column
+        elif operation in ('sum', 'count', 'min', 'max') and column not in numeric:
+            numeric.append(column)
+    return numeric, distinct
+
+
+NUMERIC_COLUMNS, DISTINCT_COLUMNS = accumulated_columns()
+
 
 def makeSureLessThan24H(time):
     """
@@ -111,154 +117,723 @@ def makeSureLessThan24H(time):
         return None
 
 
-def concat_command(arr):
-    # Concatenate the DataFrame; this will need care taken for recalculations
-    if len(arr)==0:
-        return None
-    return pd.concat(arr, ignore_index=True)
-
-
 def shape_aggA(concatenated):
     if concatenated is None:
         return None
-    agg_operations=getCommanShapeAggOp()
-    # Apply aggregation per group
-    def aggregate_group(group):
-        final_agg = {}
-        final_agg["command_shape"]=group["command_shape"].iloc[0]
-        for key, (column, operation) in agg_operations.items():
-            if operation == 'sum':
-                final_agg[key] = group[key].sum()
-            elif operation == 'count':
-                final_agg[key] = group[key].sum()  # Changed to correct count logic
-            elif operation == 'mean':
-                sum_column = f"{column}_total"
-                count_column = f"{column}_count"
-                final_agg[key] = group[sum_column].sum() / group[count_column].sum()
-            elif operation == 'min':
-                final_agg[key] = group[key].min()
-            elif operation == 'max':
-                final_agg[key] = group[key].max()
-            elif operation == distinct_values:
-                final_agg[key] = distinct_values(group[key])
-            elif isinstance(operation, str):
-                final_agg[key] = group[key].agg(operation)
-            elif callable(operation):
-                final_agg[key] = operation(group[key])
+    return merge_command_shape_agg(concatenated)
+
+
+def merge_command_shape_agg(concatenated):
+    """
+    Merge partial aggregations by shape_id (chunks, hours, ranges) of the getCommanShapeAggOp columns.
+    Sums, counts, mins and maxes are combined by one groupby().agg, the averages recomputed from total and count,
+    the distinct values merged by union (in the order they were first seen, bounded by DISTINCT_LIMIT with a
+    HyperLogLog in the {key}_hll column past it) and has_sort_stage is the mode.
+    The latency sketches of ShapeAccumulator.to_frame, when there are some, are merged and their quantiles recomputed.
+    """
+    agg_operations = getCommanShapeAggOp()
+    # merge of each partial column: count is summed
+    merge_operations = {key: ('sum' if operation == 'count' else operation)
+                        for key, (column, operation) in agg_operations.items() if operation in ('sum', 'count', 'min', 'max')}
+    shape_ids = concatenated['shape_id']
+    merged = concatenated.groupby('shape_id', sort=True).agg(merge_operations)
+    columns = {}
+    hlls = {}
+    for key, (column, operation) in agg_operations.items():
+        if operation == 'mean':
+            columns[key] = merged[f"{column}_total"] / merged[f"{column}_count"]
+        elif operation is distinct_values:
+            columns[key], hlls[f"{key}_hll"] = merge_distinct_values(shape_ids, concatenated[key], merged.index,
+                                                                     concatenated.get(f"{key}_hll"))
+        elif key == 'has_sort_stage':
+            columns[key] = merge_mode(shape_ids, concatenated[key], merged.index)
+    columns.update(hlls)
+    output = list(agg_operations) + list(hlls)
+    for column in SKETCH_COLUMNS:
+        if f"{column}_sketch" in concatenated.columns:
+            sketches = merge_sketches(concatenated[f"{column}_sketch"], merged.index.get_indexer(shape_ids),
+                                      len(merged))
+            for name, values in sketches.items():
+                columns[f"{column}_{name}"] = values
+            output.extend(sketch_columns(column))
+    merged = pd.concat([merged, pd.DataFrame(columns, index=merged.index)], axis=1)[output]
+    merged.insert(0, 'shape_id', merged.index)
+    return merged.reset_index(drop=True)
+
+
+def merge_distinct_values(shape_ids, lists, index, hlls=None):
+    """
+    Union of the distinct_values lists by shape_id, for each shape_id of index, with its encoded HyperLogLog:
+    '' while the union is exact, see bound_values. hlls is the HyperLogLog of each list, when there are some
+    """
+    values = pd.Series(lists.to_numpy(), index=shape_ids.to_numpy()).dropna().explode().dropna()
+    values = values[values != 0]
+    pairs = pd.DataFrame({'shape_id': values.index, 'value': values.to_numpy()}).drop_duplicates()
+    by_shape = {}
+    for shape_id, value in zip(pairs['shape_id'].tolist(), pairs['value'].tolist()):
+        by_shape.setdefault(shape_id, []).append(value)
+    hlls_by_shape = {}
+    if hlls is not None:
+        present = hlls.to_numpy(dtype=object) != ''
+        for shape_id, hll in zip(shape_ids[present].tolist(), hlls[present].tolist()):
+            if isinstance(hll, str) and hll:
+                hlls_by_shape.setdefault(shape_id, []).append(hll)
+    lists = [by_shape.get(shape_id, []) for shape_id in index.tolist()]
+    merged_hlls = [''] * len(lists)
+    for position, shape_id in enumerate(index.tolist()):
+        if len(lists[position]) > DISTINCT_LIMIT or shape_id in hlls_by_shape:
+            lists[position], merged_hlls[position] = bound_values(lists[position], hlls_by_shape.get(shape_id, []))
+    return lists, merged_hlls
+
+
+def merge_mode(shape_ids, values, index):
+    """Most frequent value by shape_id, the smallest one on a tie like Series.mode, False without value"""
+    counts = pd.DataFrame({'shape_id': shape_ids.to_numpy(), 'value': values.to_numpy()}).dropna() \
+        .value_counts().reset_index(name='n')
+    counts = counts.sort_values(['shape_id', 'n', 'value'], ascending=[True, False, True]).drop_duplicates('shape_id')
+    return pd.Series(counts['value'].to_numpy(), index=counts['shape_id'].to_numpy()).reindex(index, fill_value=False)
+
+
+# (slot, value code) pairs of the distinct values of ShapeAccumulator, slot << PAIR_BITS | code
+PAIR_BITS = 32
+PAIR_MASK = (1 << PAIR_BITS) - 1
+# pair arrays kept before they are deduplicated in one
+PAIR_ARRAYS = 64
+# values kept in a StringTable of ShapeAccumulator when it is rebuilt, beyond twice the number of values still used
+TABLE_SLACK = 4096
+# shape_id of the rows of the shapes out of the top shapes of a ShapeAccumulator with top_shapes, and its display
+OTHER_SHAPE_ID = 0
+OTHER_SHAPE_NAME = b"other shapes (out of the top shapes)"
+# weights of the top shapes: total duration and rows
+TOP_WEIGHTS = 2
+
+
+class ShapeAccumulator:
+    """
+    Aggregations of getCommanShapeAggOp by hour and shape_id, updated chunk by chunk (add_frame) or with the
+    accumulator of another chunk, range or file (merge), whatever the order of the hours.
+    The DataFrame is only built by to_frame, at the end of the extraction.
+    Each (hour, shape_id) has a slot: the totals, counts, mins and maxs of each column are numpy arrays indexed
+    by slot, the distinct values are sets of (slot, value code) pairs with their row counts and the values in a
+    StringTable by column, bounded by DISTINCT_LIMIT values by slot with a HyperLogLog past it,
+    the latency sketches of SKETCH_COLUMNS are (slot, bin code) pairs with their counts.
+    With top_shapes > 0 only the heavy hitters are kept (space-saving): the top_shapes shapes by total duration and
+    the top_shapes shapes by rows, the others are moved to the OTHER_SHAPE_ID slot of their hour.
+    """
+    __slots__ = ("slots", "hours", "shape_ids", "hour_names", "rows", "sort_stages", "totals", "counts", "mins",
+                 "maxs", "tables", "pairs", "distinct", "hlls", "sketches", "shapes", "top_shapes", "floor", "errors")
+
+    def __init__(self, top_shapes=0):
+        self.slots = {}
+        # hour (epoch milliseconds) and shape_id of each slot
+        self.hours = array('q')
+        self.shape_ids = array('q')
+        # dhour (time zone of the log) by hour
+        self.hour_names = {}
+        # rows and rows with a sort stage by slot, the arrays have room for more slots than len(self.hours)
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.sort_stages = np.zeros(0, dtype=np.int64)
+        self.totals = {}
+        self.counts = {}
+        self.mins = {}
+        self.maxs = {}
+        self.tables = {key: StringTable() for key in DISTINCT_COLUMNS}
+        # (slot << PAIR_BITS | code, count) arrays by key, added since distinct_pairs
+        self.pairs = {key: [] for key in DISTINCT_COLUMNS}
+        # sorted and bounded (slot << PAIR_BITS | code, count) arrays by key
+        self.distinct = {key: (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)) for key in DISTINCT_COLUMNS}
+        # HyperLogLog registers by slot of the slots with more than DISTINCT_LIMIT values, by key
+        self.hlls = {key: {} for key in DISTINCT_COLUMNS}
+        # (slot << CODE_BITS | code, count) arrays by column
+        self.sketches = {column: [] for column in SKETCH_COLUMNS}
+        # shape_ids of the slots
+        self.shapes = set()
+        # space-saving state when top_shapes > 0: a shape out of the slots has at most the floor weights
+        # (duration, rows), a shape of the slots at most the errors weights (floor when missing) more than its slots
+        self.top_shapes = top_shapes
+        self.floor = (0,) * TOP_WEIGHTS
+        self.errors = {}
+
+    def __len__(self):
+        return len(self.hours)
+
+    def add_frame(self, df, hour_names):
+        """Add the rows of a chunk DataFrame (DF_COL, hour in epoch milliseconds), hour_names is the dhour by hour"""
+        if df.shape[0] == 0:
+            return
+        self.hour_names.update(hour_names)
+        numeric = df[NUMERIC_COLUMNS]
+        for column in NUMERIC_COLUMNS:
+            if numeric[column].dtype == object:
+                # values of several types, as numbers
+                numeric = numeric.assign(**{column: pd.to_numeric(numeric[column], errors='coerce')})
+        groups = numeric.groupby([df['hour'], df['shape_id']], sort=False)
+        # group of each row, numbered in the order of the groups of the aggregations
+        group_ids = groups.ngroup().to_numpy()
+        stats = groups.agg(['sum', 'count', 'min', 'max'])
+        sort_stages = np.bincount(group_ids, weights=(df['has_sort_stage'] == 1).to_numpy(), minlength=len(stats))
+        distinct = {}
+        for key, column in DISTINCT_COLUMNS.items():
+            codes, values = pd.factorize(df[column])
+            values = list(values)
+            # distinct_values drops the missing values and 0
+            valid = codes >= 0
+            zeros = [code for code, value in enumerate(values) if value == 0]
+            if zeros:
+                valid &= ~np.isin(codes, zeros)
+            pairs, pair_counts = np.unique((group_ids[valid].astype(np.int64) << PAIR_BITS) | codes[valid],
+                                           return_counts=True)
+            distinct[key] = (pairs >> PAIR_BITS, pairs & PAIR_MASK, pair_counts, values, {})
+        sketches = {column: sketch_bins(group_ids, numeric[column].to_numpy(np.float64)) for column in SKETCH_COLUMNS}
+        self.fold(stats.index.get_level_values(0).to_numpy(np.int64), stats.index.get_level_values(1).to_numpy(np.int64),
+                  np.bincount(group_ids, minlength=len(stats)), sort_stages.astype(np.int64),
+                  {column: stats[(column, 'sum')].to_numpy() for column in NUMERIC_COLUMNS},
+                  {column: stats[(column, 'count')].to_numpy() for column in NUMERIC_COLUMNS},
+                  {column: stats[(column, 'min')].to_numpy() for column in NUMERIC_COLUMNS},
+                  {column: stats[(column, 'max')].to_numpy() for column in NUMERIC_COLUMNS},
+                  distinct, sketches)
+
+    def merge(self, other):
+        """Add the aggregations of another accumulator"""
+        size = len(other)
+        if size == 0:
+            return
+        self.hour_names.update(other.hour_names)
+        distinct = {}
+        for key in DISTINCT_COLUMNS:
+            pairs, pair_counts = other.distinct_pairs(key)
+            distinct[key] = (pairs >> PAIR_BITS, pairs & PAIR_MASK, pair_counts, other.tables[key].values,
+                             other.hlls[key])
+        sketches = {column: other.sketch_bins(column) for column in SKETCH_COLUMNS}
+        self.merge_errors(other)
+        self.fold(np.frombuffer(other.hours, dtype=np.int64), np.frombuffer(other.shape_ids, dtype=np.int64),
+                  other.rows[:size], other.sort_stages[:size],
+                  {column: values[:size] for column, values in other.totals.items()},
+                  {column: values[:size] for column, values in other.counts.items()},
+                  {column: values[:size] for column, values in other.mins.items()},
+                  {column: values[:size] for column, values in other.maxs.items()},
+                  distinct, sketches)
+        self.top_shapes = max(self.top_shapes, other.top_shapes)
+        if self.top_shapes and len(self.shapes - {OTHER_SHAPE_ID}) > 4 * self.top_shapes:
+            self.prune_shapes()
+
+    def merge_errors(self, other):
+        """Space-saving state of the merge with other: the weights a shape may have missed are added"""
+        if other.floor == self.floor == (0,) * TOP_WEIGHTS:
+            return
+        if other.floor == (0,) * TOP_WEIGHTS and not other.errors:
+            # other is exact, the errors do not change
+            return
+        self.errors = {shape_id: tuple(a + b for a, b in zip(self.errors.get(shape_id, self.floor),
+                                                             other.errors.get(shape_id, other.floor)))
+                       for shape_id in self.shapes | other.shapes if shape_id != OTHER_SHAPE_ID}
+        self.floor = tuple(a + b for a, b in zip(self.floor, other.floor))
+
+    def prune_shapes(self):
+        """
+        Keep the top_shapes shapes with the highest estimated total duration and the top_shapes with the most rows,
+        estimate being the weight of the slots of the shape plus its error, the slots of the others are moved to
+        the OTHER_SHAPE_ID slot of their hour and the floor is raised to the highest estimate of a moved shape
+        """
+        size = len(self.hours)
+        shape_ids = np.frombuffer(self.shape_ids, dtype=np.int64)
+        tracked = shape_ids != OTHER_SHAPE_ID
+        shapes, inverse = np.unique(shape_ids[tracked], return_inverse=True)
+        durations = np.nan_to_num(self.totals["durationMillis"][:size][tracked])
+        weights = np.stack([np.bincount(inverse, weights=durations, minlength=len(shapes)),
+                            np.bincount(inverse, weights=self.rows[:size][tracked], minlength=len(shapes))], axis=1)
+        errors = np.array([self.errors.get(shape_id, self.floor) for shape_id in shapes.tolist()],
+                          dtype=np.float64).reshape(-1, TOP_WEIGHTS)
+        estimates = weights + errors
+        kept = np.zeros(len(shapes), dtype=bool)
+        for weight in range(TOP_WEIGHTS):
+            kept[np.argsort(-estimates[:, weight], kind='stable')[:self.top_shapes]] = True
+        if kept.all():
+            return
+        self.floor = tuple(float(max(floor, estimates[~kept, weight].max())) for weight, floor in enumerate(self.floor))
+        self.errors = {shape_id: tuple(error) for shape_id, error in zip(shapes[kept].tolist(), errors[kept].tolist())}
+        self.move_to_other(shapes[kept])
+
+    def move_to_other(self, kept):
+        """Move the slots of the shapes not in kept (sorted) to the OTHER_SHAPE_ID slot of their hour"""
+        hours = np.frombuffer(self.hours, dtype=np.int64)
+        shape_ids = np.frombuffer(self.shape_ids, dtype=np.int64)
+        moved = (shape_ids != OTHER_SHAPE_ID) & ~np.isin(shape_ids, kept)
+        kept_slots = np.flatnonzero(~moved)
+        positions = np.empty(len(hours), dtype=np.int64)
+        positions[kept_slots] = np.arange(len(kept_slots))
+        new_hours, new_shape_ids = hours[kept_slots].tolist(), shape_ids[kept_slots].tolist()
+        other_hours, other_indexes = np.unique(hours[moved], return_inverse=True)
+        other_positions = []
+        for hour in other_hours.tolist():
+            slot = self.slots.get((hour, OTHER_SHAPE_ID))
+            if slot is None:
+                other_positions.append(len(new_hours))
+                new_hours.append(hour)
+                new_shape_ids.append(OTHER_SHAPE_ID)
             else:
-                logging.warning("key")
+                other_positions.append(positions[slot])
+        positions[moved] = np.array(other_positions, dtype=np.int64)[other_indexes]
+        pruned = ShapeAccumulator()
+        pruned.hour_names = self.hour_names
+        self.fold_into(pruned, positions, np.array(new_hours, dtype=np.int64), np.array(new_shape_ids, dtype=np.int64))
+        for name in ("slots", "hours", "shape_ids", "rows", "sort_stages", "totals", "counts", "mins", "maxs",
+                     "tables", "pairs", "distinct", "hlls", "sketches", "shapes"):
+            setattr(self, name, getattr(pruned, name))
+
+    def fold_into(self, target, positions, hours, shape_ids):
+        """
+        Add the aggregations to target, slot s being the pair (hours[positions[s]], shape_ids[positions[s]]),
+        several slots can have the same position
+        """
+        size = len(self.hours)
+        count = len(hours)
+
+        def added(values):
+            result = np.zeros(count, dtype=values.dtype)
+            np.add.at(result, positions, values[:size])
+            return result
+
+        def reduced(values, ufunc):
+            result = np.empty(count, dtype=values.dtype)
+            result[positions] = values[:size]
+            ufunc.at(result, positions, values[:size])
+            return result
+
+        distinct = {}
+        for key in DISTINCT_COLUMNS:
+            pairs, pair_counts = self.distinct_pairs(key)
+            hlls = {}
+            for slot, registers in self.hlls[key].items():
+                position = int(positions[slot])
+                hlls[position] = registers if position not in hlls else np.maximum(hlls[position], registers)
+            distinct[key] = (positions[pairs >> PAIR_BITS], pairs & PAIR_MASK, pair_counts, self.tables[key].values,
+                             hlls)
+        sketches = {}
+        for column in SKETCH_COLUMNS:
+            slots, codes, bin_counts = self.sketch_bins(column)
+            sketches[column] = (positions[slots], codes, bin_counts)
+        target.fold(hours, shape_ids, added(self.rows), added(self.sort_stages),
+                    {column: added(values) for column, values in self.totals.items()},
+                    {column: added(values) for column, values in self.counts.items()},
+                    {column: reduced(values, np.fmin) for column, values in self.mins.items()},
+                    {column: reduced(values, np.fmax) for column, values in self.maxs.items()},
+                    distinct, sketches)
+
+    def fold(self, hours, shape_ids, rows, sort_stages, totals, counts, mins, maxs, distinct, sketches):
+        """
+        Add aggregations by (hour, shape_id), each pair once: arrays of the aggregations by column,
+        distinct values by aggregation key as (index of the pair, value code, row count, values,
+        HyperLogLog registers by index of the pair)
+        and sketch bins by column as (index of the pair, bin code, count)
+        """
+        size = len(self.hours)
+        slots = self.get_slots(hours, shape_ids)
+        new = slots >= size
+        self.rows[slots] += rows
+        self.sort_stages[slots] += sort_stages
+        for column, total in totals.items():
+            if column not in self.totals:
+                self.add_column(column, total.dtype)
+            elif total.dtype.kind == 'f' and self.totals[column].dtype.kind != 'f':
+                for stats in (self.totals, self.mins, self.maxs):
+                    stats[column] = stats[column].astype(np.float64)
+            self.totals[column][slots] += total
+            self.counts[column][slots] += counts[column]
+            self.mins[column][slots] = np.where(new, mins[column], np.fmin(self.mins[column][slots], mins[column]))
+            self.maxs[column][slots] = np.where(new, maxs[column], np.fmax(self.maxs[column][slots], maxs[column]))
+        for key, (indexes, codes, value_counts, values, hlls) in distinct.items():
+            for index, registers in hlls.items():
+                slot = int(slots[index])
+                current = self.hlls[key].get(slot)
+                self.hlls[key][slot] = registers.copy() if current is None else np.maximum(current, registers)
+            if len(indexes) == 0:
+                continue
+            table = self.tables[key]
+            codes = np.array([table[value] for value in values], dtype=np.int64)[codes]
+            self.pairs[key].append(((slots[indexes] << PAIR_BITS) | codes, value_counts))
+            if len(self.pairs[key]) >= PAIR_ARRAYS:
+                self.distinct_pairs(key)
+        for column, (indexes, codes, bin_counts) in sketches.items():
+            if len(indexes) == 0:
                 continue
-        return pd.Series(final_agg,name=group.name)
-    # Perform the groupby operation with aggregations
-    dfca = concatenated.groupby('command_shape').apply(aggregate_group)
-    return dfca
-
-
-def concat_command_shape_agg(df1,df2):
-    if df1 is None:
-        return df2
-    if df1.shape[0]==0:
-        return df2
-    if df2.shape[0]==0:
-        return df1
-    # Concatenate the DataFrame; this will need care taken for recalculations
-    concatenated = pd.concat([df1, df2], ignore_index=True)
-    agg_operations=getCommanShapeAggOp()
-    # Apply aggregation per group
-    def aggregate_group(group):
-        final_agg = {}
-        final_agg["command_shape"]=group["command_shape"].iloc[0]
-        for key, (column, operation) in agg_operations.items():
+            self.sketches[column].append(((slots[indexes] << CODE_BITS) | codes, bin_counts))
+            if len(self.sketches[column]) >= PAIR_ARRAYS:
+                self.sketch_bins(column)
+
+    def get_slots(self, hours, shape_ids):
+        """Slot of each (hour, shape_id), added when it is new"""
+        slots = self.slots
+        indexes = np.empty(len(hours), dtype=np.int64)
+        for i, key in enumerate(zip(hours.tolist(), shape_ids.tolist())):
+            slot = slots.get(key)
+            if slot is None:
+                slot = slots[key] = len(self.hours)
+                self.hours.append(key[0])
+                self.shape_ids.append(key[1])
+                self.shapes.add(key[1])
+            indexes[i] = slot
+        if len(self.hours) > len(self.rows):
+            self.reserve(max(len(self.hours), 2 * len(self.rows), 1024))
+        return indexes
+
+    def reserve(self, capacity):
+        """Room for capacity slots in the arrays"""
+        def grown(values):
+            new_values = np.zeros(capacity, dtype=values.dtype)
+            new_values[:len(values)] = values
+            return new_values
+        self.rows = grown(self.rows)
+        self.sort_stages = grown(self.sort_stages)
+        for stats in (self.totals, self.counts, self.mins, self.maxs):
+            for column, values in stats.items():
+                stats[column] = grown(values)
+
+    def add_column(self, column, dtype):
+        dtype = np.float64 if dtype.kind == 'f' else np.int64
+        capacity = len(self.rows)
+        self.totals[column] = np.zeros(capacity, dtype=dtype)
+        self.counts[column] = np.zeros(capacity, dtype=np.int64)
+        self.mins[column] = np.zeros(capacity, dtype=dtype)
+        self.maxs[column] = np.zeros(capacity, dtype=dtype)
+
+    def distinct_pairs(self, key):
+        """
+        Sorted (slot, value code) pairs of a distinct values key and their row counts, the pairs added since the
+        last call are merged in them and bounded
+        """
+        pending = self.pairs[key]
+        if len(pending) == 0:
+            return self.distinct[key]
+        pairs, counts = self.distinct[key]
+        added = np.concatenate([added for added, _ in pending])
+        pairs, inverse = np.unique(np.concatenate([pairs, added]), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=np.concatenate([counts] + [counts for _, counts in pending]),
+                             minlength=len(pairs)).astype(np.int64)
+        pending.clear()
+        pairs, counts = self.bound_pairs(key, pairs, counts, np.unique(added >> PAIR_BITS))
+        self.distinct[key] = self.compact_table(key, pairs), counts
+        return self.distinct[key]
+
+    def bound_pairs(self, key, pairs, counts, changed):
+        """
+        Keep at most DISTINCT_LIMIT values by slot: the values of the slots past it (or with a HyperLogLog
+        already) which changed are added to their HyperLogLog and only their TOP_EXAMPLES most frequent are kept
+        """
+        slots = pairs >> PAIR_BITS
+        hlls = self.hlls[key]
+        approximate = np.union1d(np.flatnonzero(np.bincount(slots) > DISTINCT_LIMIT),
+                                 np.fromiter(hlls, dtype=np.int64, count=len(hlls)))
+        if len(approximate) == 0:
+            return pairs, counts
+        updated = np.intersect1d(approximate, changed)
+        if len(updated):
+            rows = np.minimum(np.searchsorted(updated, slots), len(updated) - 1)
+            hashed = updated[rows] == slots
+            codes, code_indexes = np.unique(pairs[hashed] & PAIR_MASK, return_inverse=True)
+            values = self.tables[key].values
+            registers = new_registers(len(updated))
+            for row, slot in enumerate(updated.tolist()):
+                if slot in hlls:
+                    registers[row] = hlls[slot]
+            add_hashes(registers, rows[hashed], value_hashes([values[code] for code in codes.tolist()])[code_indexes])
+            for row, slot in enumerate(updated.tolist()):
+                hlls[slot] = registers[row].copy()
+        # rank of each pair in its slot by decreasing count
+        ranked = np.lexsort((pairs, -counts, slots))
+        ranked_slots = slots[ranked]
+        ranks = np.arange(len(ranked)) - np.searchsorted(ranked_slots, ranked_slots)
+        kept = np.sort(ranked[(ranks < TOP_EXAMPLES) | ~np.isin(ranked_slots, approximate)])
+        return pairs[kept], counts[kept]
+
+    def compact_table(self, key, pairs):
+        """Rebuild the StringTable of a key without the values dropped by bound_pairs when they are too many"""
+        table = self.tables[key]
+        codes = pairs & PAIR_MASK
+        used = np.unique(codes)
+        if len(table.values) <= 2 * len(used) + TABLE_SLACK:
+            return pairs
+        values = table.values
+        self.tables[key] = StringTable.from_values([values[code] for code in used.tolist()])
+        # the codes keep their order, the pairs stay sorted
+        return ((pairs >> PAIR_BITS) << PAIR_BITS) | np.searchsorted(used, codes)
+
+    def sketch_bins(self, column):
+        """Sketch bins (slot, code, count) of a column sorted by slot and code, kept as one array"""
+        bins = self.sketches[column]
+        if len(bins) == 0:
+            return reduce_bins([], [], [])
+        if len(bins) > 1:
+            keys = np.concatenate([keys for keys, _ in bins])
+            slots, codes, counts = reduce_bins(keys >> CODE_BITS, keys & CODE_MASK,
+                                               np.concatenate([counts for _, counts in bins]))
+            bins[:] = [((slots << CODE_BITS) | codes, counts)]
+        keys, counts = bins[0]
+        return keys >> CODE_BITS, keys & CODE_MASK, counts
+
+    def distinct_lists(self, key, order):
+        """
+        List of the distinct values of each slot of order, in the order they were first seen (the most frequent
+        first for the slots with a HyperLogLog) and the encoded HyperLogLog of each slot, '' when exact
+        """
+        lists = [[] for _ in range(len(self.hours))]
+        pairs, counts = self.distinct_pairs(key)
+        hlls = self.hlls[key]
+        slots = pairs >> PAIR_BITS
+        approximate = np.isin(slots, np.fromiter(hlls, dtype=np.int64, count=len(hlls)))
+        ranked = np.lexsort((pairs, np.where(approximate, -counts, 0), slots))
+        values = self.tables[key].values
+        for slot, code in zip(slots[ranked].tolist(), (pairs[ranked] & PAIR_MASK).tolist()):
+            lists[slot].append(values[code])
+        order = order.tolist()
+        return [lists[slot] for slot in order], [encode_hll(hlls[slot]) if slot in hlls else '' for slot in order]
+
+    def to_frame(self, hour=None):
+        """DataFrame of the aggregations by hour and shape_id (only of hour, epoch milliseconds, when set), None if empty"""
+        if len(self.hours) == 0:
+            return None
+        hours = np.frombuffer(self.hours, dtype=np.int64)
+        shape_ids = np.frombuffer(self.shape_ids, dtype=np.int64)
+        order = np.lexsort((shape_ids, hours))
+        if hour is not None:
+            order = order[hours[order] == hour]
+            if len(order) == 0:
+                return None
+        data = {"shape_id": shape_ids[order]}
+        hlls = {}
+        for key, (column, operation) in getCommanShapeAggOp().items():
             if operation == 'sum':
-                final_agg[key] = group[key].sum()
+                data[key] = self.totals[column][order]
             elif operation == 'count':
-                final_agg[key] = group[key].sum()
-            elif operation == 'mean':
-                sum_column = f"{column}_total"
-                count_column = f"{column}_count"
-                final_agg[key] = group[sum_column].sum() / group[count_column].sum()
+                data[key] = self.counts[column][order]
             elif operation == 'min':
-                final_agg[key] = group[key].min()
+                data[key] = self.mins[column][order]
             elif operation == 'max':
-                final_agg[key] = group[key].max()
-            elif operation == distinct_values:
-                final_agg[key] = distinct_values(group[key])
-            elif isinstance(operation, str):
-                final_agg[key] = group[key].agg(operation)
-            elif callable(operation):
-                final_agg[key] = operation(group[key])
-            else:
-                logging.warning("key")
-                continue
-        return pd.Series(final_agg,name=group.name)
-    # Perform the groupby operation with aggregations
-    dfca = concatenated.groupby('command_shape').apply(aggregate_group)
-    return dfca
+                data[key] = self.maxs[column][order]
+            elif operation == 'mean':
+                data[key] = pd.Series(self.totals[column][order]) / pd.Series(self.counts[column][order])
+            elif operation is distinct_values:
+                data[key], hlls[f"{key}_hll"] = self.distinct_lists(key, order)
+            elif key == 'has_sort_stage':
+                # mode of 0 and 1, 0 on a tie
+                data[key] = (2 * self.sort_stages[order] > self.rows[order]).astype(np.int64)
+        data.update(hlls)
+        # sketch bins by position in order
+        positions = np.full(len(self.hours), -1, dtype=np.int64)
+        positions[order] = np.arange(len(order))
+        for column in SKETCH_COLUMNS:
+            slots, codes, counts = self.sketch_bins(column)
+            ids = positions[slots]
+            kept = ids >= 0
+            ids, codes, counts = reduce_bins(ids[kept], codes[kept], counts[kept])
+            for name, quantile in QUANTILES.items():
+                data[f"{column}_{name}"] = quantiles(ids, codes, counts, len(order), quantile)
+            data[f"{column}_sketch"] = encode_sketches(ids, codes, counts, len(order))
+        data["hour"] = pd.Series(hours[order]).map(self.hour_names)
+        return pd.DataFrame(data)
 
 
-def append_to_parquet(data, file_path_base,dtime,id,save_by_chunk,dumpAggregation,result,saveAll=False,
-                      generate_orig_only=False):
-    day  = dtime.strftime('%Y%m%d')
-    hour = dtime.strftime('%H')
-    dhour = dtime.strftime('%Y-%m-%d_%H')
-    result["countOfSlow"]+=len(data)
-    if saveAll:
-        result["resume"]["id"]=id
-        result["resume"]["dtime"]=dtime.isoformat()
-        winner = "dask"
-        if total_algo_stand < total_algo_dd :
-            winner = "stand"
-        elif total_algo_stand == total_algo_dd:
-            winner = "none"
-        logging.info(f"winner={winner} stand={total_algo_stand}ns and dd={total_algo_dd}ns")
-        with open(f"{file_path_base}resume.json", "w") as out_file:
-            encoder.encode(result["resume"])
-    file_path_base=f"{file_path_base}{day}/"
-    file_path=f"{file_path_base}{hour}/"
+def new_hour_shape_stats(top_shapes=0):
+    return {"groupByCommandShape": ShapeAccumulator(top_shapes),
+            "groupByCommandShapeChangeStream": ShapeAccumulator(top_shapes)}
+
+
+class ChunkPartial:
+    """Aggregations of one chunk, computed without the result by aggregate_chunk and merged in it by commit_chunk"""
+    __slots__ = ("id", "dtime", "count", "shapes", "stats")
+
+    def __init__(self, id, dtime, count, shapes):
+        self.id = id
+        self.dtime = dtime
+        self.count = count
+        self.shapes = shapes
+        # ShapeAccumulator of the rows of the chunk by type (groupByCommandShape...), None for orig only
+        self.stats = None
+
+
+def aggregate_chunk(data, file_path_base, dtime, id, save_by_chunk, generate_orig_only=False):
+    """
+    Part of the aggregation of a chunk which does not depend on the other chunks: the chunk file and the
+    aggregations of its rows by hour and shape. Can run in any worker, in any order.
+    """
+    log_hour = get_log_hour(dtime)
+    partial = ChunkPartial(id, dtime, len(data), data.shapes)
+    file_path=f"{file_path_base}{log_hour.day}/{log_hour.hh}/"
     createDirs(file_path)
-    df_chunk = pd.DataFrame(data, columns=DF_COL)
+    df_chunk = data.to_frame()
     if not generate_orig_only :
-       updateCommandShapeGroupHour(df_chunk[df_chunk['changestream'] == False], dhour, result, "groupByCommandShape")
-       updateCommandShapeGroupHour(df_chunk[df_chunk['changestream'] == True], dhour, result, "groupByCommandShapeChangeStream")
-
+        partial.stats = new_hour_shape_stats()
+        partial.stats["groupByCommandShape"].add_frame(df_chunk[df_chunk['changestream'] == False], data.hours)
+        partial.stats["groupByCommandShapeChangeStream"].add_frame(df_chunk[df_chunk['changestream'] == True], data.hours)
+    # epoch milliseconds to datetime64
+    df_chunk['timestamp'] = pd.to_datetime(df_chunk['timestamp'], unit='ms', utc=True)
+    df_chunk['hour'] = pd.to_datetime(df_chunk['hour'], unit='ms', utc=True)
 
     if save_by_chunk == "parquet":
         write_parquet(df_chunk, f"{file_path}/{id}_orig.parquet")
-        if (dumpAggregation or saveAll) and (not generate_orig_only) :
-            write_parquet(result["groupByCommandShape"][dhour], f"{file_path}/{id}_groupByShape.parquet")
-        if saveAll and (not generate_orig_only):
-            updateCommandShapeGroupGlobal(result)
-            write_parquet(result["groupByCommandShape"]["global"], f"{file_path_base}/{id}_groupByShapeAll.parquet")
     elif save_by_chunk == "json":
         #split for compact json
         df_chunk.to_json(f"{file_path}/{id}_orig.json", orient = 'records', compression = 'infer')
-        if (dumpAggregation or saveAll) and (not generate_orig_only):
-            result["groupByCommandShape"][dhour].to_json(f"{file_path}/{id}_groupByShape.json", orient = 'records', compression = 'infer')
-        if saveAll and (not generate_orig_only):
+    return partial
+
+
+def commit_chunk(partial, file_path_base, save_by_chunk, dumpAggregation, result, saveAll=False):
+    """Merge the ChunkPartial of a chunk in result, the chunks being committed one at a time in their order"""
+    log_hour = get_log_hour(partial.dtime)
+    result["countOfSlow"]+=partial.count
+    result["shapes"].update(partial.shapes)
+    if saveAll:
+        result["resume"]["id"]=partial.id
+        result["resume"]["dtime"]=partial.dtime.isoformat()
+    if partial.stats is None:
+        return True
+    for type, accumulator in partial.stats.items():
+        result["hourShapeStats"][type].merge(accumulator)
+    keep_tracked_shapes(result)
+    file_path_base=f"{file_path_base}{log_hour.day}/"
+    file_path=f"{file_path_base}{log_hour.hh}/"
+    id = partial.id
+    # aggregations of the hour of the chunk so far
+    hour_df = None
+    if (dumpAggregation or saveAll) and save_by_chunk in ("parquet", "json"):
+        hour_df = result["hourShapeStats"]["groupByCommandShape"].to_frame(log_hour.epoch)
+    if save_by_chunk == "parquet":
+        if hour_df is not None:
+            write_parquet(hour_df, f"{file_path}/{id}_groupByShape.parquet")
+        if saveAll:
+            updateCommandShapeGroupGlobal(result)
+            write_parquet(result["groupByCommandShape"]["global"], f"{file_path_base}/{id}_groupByShapeAll.parquet")
+    elif save_by_chunk == "json":
+        if hour_df is not None:
+            hour_df.to_json(f"{file_path}/{id}_groupByShape.json", orient = 'records', compression = 'infer')
+        if saveAll:
             updateCommandShapeGroupGlobal(result)
             result["groupByCommandShape"]["global"].to_json(f"{file_path_base}/{id}_groupByShapeAll.json", orient = 'records', compression = 'infer')
     return True
 
 
-def updateCommandShapeGroupHour(df_withoutChangestream, hour, result, type):
-    command_shape_stats = groupbyCommandShape(df_withoutChangestream)
-    result[type][hour] = concat_command_shape_agg(
-        result[type].get(hour, None), command_shape_stats)
-    return True
+def append_to_parquet(data, file_path_base,dtime,id,save_by_chunk,dumpAggregation,result,saveAll=False,
+                      generate_orig_only=False):
+    partial = aggregate_chunk(data, file_path_base, dtime, id, save_by_chunk, generate_orig_only)
+    return commit_chunk(partial, file_path_base, save_by_chunk, dumpAggregation, result, saveAll)
+
+
+def keep_tracked_shapes(result):
+    """
+    With top shapes, drop from the side table result["shapes"] the JSON shapes of the shapes no longer tracked,
+    once it has twice as many shapes as the accumulators so it is not rebuilt at every chunk
+    """
+    accumulators = result["hourShapeStats"].values()
+    if not any(accumulator.top_shapes for accumulator in accumulators):
+        return
+    tracked = set().union(*(accumulator.shapes for accumulator in accumulators))
+    if len(result["shapes"]) > 2 * len(tracked):
+        result["shapes"] = {fingerprint: shape for fingerprint, shape in result["shapes"].items()
+                            if fingerprint in tracked}
 
 
 def updateCommandShapeGroupGlobal(result):
     for type in ["groupByCommandShape","groupByCommandShapeChangeStream"]:
-        array = []
-        keys = []
-        for key,value in result[type].items():
-            if value is not None and value.shape[0] > 0:
-                value["hour"]=key
-                array.append(value)
-            keys.append(key)
-        for key in keys:
-            del result[type][key]
-        result[type]["hours"] = concat_command(array)
+        # the only DataFrame of the hours, built from the accumulator
+        result[type]["hours"] = result["hourShapeStats"][type].to_frame()
         result[type]["global"] = shape_aggA(result[type]["hours"])
+        if result[type]["global"] is not None:
+            # JSON shape for display, the ones known before the extraction are in the shape registry
+            shapes = result["shapes"]
+            result[type]["global"].insert(1, "command_shape",
+                                          result[type]["global"]["shape_id"].map(
+                                              lambda shape_id: OTHER_SHAPE_NAME if shape_id == OTHER_SHAPE_ID
+                                              else shape_of(shape_id, shapes)))
+    return True
+
+
+
+def merge_results(results):
+    """
+    Merge several extraction results (one per worker, range or file) into one result
+    with the same shape as the one returned by AsyncExtractAndAggregate.
+    """
+    merged = {"countOfSlow": 0, "systemSkipped": 0, "groupByCommandShape": {}, "groupByCommandShapeChangeStream": {},
+              "hourShapeStats": new_hour_shape_stats(), "shapes": {}, "resume": {}, "decodeStats": new_decode_stats()}
+    for result in results:
+        merged["countOfSlow"] += result.get("countOfSlow", 0)
+        merged["shapes"].update(result.get("shapes", {}))
+        merged["systemSkipped"] += result.get("systemSkipped", 0)
+        merge_decode_stats(merged["decodeStats"], result.get("decodeStats", {}))
+        for type, accumulator in result["hourShapeStats"].items():
+            merged["hourShapeStats"][type].merge(accumulator)
+    keep_tracked_shapes(merged)
+    updateCommandShapeGroupGlobal(merged)
+    return merged
+
+
+def save_global_aggregation(result, file_path_base, save_by_chunk):
+    if save_by_chunk == "parquet":
+        if result["groupByCommandShape"].get("global", None) is not None:
+            write_parquet(result["groupByCommandShape"]["global"], f"{file_path_base}groupByShapeAll.parquet")
+    elif save_by_chunk == "json":
+        if result["groupByCommandShape"].get("global", None) is not None:
+            result["groupByCommandShape"]["global"].to_json(f"{file_path_base}groupByShapeAll.json", orient = 'records', compression = 'infer')
+
+
+CHECKPOINT_TYPES = ["hourShapeStats", "shapes"]
+# version of the checkpoint state, the checkpoints of the other versions are ignored
+CHECKPOINT_VERSION = 4
+
+
+def save_checkpoint(result, file_path_base, checkpoint, pending, dest_checkpoint=None):
+    """
+    Save the aggregations of the chunks flushed so far, the entries not flushed yet (pending)
+    and the source offset they cover, so that an interrupted extraction continues from there.
+    Runs in the aggregation pool, after the chunks it covers and before the next ones.
+    """
+    if dest_checkpoint is not None:
+        try:
+            checkpoint["output_size"] = dest_checkpoint.result(timeout=600)
+        except futures.TimeoutError:
+            # keep the previous checkpoint, consistent with the slow query log
+            logging.warning("slow query log checkpoint not acknowledged, checkpoint skipped")
+            return False
+    checkpoint["countOfSlow"] = result["countOfSlow"]
+    state = {type: result[type] for type in CHECKPOINT_TYPES}
+    state["version"] = CHECKPOINT_VERSION
+    state["pending"] = pending
+    pd.to_pickle(state, f"{file_path_base}checkpoint.pkl.tmp")
+    os.replace(f"{file_path_base}checkpoint.pkl.tmp", f"{file_path_base}checkpoint.pkl")
+    result["resume"].update(checkpoint)
+    with open(f"{file_path_base}resume.json.tmp", "wb") as out_file:
+        out_file.write(encoder.encode(result["resume"]))
+    os.replace(f"{file_path_base}resume.json.tmp", f"{file_path_base}resume.json")
     return True
 
+
+def load_checkpoint(file_path_base, log_file_path, follow=False):
+    """
+    Checkpoint left in resume.json by an interrupted extraction of log_file_path (or the last follow run),
+    None when the extraction has to start from the beginning.
+    When follow the log may have been rotated since, the source finds its offset in its own state (follow.json):
+    without it the checkpoint is ignored, the file is followed again from the beginning.
+    """
+    if not os.path.isfile(f"{file_path_base}resume.json") or not os.path.isfile(f"{file_path_base}checkpoint.pkl"):
+        return None
+    if follow and not os.path.isfile(f"{file_path_base}follow.json"):
+        logging.info(f"no followed offset in {file_path_base}, follow from the beginning")
+        return None
+    with open(f"{file_path_base}resume.json", "rb") as in_file:
+        checkpoint = decoder.decode(in_file.read())
+    if checkpoint.get("complete", True) or checkpoint.get("offset", None) is None:
+        return None
+    size = None if follow else os.path.getsize(log_file_path)
+    if checkpoint.get("source", None) != log_file_path or size is not None and (
+            size < checkpoint.get("source_size", 0) or
+            (log_file_path.endswith('.gz') and size != checkpoint.get("source_size", 0))):
+        logging.info(f"checkpoint in {file_path_base} is not for the current {log_file_path}, start from the beginning")
+        return None
+    state = pd.read_pickle(f"{file_path_base}checkpoint.pkl")
+    if state.pop("version", None) != CHECKPOINT_VERSION:
+        logging.info(f"checkpoint in {file_path_base} is from an older version, start from the beginning")
+        return None
+    checkpoint["pending"] = state.pop("pending")
+    checkpoint["aggregates"] = state
+    logging.info(f"continue {log_file_path} from offset {checkpoint['offset']} with {checkpoint['countOfSlow']} slow queries")
+    return checkpoint
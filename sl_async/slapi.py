@@ -1,16 +1,102 @@
 import asyncio
-import logging
+from datetime import timezone
+
+from sl_json.json import get_time_from_prefix
 
 class SLClosable:
     async def close(self):
         pass
 
+
+class EndOfStream:
+    """Marker sent once in a channel after the last batch"""
+    def __repr__(self):
+        return "END_OF_STREAM"
+
+END_OF_STREAM = EndOfStream()
+
+
+class SourceOffset:
+    """Marker sent in a channel as its own batch: every line before offset in the source has been sent"""
+    __slots__ = ("offset", "inode", "decode_stats")
+
+    def __init__(self, offset, inode=None):
+        self.offset = offset
+        self.inode = inode  # file of the offset when the source follows a rotated log, None otherwise
+        self.decode_stats = None  # decode counters of the lines before offset, set by the decode stage
+
+    def __repr__(self):
+        return f"SourceOffset({self.offset})"
+
+
+class SLChannel:
+    """
+    Bounded channel carrying batches (lists) of items between two pipeline stages.
+    Items are buffered until batch_size is reached so the stages only switch once per batch,
+    close() sends the pending items followed by END_OF_STREAM.
+    """
+    def __init__(self, max_batches=16, batch_size=256):
+        self.queue = asyncio.Queue(max(1, max_batches))
+        self.batch_size = batch_size
+        self.batch = []
+
+    async def put(self, item):
+        self.batch.append(item)
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+
+    async def put_all(self, items):
+        self.batch.extend(items)
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+
+    async def put_batch(self, batch):
+        """Send a ready made batch, after the pending items to keep the order"""
+        await self.flush()
+        if batch:
+            await self.queue.put(batch)
+
+    async def flush(self):
+        if self.batch:
+            batch = self.batch
+            self.batch = []
+            await self.queue.put(batch)
+
+    async def close(self):
+        await self.flush()
+        await self.queue.put(END_OF_STREAM)
+
+    async def get_batch(self):
+        """Next batch, None once END_OF_STREAM is received"""
+        batch = await self.queue.get()
+        self.queue.task_done()
+        if batch is END_OF_STREAM:
+            return None
+        return batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        batch = await self.get_batch()
+        if batch is None:
+            raise StopAsyncIteration
+        return batch
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def maxsize(self):
+        return self.queue.maxsize
+
+
 class SLTask(SLClosable):
-    def __init__(self,max_queue_size):
+    def __init__(self,max_queue_size,batch_size=256):
         super().__init__()
+        # max_queue_size is in items, the channel holds batches of batch_size items
         self.max_queue_size=max_queue_size
-        self.queue = asyncio.Queue(max_queue_size)
-        self.max_queue_size=max_queue_size
+        self.batch_size=batch_size
+        self.channel = SLChannel(-(-max_queue_size // batch_size), batch_size)
         self.task=None
 
     def create_task(self):
@@ -26,19 +112,19 @@ class SLTask(SLClosable):
         return self.task
 
     def get_queue_size(self):
-        return self.queue.qsize()
+        return self.channel.qsize()
 
     def get_max_queue_size(self):
         return self.max_queue_size
 
-    def get_queue(self):
-        return self.queue
+    def get_channel(self):
+        return self.channel
 
 
 
 class SlSource(SLTask):
-    def __init__(self,path,max_queue_size):
-        super().__init__(max_queue_size)
+    def __init__(self,path,max_queue_size,batch_size=256):
+        super().__init__(max_queue_size,batch_size)
         self.path=path #url or file path
 
     def get_path(self):
@@ -47,25 +133,23 @@ class SlSource(SLTask):
     def get_name(self):
         return f"src:{self.path}"
 
-    async def __aenter__(self):
-        return self
+    def commit_offset(self, source_offset):
+        """Called once every line before source_offset (a SourceOffset) is aggregated or checkpointed"""
+        pass
 
-    async def __aiter__(self):
+    async def __aenter__(self):
         return self
 
-    async def __anext__(self):
-        logging.info(f"next called")
-        cur = self.queue.get()
-        if cur == "":
-            raise StopIteration  # End of file
-        return cur
+    def __aiter__(self):
+        # iterate over the batches of lines
+        return self.channel.__aiter__()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.close()
 
 class SlDest(SLTask):
-    def __init__(self,path,max_queue_size):
-        super().__init__(max_queue_size)
+    def __init__(self,path,max_queue_size,batch_size=256):
+        super().__init__(max_queue_size,batch_size)
         self.path=path #url or file path
 
     def get_path(self):
@@ -75,20 +159,20 @@ class SlDest(SLTask):
         return f"dst:{self.path}"
 
     async def notify_write_end(self):
-        await self.queue.put(None)
+        await self.channel.close()
+
+    async def checkpoint(self):
+        """
+        Future of the position to restart the destination from once everything written so far is durable,
+        None when the destination can not be resumed.
+        """
+        return None
 
     async def __aenter__(self):
         return self
 
-    async def __aiter__(self):
-        return self
-
-    async def __anext__(self):
-        logging.info(f"next called")
-        cur = self.queue.get()
-        if cur == "":
-            raise StopIteration  # End of file
-        return cur
+    def __aiter__(self):
+        return self.channel.__aiter__()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.close()
@@ -98,23 +182,64 @@ class SlDest(SLTask):
         await super().close()
 
 class SourceFilter(SLClosable):
-    def __init__(self,queue):
+    def __init__(self,channel):
        super().__init__()
-       self.queue=queue
+       self.channel=channel
+
+    async def process(self, line):
+       pass
+
+    async def process_block(self, buffer, start, end):
+        """
+        Process the raw lines of buffer[start:end] (bytearray or mmap), start and end being line boundaries.
+        By default decode each line and give it to process.
+        """
+        with memoryview(buffer) as view:
+            while start < end:
+                stop = buffer.find(b'\n', start, end)
+                stop = end if stop < 0 else stop + 1
+                await self.process(str(view[start:stop], 'utf-8'))
+                start = stop
+
+    async def flush(self):
+        await self.channel.flush()
+
+    async def mark_offset(self, offset, inode=None):
+        """Send a SourceOffset after the lines already selected, used to checkpoint the extraction"""
+        await self.channel.put_batch(SourceOffset(offset, inode))
 
     def close(self):
-       self.queue=None
+       self.channel=None
 
 
 
 class DefaultSourceFilter(SourceFilter):
     def __init__(self,
-                 queue,
+                 channel,
                  filter_list=None,
-                 min_size=20):
-        super().__init__(queue)
+                 min_size=20,
+                 start_time=None,
+                 end_time=None):
+        super().__init__(channel)
         self.filter_list= ['"msg":"Slow query"'] if filter_list is None else filter_list
+        self.filter_bytes=[pattern.encode('utf-8') for pattern in self.filter_list]
         self.min_size=min_size
+        # [start_time,end_time) window checked on the raw time prefix of the selected lines
+        self.start_time=start_time
+        self.end_time=end_time
+        # set once a line after end_time has been seen, the readers can stop there
+        self.done=False
+
+    def in_window(self, line):
+        line_time = get_time_from_prefix(line)
+        if line_time is None:
+            return False
+        if line_time.tzinfo is None:
+            line_time = line_time.replace(tzinfo=timezone.utc)
+        if self.end_time is not None and line_time >= self.end_time:
+            self.done = True
+            return False
+        return self.start_time is None or line_time >= self.start_time
 
     async def process(self, line):
         if not line:
@@ -126,4 +251,34 @@ class DefaultSourceFilter(SourceFilter):
             find = True
         if not find:
             return
-        await self.queue.put(line)
+        if (self.start_time is not None or self.end_time is not None) and not self.in_window(line[:96].encode()):
+            return
+        await self.channel.put(line)
+
+    def find_lines(self, buffer, start, end):
+        """[start,stop) of the lines of buffer[start:end] containing one of the patterns, without splitting the others"""
+        spans = []
+        for pattern in self.filter_bytes:
+            pos = buffer.find(pattern, start, end)
+            while pos >= 0:
+                line_start = buffer.rfind(b'\n', start, pos) + 1
+                line_start = max(line_start, start)
+                line_stop = buffer.find(b'\n', pos, end)
+                line_stop = end if line_stop < 0 else line_stop + 1
+                spans.append((line_start, line_stop))
+                pos = buffer.find(pattern, line_stop, end)
+        if len(self.filter_bytes) > 1:
+            spans = sorted(set(spans))
+        return spans
+
+    async def process_block(self, buffer, start, end):
+        # only the selected lines are decoded, straight from the buffer
+        spans = self.find_lines(buffer, start, end)
+        with memoryview(buffer) as view:
+            if self.start_time is not None or self.end_time is not None:
+                spans = [(line_start, line_stop) for line_start, line_stop in spans
+                         if self.in_window(view[line_start:min(line_stop, line_start + 96)].tobytes())]
+            lines = [str(view[line_start:line_stop], 'utf-8')
+                     for line_start, line_stop in spans
+                     if line_stop - line_start >= self.min_size]
+        await self.channel.put_all(lines)
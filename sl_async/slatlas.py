@@ -14,12 +14,16 @@ class BufferedSlAtlasSource(SlSource):
                  atlas,
                  groupId,
                  processId,
-                 line_buffer_size=500,
+                 line_buffer_size=4096,
                  dtime=None,
-                 line_filter: SourceFilter =None):
-        super().__init__(path=processId,max_queue_size=line_buffer_size)
+                 line_filter: SourceFilter =None,
+                 batch_size=256,
+                 start_time=None,
+                 end_time=None):
+        super().__init__(path=processId,max_queue_size=line_buffer_size,batch_size=batch_size)
         self.atlas=atlas
-        self.line_filter=DefaultSourceFilter(self.queue) if line_filter is None else line_filter
+        self.line_filter=DefaultSourceFilter(self.channel, start_time=start_time, end_time=end_time) \
+            if line_filter is None else line_filter
         self.groupId=groupId
         self.processId=processId
         self.dtime=dtime
@@ -95,8 +99,9 @@ class BufferedSlAtlasSource(SlSource):
                 self.dtime = get_time_from_line(last_entry)
 
 
+        await self.line_filter.flush()
         sl_atlas_log.info(f"read {self.path} complete after {it} iteration, loaded {total_loaded}")
-        await self.queue.put(None)
+        await self.channel.close()
 
     async def close(self):
         pass
@@ -0,0 +1,92 @@
+import base64
+import math
+
+import numpy as np
+import pandas as pd
+
+# Bounded distinct values: the values of a slot (hour and shape, shape...) are kept exactly up to DISTINCT_LIMIT of
+# them. Past it the slot has a HyperLogLog of all its values, for their count, and only keeps its TOP_EXAMPLES
+# most frequent values as examples, so the memory and the merges of a slot stay bounded whatever the cardinality.
+DISTINCT_LIMIT = 100
+TOP_EXAMPLES = 20
+# 2 ** HLL_BITS one byte registers, standard error of the count 1.04 / sqrt(2 ** HLL_BITS) (3.3%)
+HLL_BITS = 10
+HLL_SIZE = 1 << HLL_BITS
+HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_SIZE)
+
+
+def new_registers(count=None):
+    """Empty HyperLogLog registers, count of them as a 2D array when set"""
+    return np.zeros(HLL_SIZE if count is None else (count, HLL_SIZE), dtype=np.uint8)
+
+
+def value_hashes(values):
+    """64 bits hash of the text of each value, the same in every process (unlike hash())"""
+    if len(values) == 0:
+        return np.empty(0, dtype=np.uint64)
+    return pd.util.hash_array(np.array([str(value) for value in values], dtype=object), categorize=False)
+
+
+def leading_zeros(words):
+    """Number of leading zero bits of each uint64"""
+    words = words.copy()
+    zeros = np.zeros(len(words), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        small = words < np.uint64(1 << (64 - shift))
+        zeros[small] += shift
+        words[small] <<= np.uint64(shift)
+    zeros[words == 0] = 64
+    return zeros
+
+
+def add_hashes(registers, rows, hashes):
+    """Add the hashes to the HyperLogLogs registers[rows] (2D registers)"""
+    if len(hashes) == 0:
+        return
+    indexes = (hashes >> np.uint64(64 - HLL_BITS)).astype(np.int64)
+    ranks = np.minimum(leading_zeros(hashes << np.uint64(HLL_BITS)), 64 - HLL_BITS) + 1
+    np.maximum.at(registers, (rows, indexes), ranks.astype(np.uint8))
+
+
+def estimate(registers):
+    """Number of distinct values added to the registers"""
+    raw = HLL_ALPHA * HLL_SIZE * HLL_SIZE / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+    zeros = int(np.count_nonzero(registers == 0))
+    if raw <= 2.5 * HLL_SIZE and zeros:
+        # linear counting of the small cardinalities
+        return HLL_SIZE * math.log(HLL_SIZE / zeros)
+    return raw
+
+
+def encode_hll(registers):
+    return base64.b64encode(registers.tobytes()).decode('ascii')
+
+
+def decode_hll(hll):
+    return np.frombuffer(base64.b64decode(hll), dtype=np.uint8).copy()
+
+
+def distinct_count(hll):
+    """Estimated number of distinct values of an encoded HyperLogLog"""
+    return round(estimate(decode_hll(hll)))
+
+
+def bound_values(values, hlls):
+    """
+    Merged distinct values of a slot: (values, '') while they are at most DISTINCT_LIMIT and no list was approximate,
+    else the TOP_EXAMPLES first values with the union of the encoded HyperLogLogs hlls and of all the values
+    """
+    if len(values) <= DISTINCT_LIMIT and not hlls:
+        return values, ''
+    registers = new_registers(1)
+    for hll in hlls:
+        np.maximum(registers[0], decode_hll(hll), out=registers[0])
+    add_hashes(registers, np.zeros(len(values), dtype=np.int64), value_hashes(values))
+    return values[:TOP_EXAMPLES], encode_hll(registers[0])
+
+
+def distinct_text(values, hll):
+    """Text of the distinct values of a report, "N distinct (approx)" followed by the examples when hll is set"""
+    if isinstance(hll, str) and hll:
+        return f"{distinct_count(hll)} distinct (approx): {values}"
+    return values
@@ -0,0 +1,86 @@
+import mmap
+import os
+
+
+class LineFramer:
+    """
+    Frame a byte stream in blocks of whole lines inside one reusable bytearray.
+    Data is written in place (reserve/commit, e.g. with readinto) or copied once (feed),
+    frame() returns the [start,end) range of the complete lines received so far.
+    Only the trailing incomplete line is moved when space is needed.
+    """
+    def __init__(self, capacity=4*1024*1024):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not framed yet
+        self.end = 0    # end of the received data
+
+    def reserve(self, size):
+        """Writable memoryview of size bytes after the received data"""
+        if self.end + size > len(self.buffer):
+            pending = bytes(self.view[self.start:self.end])  # incomplete line only
+            if len(pending) + size > len(self.buffer):
+                self.view.release()
+                self.buffer = bytearray(max(2*len(self.buffer), len(pending) + size))
+                self.view = memoryview(self.buffer)
+            self.view[:len(pending)] = pending
+            self.start = 0
+            self.end = len(pending)
+        return self.view[self.end:self.end + size]
+
+    def commit(self, size):
+        self.end += size
+
+    def feed(self, data):
+        if data:
+            self.reserve(len(data))[:] = data
+            self.commit(len(data))
+
+    def frame(self, last=False):
+        """[start,end) of the complete lines not framed yet (with the incomplete one when last)"""
+        start = self.start
+        if last:
+            end = self.end
+        else:
+            end = self.buffer.rfind(b'\n', start, self.end) + 1
+            if end <= start:
+                return start, start
+        self.start = end
+        return start, end
+
+    def close(self):
+        self.view.release()
+
+
+class MmapLineFramer:
+    """
+    Frame the byte range [start,end) of a plain file in blocks of whole lines of about block_size bytes.
+    The file is memory mapped, blocks are ranges of the map so nothing is copied.
+    """
+    def __init__(self, file_path, start=0, end=None, block_size=4*1024*1024):
+        self.file = open(file_path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+        if size > 0 and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.buffer.madvise(mmap.MADV_SEQUENTIAL)
+        self.start = start
+        self.end = size if end is None else min(end, size)
+        self.block_size = block_size
+
+    def __iter__(self):
+        pos = self.start
+        while pos < self.end:
+            stop = min(pos + self.block_size, self.end)
+            if stop < self.end:
+                # end the block on a line boundary, even for a line longer than block_size
+                newline = self.buffer.rfind(b'\n', pos, stop)
+                if newline < 0:
+                    newline = self.buffer.find(b'\n', stop, self.end)
+                stop = self.end if newline < 0 else newline + 1
+            yield pos, stop
+            pos = stop
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
@@ -1,14 +1,23 @@
 import asyncio
 import logging
 import os
+import shutil
+import signal
 import time
 from concurrent import futures
 from datetime import datetime
 
 
-from sl_async.gzip import BufferedGzipReader, BufferedGzipWriter
-from sl_json.json import JsonAndText
-from sl_async.slag import append_to_parquet
+from sl_async.gzip import BufferedGzipReader, BufferedGzipWriter, split_file_ranges, find_time_range
+from sl_async.gzindex import GzipIndex
+from sl_async.slapi import SLChannel, SourceOffset
+from sl_async.sltail import FollowLogSource
+from sl_json.json import decode_lines, new_decode_stats, merge_decode_stats, format_decode_stats, \
+    datetime_to_log_time, log_time_to_datetime
+from sl_json.columns import SlowQueryColumns
+from sl_json.registry import load_shape_registry
+from sl_async.slag import append_to_parquet, aggregate_chunk, commit_chunk, merge_results, \
+    save_global_aggregation, save_checkpoint, load_checkpoint, new_hour_shape_stats
 from sl_utils.utils import convertToHumanReadable,remove_extension,createDirs
 
 import msgspec
@@ -16,6 +25,16 @@ import msgspec
 encoder = msgspec.json.Encoder()
 decoder = msgspec.json.Decoder()
 
+# source offsets are sent about every CHECKPOINT_SPACING bytes, a checkpoint is saved at the first one after a chunk flush
+CHECKPOINT_SPACING = 4*1024*1024
+# signals ending a follow run, the extraction then ends as at the end of the stream and writes the report
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+def ignore_stop_signals():
+    """Initializer of the worker processes of a follow run: only the extraction process handles STOP_SIGNALS"""
+    for signum in STOP_SIGNALS:
+        signal.signal(signum, signal.SIG_IGN)
 
 
 # Function for extracting from File :
@@ -24,19 +43,223 @@ def extract_slow_queries_from_file(
         output_file_path,
         chunk_size=200000,
         save_by_chunk="none",
-        display_at=200000):
+        display_at=200000,
+        workers=0,
+        batch_size=256,
+        source_name=None,
+        follow=None,
+        start_time=None,
+        end_time=None,
+        checkpoint=True,
+        decode_workers=0,
+        by_query_hash=False,
+        shape_registry=None,
+        aggregate_workers=0,
+        top_shapes=0):
+    if shape_registry is not None:
+        # the known shapes are not sent with the results
+        load_shape_registry(shape_registry)
+    if follow and not log_file_path.endswith('.gz'):
+        return follow_slow_queries_from_file(log_file_path, output_file_path, chunk_size, save_by_chunk, display_at,
+                                             batch_size, source_name, checkpoint=checkpoint,
+                                             decode_workers=decode_workers, by_query_hash=by_query_hash,
+                                             aggregate_workers=aggregate_workers, top_shapes=top_shapes, **follow)
     output_file_path_without_ext=remove_extension(output_file_path)
     parquet_file_path_base=f"{output_file_path_without_ext}/"
+    gzip_index=None
+    start, end = 0, None
+    time_window = start_time is not None or end_time is not None
+    # checkpoint of an interrupted sequential extraction (the parallel ones are not checkpointed)
+    resume = load_checkpoint(parquet_file_path_base, log_file_path) if checkpoint and workers <= 1 else None
+    if not log_file_path.endswith('.gz'):
+        if time_window:
+            # out of window data is never read
+            start, end = find_time_range(log_file_path, start_time, end_time)
+            logging.info(f"Time window of {log_file_path} is the byte range [{start},{end})")
+        if workers > 1:
+            return extract_slow_queries_from_file_parallel(log_file_path, output_file_path, chunk_size,
+                                                           save_by_chunk, display_at, workers, batch_size=batch_size,
+                                                           source_name=source_name, start=start, end=end,
+                                                           start_time=start_time, end_time=end_time,
+                                                           by_query_hash=by_query_hash,
+                                                           aggregate_workers=aggregate_workers,
+                                                           top_shapes=top_shapes)
+    elif (workers > 1 or time_window or resume is not None) and GzipIndex.available():
+        gzip_index=GzipIndex(log_file_path)
+        if gzip_index.load():
+            start, end = gzip_index.find_range(start_time, end_time)
+            if workers > 1:
+                return extract_slow_queries_from_file_parallel(log_file_path, output_file_path, chunk_size,
+                                                               save_by_chunk, display_at, workers, gzip_index,
+                                                               batch_size, source_name, start, end,
+                                                               start_time, end_time, by_query_hash,
+                                                               aggregate_workers, top_shapes)
+        # no index yet, this sequential pass builds it for the next runs
+    if resume is not None:
+        start = max(start, resume["offset"])
+
+    file_name = os.path.basename(log_file_path)
+    file_name_without_extension = os.path.splitext(file_name)[0] if source_name is None else source_name
+    createDirs(parquet_file_path_base)
+    src= BufferedGzipReader(log_file_path, start=start, end=end, gzip_index=gzip_index, batch_size=batch_size,
+                            start_time=start_time, end_time=end_time,
+                            checkpoint_spacing=CHECKPOINT_SPACING if checkpoint else None)
+    dest= BufferedGzipWriter(output_file_path, batch_size=batch_size,
+                             resume_size=None if resume is None else resume.get("output_size", None))
+    orch=AsyncExtractAndAggregate(file_name_without_extension,0,src,dest,parquet_file_path_base,chunk_size,save_by_chunk,
+                                  checkpoint=resume,decode_workers=decode_workers,by_query_hash=by_query_hash,
+                                  aggregate_workers=aggregate_workers,top_shapes=top_shapes)
+    orch.run()
+    return orch.get_results()
 
+
+def follow_slow_queries_from_file(
+        log_file_path,
+        output_file_path,
+        chunk_size=200000,
+        save_by_chunk="none",
+        display_at=200000,
+        batch_size=256,
+        source_name=None,
+        poll_interval=1.0,
+        flush_interval=60,
+        idle_timeout=0,
+        checkpoint=True,
+        decode_workers=0,
+        by_query_hash=False,
+        aggregate_workers=0,
+        top_shapes=0):
+    output_file_path_without_ext=remove_extension(output_file_path)
+    parquet_file_path_base=f"{output_file_path_without_ext}/"
     file_name = os.path.basename(log_file_path)
-    file_name_without_extension = os.path.splitext(file_name)[0]
+    file_name_without_extension = os.path.splitext(file_name)[0] if source_name is None else source_name
     createDirs(parquet_file_path_base)
-    src= BufferedGzipReader(log_file_path)
-    dest= BufferedGzipWriter(output_file_path)
-    orch=AsyncExtractAndAggregate(file_name_without_extension,0,src,dest,parquet_file_path_base,chunk_size,save_by_chunk  )
+    # aggregations checkpointed by the previous run, up to the offset kept in follow.json
+    resume = load_checkpoint(parquet_file_path_base, log_file_path, follow=True) if checkpoint else None
+    # the offset is kept next to the aggregations so a restart continues the same file, without checkpoint
+    # each run follows the file from the beginning
+    src= FollowLogSource(log_file_path, f"{parquet_file_path_base}follow.json" if checkpoint else None,
+                         poll_interval, idle_timeout,
+                         batch_size=batch_size,
+                         checkpoint_spacing=CHECKPOINT_SPACING if checkpoint else None)
+    # each run writes a new slow query log, the previous ones are kept
+    dest= BufferedGzipWriter(f"{output_file_path_without_ext}_{datetime.now().strftime('%Y%m%d%H%M%S')}",
+                             batch_size=batch_size)
+    orch=AsyncExtractAndAggregate(file_name_without_extension,0,src,dest,parquet_file_path_base,chunk_size,
+                                  save_by_chunk,display_at,flush_interval=flush_interval,checkpoint=resume,
+                                  decode_workers=decode_workers,by_query_hash=by_query_hash,
+                                  aggregate_workers=aggregate_workers,top_shapes=top_shapes)
     orch.run()
     return orch.get_results()
 
+
+def extract_range(log_file_path, start, end, output_part_path, parquet_file_path_base, source_name,
+                  chunk_size, save_by_chunk, display_at, gzip_index=None, batch_size=256,
+                  start_time=None, end_time=None, by_query_hash=False, aggregate_workers=0, top_shapes=0):
+    createDirs(parquet_file_path_base)
+    src= BufferedGzipReader(log_file_path, start=start, end=end, gzip_index=gzip_index, batch_size=batch_size,
+                            start_time=start_time, end_time=end_time)
+    dest= BufferedGzipWriter(output_part_path, batch_size=batch_size)
+    orch=AsyncExtractAndAggregate(source_name,0,src,dest,parquet_file_path_base,chunk_size,save_by_chunk,display_at,
+                                  by_query_hash=by_query_hash,aggregate_workers=aggregate_workers,
+                                  top_shapes=top_shapes)
+    dest_path=dest.get_path()
+    orch.run()
+    return orch.get_results(), dest_path
+
+
+# Function for extracting from File using one process per byte range (plain text or indexed gzip) :
+def extract_slow_queries_from_file_parallel(
+        log_file_path,
+        output_file_path,
+        chunk_size=200000,
+        save_by_chunk="none",
+        display_at=200000,
+        workers=os.cpu_count(),
+        gzip_index=None,
+        batch_size=256,
+        source_name=None,
+        start=0,
+        end=None,
+        start_time=None,
+        end_time=None,
+        by_query_hash=False,
+        aggregate_workers=0,
+        top_shapes=0):
+    begin = time.time()
+    output_file_path_without_ext=remove_extension(output_file_path)
+    parquet_file_path_base=f"{output_file_path_without_ext}/"
+    file_name = os.path.basename(log_file_path)
+    file_name_without_extension = os.path.splitext(file_name)[0] if source_name is None else source_name
+    createDirs(parquet_file_path_base)
+    if gzip_index is None:
+        ranges = split_file_ranges(log_file_path, workers, start=start, end=end)
+    else:
+        ranges = gzip_index.split_ranges(workers, start, end)
+    logging.info(f"Extract {log_file_path} with {len(ranges)} ranges on {workers} workers")
+    with futures.ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as pool:
+        parts = [pool.submit(extract_range, log_file_path, range_start, range_end,
+                             f"{parquet_file_path_base}part{idx:03d}/slow_queries",
+                             f"{parquet_file_path_base}part{idx:03d}/",
+                             file_name_without_extension, chunk_size, save_by_chunk, display_at, gzip_index,
+                             batch_size, start_time, end_time, by_query_hash, aggregate_workers, top_shapes)
+                 for idx, (range_start, range_end) in enumerate(ranges)]
+        parts = [part.result() for part in parts]
+    # gzip members can be concatenated, keep the range order to keep the log order
+    dest_path = BufferedGzipWriter.modify_path(output_file_path)
+    with open(dest_path, 'wb') as out_file:
+        for _, part_path in parts:
+            with open(part_path, 'rb') as in_file:
+                shutil.copyfileobj(in_file, out_file)
+            os.remove(part_path)
+    result = merge_results([part_result for part_result, _ in parts])
+    save_global_aggregation(result, parquet_file_path_base, save_by_chunk)
+    millis_str=convertToHumanReadable("Millis",(time.time() - begin) * 1000)
+    logging.info(f"Extracted {result['countOfSlow']} slow queries from {len(ranges)} ranges to {dest_path} in {millis_str}")
+    logging.info(f"Decode of {log_file_path}: {format_decode_stats(result['decodeStats'])}")
+    return result
+
+# Function for extracting several Files, up to parallel_files at the same time :
+def extract_slow_queries_from_files(
+        log_files,
+        chunk_size=200000,
+        save_by_chunk="none",
+        display_at=200000,
+        workers=0,
+        batch_size=256,
+        parallel_files=1,
+        follow=None,
+        start_time=None,
+        end_time=None,
+        checkpoint=True,
+        decode_workers=0,
+        by_query_hash=False,
+        shape_registry=None,
+        aggregate_workers=0,
+        top_shapes=0):
+    """
+    log_files is a dict name -> (log file path, output file path), the name without extension is the source.
+    shape_registry is the path of the shape registry of the previous runs, None to compute every shape.
+    Return a dict name -> result in the same order.
+    """
+    if parallel_files <= 1 or len(log_files) <= 1:
+        return {name: extract_slow_queries_from_file(log_file_path, output_file_path, chunk_size, save_by_chunk,
+                                                     display_at, workers, batch_size, os.path.splitext(name)[0],
+                                                     follow, start_time, end_time, checkpoint, decode_workers,
+                                                     by_query_hash, shape_registry, aggregate_workers, top_shapes)
+                for name, (log_file_path, output_file_path) in log_files.items()}
+    begin = time.time()
+    with futures.ProcessPoolExecutor(max_workers=min(parallel_files, len(log_files))) as pool:
+        results = {name: pool.submit(extract_slow_queries_from_file, log_file_path, output_file_path, chunk_size,
+                                     save_by_chunk, display_at, workers, batch_size, os.path.splitext(name)[0],
+                                     follow, start_time, end_time, checkpoint, decode_workers, by_query_hash,
+                                     shape_registry, aggregate_workers, top_shapes)
+                   for name, (log_file_path, output_file_path) in log_files.items()}
+        results = {name: result.result() for name, result in results.items()}
+    millis_str=convertToHumanReadable("Millis",(time.time() - begin) * 1000)
+    logging.info(f"Extracted {len(log_files)} files with {parallel_files} in parallel in {millis_str}")
+    return results
+
 class AsyncExtractAndAggregate:
     def __init__(self,
                  sourceName,
@@ -47,29 +270,63 @@ class AsyncExtractAndAggregate:
                  chunk_size=200000,
                  save_by_chunk="none",
                  display_at=200000,
-                 line_buffer_size=500
+                 line_buffer_size=4096,
+                 flush_interval=0,
+                 checkpoint=None,
+                 decode_workers=0,
+                 by_query_hash=False,
+                 aggregate_workers=0,
+                 top_shapes=0
                  ):
         self.sourceName=sourceName
         self.source=source
         self.shard=shard
         self.dest=dest
-        self.queue_decoded = asyncio.Queue(3*line_buffer_size)
-        self.queue_source=self.source.get_queue()
+        self.batch_size=self.source.batch_size
+        self.channel_decoded = SLChannel(-(-3*line_buffer_size // self.batch_size), self.batch_size)
+        self.channel_source=self.source.get_channel()
         self.source_task=None
         self.consumer_task = None
         self.aggreg_task = None
         self.chunk_size=chunk_size
         self.save_by_chunk=save_by_chunk
         self.display_at=display_at
+        # when > 0 the pending entries are aggregated every flush_interval seconds (follow mode)
+        self.flush_interval=flush_interval
+        self.last_flush=time.time()
+        # a followed source is stopped by STOP_SIGNALS, the workers ignore them
+        self.follow=isinstance(source, FollowLogSource)
+        self.worker_initializer=ignore_stop_signals if self.follow else None
+        # when > 0 the lines are decoded by this many processes instead of the event loop
+        self.decode_workers=decode_workers
+        # group the rows by the query hash logged by the server when there is one, instead of the command shape
+        self.by_query_hash=by_query_hash
+        # when > 0 only the top shapes by duration and by count are aggregated, the others in one other shape
+        self.top_shapes=top_shapes
         self.parquet_file_path_base=parquet_file_path_base
         self.result=self.init_result(parquet_file_path_base)
+        # committer thread: the only one updating self.result once the extraction started
         self.pool = futures.ThreadPoolExecutor(max_workers=1)
+        # when > 0 the chunks are aggregated by this many processes and merged in order by the committer,
+        # otherwise the committer aggregates them too
+        self.aggregate_workers=aggregate_workers
+        self.aggregate_pool = futures.ProcessPoolExecutor(max_workers=aggregate_workers,
+                                                          initializer=self.worker_initializer) \
+            if aggregate_workers > 0 else None
+        # chunks and checkpoints waiting for the committer, in order
+        self.commits = asyncio.Queue(2 * max(1, aggregate_workers))
+        self.committer = None
         self.lastPrint=0
         self.lastHours=None
+        self.pending=SlowQueryColumns()
+        if checkpoint is not None:
+            self.restore_checkpoint(checkpoint)
+        self.checkpoint_id=self.result["resume"].get("id",0)
 
     def init_result(self,file_path_base):
         result= {"countOfSlow": 0, "systemSkipped": 0, "groupByCommandShape": {}, "groupByCommandShapeChangeStream": {},
-                 "resume": {}}
+                 "hourShapeStats": new_hour_shape_stats(self.top_shapes), "shapes": {}, "resume": {},
+                 "decodeStats": new_decode_stats()}
         if os.path.isfile(f"{file_path_base}resume.json"):
             with open(f"{file_path_base}resume.json") as out_file:
                 read=out_file.read()
@@ -80,9 +337,87 @@ class AsyncExtractAndAggregate:
                 result["resume"]["dtime"]=datetime.fromisoformat(dtime)
         return result
 
+    def restore_checkpoint(self, checkpoint):
+        # continue an interrupted extraction: aggregations and entries not flushed at the checkpoint
+        for type, value in checkpoint.pop("aggregates").items():
+            self.result[type] = value
+        for accumulator in self.result["hourShapeStats"].values():
+            accumulator.top_shapes = self.top_shapes
+        self.pending = checkpoint.pop("pending")
+        self.result["countOfSlow"] = checkpoint["countOfSlow"]
+        self.result["systemSkipped"] = checkpoint["systemSkipped"]
+        self.result["decodeStats"].update(checkpoint.get("decodeStats", {}))
+        self.lastHours = checkpoint.get("dhour", None)
+        self.result["resume"] = checkpoint
+        if checkpoint.get("dtime", None) is not None:
+            checkpoint["dtime"] = datetime.fromisoformat(checkpoint["dtime"])
+
+    def checkpoint_state(self, source_offset, it, dtime):
+        """resume.json content of a checkpoint at a source offset"""
+        source_path = self.source.get_path()
+        return {"id": it, "offset": source_offset.offset, "decodeStats": source_offset.decode_stats,
+                "dtime": None if dtime is None else dtime.isoformat(),
+                "dhour": self.lastHours, "systemSkipped": self.result["systemSkipped"],
+                "source": source_path, "complete": False,
+                "source_size": os.path.getsize(source_path) if os.path.isfile(source_path) else 0}
+
+    async def checkpoint(self, source_offset, it, dtime, data):
+        """Checkpoint at a source offset, saved by the pool once the chunks before it are aggregated"""
+        checkpoint = self.checkpoint_state(source_offset, it, dtime)
+        dest_checkpoint = await self.dest.checkpoint()
+        await self.submit_commit(None, self.save_source_checkpoint, source_offset, checkpoint, data.copy(), dest_checkpoint)
+
+    def save_source_checkpoint(self, source_offset, checkpoint, pending, dest_checkpoint):
+        """Save a checkpoint in the pool, then let the source keep its offset"""
+        if save_checkpoint(self.result, self.parquet_file_path_base, checkpoint, pending, dest_checkpoint):
+            self.source.commit_offset(source_offset)
+
+    async def submit_chunk(self, data, dtime, it, dump_aggregation, save_all=False):
+        """Aggregate a chunk, by the aggregation processes when there are some, and commit it after the previous ones"""
+        if self.aggregate_pool is None:
+            await self.submit_commit(None, append_to_parquet, data, self.parquet_file_path_base, dtime, it,
+                                     self.save_by_chunk, dump_aggregation, self.result, save_all)
+            return
+        partial = asyncio.wrap_future(self.aggregate_pool.submit(aggregate_chunk, data, self.parquet_file_path_base,
+                                                                 dtime, it, self.save_by_chunk))
+        await self.submit_commit(partial, commit_chunk, self.parquet_file_path_base, self.save_by_chunk,
+                                 dump_aggregation, self.result, save_all)
+
+    async def submit_commit(self, partial, fn, *args):
+        """
+        Queue fn(*args) for the committer, fn(partial result, *args) when partial (future of a ChunkPartial) is given.
+        Waits while the committer is 2 * aggregate_workers items behind, raises its error if it failed.
+        """
+        put = asyncio.ensure_future(self.commits.put((partial, fn, args)))
+        await asyncio.wait((put, self.committer), return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            # the committer ended before the end of the stream
+            self.committer.result()
+            raise RuntimeError("aggregation committer ended")
+
+    async def commit(self):
+        """
+        Single committer: runs the queued commits one at a time in the pool thread, in the submission order,
+        so the chunks are merged in self.result in the log order and a checkpoint covers the chunks before it.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            partial, fn, args = await self.commits.get()
+            if fn is None:
+                # end of the stream
+                return
+            if partial is not None:
+                args = (await partial,) + args
+            await loop.run_in_executor(self.pool, fn, *args)
+
     def write_result(self):
+        self.result["resume"]["complete"]=True
+        self.result["resume"]["countOfSlow"]=self.result["countOfSlow"]
         with open(f"{self.parquet_file_path_base}resume.json","w") as in_file:
             in_file.write(encoder.encode(self.result["resume"]).decode())
+        if os.path.isfile(f"{self.parquet_file_path_base}checkpoint.pkl"):
+            os.remove(f"{self.parquet_file_path_base}checkpoint.pkl")
 
 
     def get_dtime(self):
@@ -92,81 +427,153 @@ class AsyncExtractAndAggregate:
         asyncio.run(self.internal())
 
     async def decode(self):
-        while True:
-            item = await self.queue_source.get()
-            if item is None:
-                await self.queue_decoded.put(None)
-                self.queue_source.task_done()
-                break
-            # logging.info(f"added {item}")
-            await self.queue_decoded.put(JsonAndText(item,self.sourceName,self.shard))
-            self.queue_source.task_done()
-        logging.info(f"Decode ended for {self.source.get_name()}")
+        if self.decode_workers > 0:
+            await self.decode_in_processes()
+            return
+        stats = self.result["decodeStats"]
+        async for batch in self.channel_source:
+            if batch.__class__ is SourceOffset:
+                batch.decode_stats = dict(stats)
+                await self.channel_decoded.put_batch(batch)
+                continue
+            decoded, _ = decode_lines(batch, self.sourceName, self.shard, stats, self.by_query_hash,
+                                      self.top_shapes > 0)
+            await self.channel_decoded.put_batch(decoded)
+        await self.channel_decoded.close()
+        logging.info(f"Decode ended for {self.source.get_name()}: {format_decode_stats(stats)}")
+
+    async def decode_in_processes(self):
+        """
+        Decode the batches of lines in decode_workers processes.
+        The batches are given back in the source order, so the chunks and checkpoints are the same as inline.
+        """
+        stats = self.result["decodeStats"]
+        loop = asyncio.get_running_loop()
+        # batches being decoded (futures) and source offsets, in the source order
+        in_flight = asyncio.Queue(2 * self.decode_workers)
+        with futures.ProcessPoolExecutor(max_workers=self.decode_workers, initializer=self.worker_initializer) as pool:
+            async def submit():
+                async for batch in self.channel_source:
+                    if batch.__class__ is not SourceOffset:
+                        batch = loop.run_in_executor(pool, decode_lines, batch, self.sourceName, self.shard,
+                                                     None, self.by_query_hash, self.top_shapes > 0)
+                    await in_flight.put(batch)
+                await in_flight.put(None)
+            submit_task = asyncio.create_task(submit())
+            while (item := await in_flight.get()) is not None:
+                if item.__class__ is SourceOffset:
+                    item.decode_stats = dict(stats)
+                    await self.channel_decoded.put_batch(item)
+                    continue
+                decoded, batch_stats = await item
+                merge_decode_stats(stats, batch_stats)
+                await self.channel_decoded.put_batch(decoded)
+            await submit_task
+        await self.channel_decoded.close()
+        logging.info(f"Decode ended for {self.source.get_name()} with {self.decode_workers} processes: "
+                     f"{format_decode_stats(stats)}")
+
+    async def next_decoded_batch(self):
+        """Next decoded batch, [] once flush_interval has passed since the last flush, None at the end"""
+        if not self.flush_interval:
+            return await self.channel_decoded.get_batch()
+        timeout = self.last_flush + self.flush_interval - time.time()
+        if timeout <= 0:
+            return []
+        try:
+            return await asyncio.wait_for(self.channel_decoded.get_batch(), timeout)
+        except asyncio.TimeoutError:
+            return []
 
     async def bufferAggregate(self):
         start_time = time.time()
-        data = []
-        dtime = self.result.get("resume",{}).get(None)
+        data = self.pending
+        # time of the last decoded line, as epoch milliseconds and LogHour
+        epoch, log_hour = None, None
+        if self.result.get("resume",{}).get("dtime",None) is not None:
+            epoch, log_hour = datetime_to_log_time(self.result["resume"]["dtime"])
         it= self.result.get("resume",{}).get("id",0)
-        future=None
-        while True:
-            try:
-                if self.queue_decoded.qsize()>50 :
-                    dline = self.queue_decoded.get_nowait()
-                else:
-                    dline = await self.queue_decoded.get()
-                if dline is None:
-                    self.queue_decoded.task_done()
-                    break
-                dtime,dhour,log_entry,orig_line = dline.decode()
-                dline.clear()
-                if log_entry is not None:
-                    if self.lastHours is None :
-                        self.lastHours = dhour
-                    if self.lastHours != dhour or len(data) >= self.chunk_size:
-                        dump_aggregation=(self.lastHours != dhour)
-                        self.lastHours = dhour
-                        it+=1
-                        future=self.pool.submit(append_to_parquet,data, self.parquet_file_path_base,dtime, it,self.save_by_chunk,dump_aggregation,self.result)
-                        data = []  # Clear list to free memory
-                        if self.result["countOfSlow"]-self.lastPrint>0 and self.result["countOfSlow"]-self.lastPrint>self.display_at:
-                            self.lastPrint=self.result["countOfSlow"]
-                            end_time = time.time()
-                            elapsed_time_ms = (end_time - start_time) * 1000
-
-                            countOfSlow = self.result["countOfSlow"]
-                            millis_str=convertToHumanReadable("Millis",elapsed_time_ms)
-                            src_qsize_str=self.source.get_queue().qsize()
-                            dec_qsize_str=self.queue_decoded.qsize()
-                            dest_qsize_str=self.dest.queue_size()
-                            speed=int(round(self.result["countOfSlow"]/(elapsed_time_ms/1000)))
-                            logging.info(f"loaded {countOfSlow} slow queries in {millis_str} it={it}"+
-                                         f" Q={src_qsize_str}|{dec_qsize_str}|{dest_qsize_str} {speed}SQPS")
-                    data.append(log_entry)
-                    if log_entry:
-                        await self.dest.write(orig_line)
-                    else:
-                        self.result["systemSkipped"]+=1
-                self.queue_decoded.task_done()
-            except msgspec.MsgspecError:
-                # Skip lines that are not valid JSON
-                self.queue_decoded.task_done()
+        # last SourceOffset received, every line before it is aggregated at the end
+        source_offset = None
+        self.committer = asyncio.create_task(self.commit())
+        while (batch := await self.next_decoded_batch()) is not None:
+            if batch.__class__ is SourceOffset:
+                source_offset = batch
+                if it > self.checkpoint_id:
+                    # first offset after a chunk flush
+                    self.checkpoint_id = it
+                    await self.checkpoint(batch, it, log_time_to_datetime(epoch, log_hour), data)
                 continue
+            if batch.__class__ is list:
+                if data:
+                    # flush_interval since the last flush: aggregate what we have so the hourly stats stay current
+                    it+=1
+                    await self.submit_chunk(data, log_time_to_datetime(epoch, log_hour), it, True)
+                    data = SlowQueryColumns()
+                self.last_flush = time.time()
+                continue
+            if batch.shapes:
+                # merged in the side table by the pool with the chunk, before the rows of the next chunks
+                data.shapes.update(batch.shapes)
+            for batch_hour in set(batch.log_hours):
+                data.hours[batch_hour.epoch] = batch_hour.dhour
+            lines = []
+            for epoch, log_hour, log_entry, orig_line in zip(batch.epochs, batch.log_hours, batch.rows, batch.lines):
+                # the rows are aggregated in their own hour, the chunks are only cut by size
+                if len(data) >= self.chunk_size:
+                    dhour = log_hour.dhour
+                    # the hour aggregations are saved when the chunks reach a new hour
+                    dump_aggregation=(self.lastHours != dhour)
+                    self.lastHours = dhour
+                    it+=1
+                    await self.submit_chunk(data, log_time_to_datetime(epoch, log_hour), it, dump_aggregation)
+                    data = SlowQueryColumns()  # new buffers, the committer owns the previous ones
+                    self.last_flush = time.time()
+                    if self.result["countOfSlow"]-self.lastPrint>0 and self.result["countOfSlow"]-self.lastPrint>self.display_at:
+                        self.lastPrint=self.result["countOfSlow"]
+                        end_time = time.time()
+                        elapsed_time_ms = (end_time - start_time) * 1000
+
+                        countOfSlow = self.result["countOfSlow"]
+                        millis_str=convertToHumanReadable("Millis",elapsed_time_ms)
+                        src_qsize_str=self.channel_source.qsize()
+                        dec_qsize_str=self.channel_decoded.qsize()
+                        dest_qsize_str=self.dest.queue_size()
+                        speed=int(round(self.result["countOfSlow"]/(elapsed_time_ms/1000)))
+                        logging.info(f"loaded {countOfSlow} slow queries in {millis_str} it={it}"+
+                                     f" Q={src_qsize_str}|{dec_qsize_str}|{dest_qsize_str} {speed}SQPS")
+                data.append(log_entry)
+                if log_entry:
+                    lines.append(orig_line)
+                else:
+                    self.result["systemSkipped"]+=1
+            if batch.last_log_hour is not None:
+                epoch, log_hour = batch.last_epoch, batch.last_log_hour
+            await self.dest.write_all(lines)
         await self.dest.notify_write_end()
         # Handle any remaining data
         logging.info("Finishing global aggregation")
         if data:
             it+=1
-            future=self.pool.submit(append_to_parquet,data, self.parquet_file_path_base,dtime,it,self.save_by_chunk,True,self.result,True)
+            await self.submit_chunk(data, log_time_to_datetime(epoch, log_hour), it, True, True)
+        if self.follow and self.source.state_path is not None and source_offset is not None:
+            # the aggregations up to the offset kept in follow.json, the next run continues both
+            await self.submit_commit(None, self.save_source_checkpoint, source_offset,
+                                     self.checkpoint_state(source_offset, it, log_time_to_datetime(epoch, log_hour)),
+                                     SlowQueryColumns(), None)
         start_waiting=time.time()
-        if future:
-            future.result()
+        await self.submit_commit(None, None)
+        # the committer may wait for the writer (checkpoint), do not block the loop
+        await self.committer
         end_time = time.time()
         elapsed_time_ms = (end_time - start_waiting) * 1000
         millis_str=convertToHumanReadable("Millis",elapsed_time_ms)
         logging.info(f"waiting for last pool took {millis_str}")
         self.pool.shutdown(wait=True)
-        self.write_result()
+        if self.aggregate_pool is not None:
+            self.aggregate_pool.shutdown(wait=True)
+        if not self.follow:
+            self.write_result()
         end_time = time.time()
         elapsed_time_ms = (end_time - start_time) * 1000
         countOfSlow=self.result["countOfSlow"]
@@ -176,6 +583,8 @@ class AsyncExtractAndAggregate:
 
 
     async def internal(self):
+        if self.follow:
+            self.add_stop_handlers()
         self.consumer_task = asyncio.create_task(self.decode())
         self.aggreg_task = asyncio.create_task(self.bufferAggregate())
         self.source.create_task()
@@ -188,5 +597,18 @@ class AsyncExtractAndAggregate:
         #await self.queue.join()
         #await self.queue.put(None)  # Signal the consumer to stop
 
+    def add_stop_handlers(self):
+        loop = asyncio.get_running_loop()
+        for signum in STOP_SIGNALS:
+            try:
+                loop.add_signal_handler(signum, self.stop, signum)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # no signal handler out of the main thread or on Windows, stopped by the idle timeout only
+                return
+
+    def stop(self, signum):
+        logging.info(f"{signal.Signals(signum).name} received, stop following {self.source.get_path()}")
+        self.source.stop()
+
     def get_results(self):
         return self.result
\ No newline at end of file
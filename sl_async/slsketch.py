@@ -0,0 +1,144 @@
+import base64
+import math
+
+import numpy as np
+
+# DDSketch style quantile sketches of the latencies: the values are counted in bins of relative width
+# 2 * RELATIVE_ACCURACY, a quantile is the (relative) middle of its bin, within RELATIVE_ACCURACY of the exact one.
+# The sketches of a slot (hour and shape, shape, namespace...) are merged by adding the counts of the same bins,
+# in any order. Bins are handled as arrays (id, code, count) sorted by id and code, id being the slot.
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+# code of the bin of the values <= 0, the others are KEY_OFFSET + ceil(log_gamma(value))
+ZERO_CODE = 0
+KEY_OFFSET = 1 << 15
+CODE_BITS = 16
+CODE_MASK = (1 << CODE_BITS) - 1
+# prefix of the encoded sketches with uint64 counts
+WIDE = '*'
+
+# columns with a sketch and the quantiles shown for them
+SKETCH_COLUMNS = ['durationMillis', 'cpuNanos', 'workingMillis', 'planningTimeMicros']
+QUANTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+
+
+def sketch_columns(column):
+    """Columns of the aggregations added for the sketch of a column: its quantiles and the encoded sketch"""
+    return [f"{column}_{name}" for name in QUANTILES] + [f"{column}_sketch"]
+
+
+def sketch_bins(ids, values):
+    """Bins of the values by id, the missing values are skipped"""
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    ids, values = ids[valid], values[valid]
+    codes = np.full(len(values), ZERO_CODE, dtype=np.int64)
+    positive = values > 0
+    codes[positive] = np.clip(np.ceil(np.log(values[positive]) / LOG_GAMMA) + KEY_OFFSET, 1, CODE_MASK)
+    return reduce_bins(ids, codes, np.ones(len(values), dtype=np.int64))
+
+
+def reduce_bins(ids, codes, counts):
+    """Bins with the same id and code added, sorted by id and code"""
+    if len(ids) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    keys, inverse = np.unique((np.asarray(ids, dtype=np.int64) << CODE_BITS) | codes, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
+    return keys >> CODE_BITS, keys & CODE_MASK, counts
+
+
+def bin_values(codes):
+    """Value of each bin code"""
+    values = 2 * np.power(GAMMA, codes.astype(np.float64) - KEY_OFFSET) / (GAMMA + 1)
+    return np.where(codes == ZERO_CODE, 0.0, values)
+
+
+def quantiles(ids, codes, counts, size, quantile):
+    """quantile of the ids 0 to size - 1, NaN for the ids without value"""
+    totals = np.bincount(ids, weights=counts, minlength=size)
+    if len(ids) == 0:
+        return np.full(size, np.nan)
+    cumulative = np.cumsum(counts)
+    # count before the first bin of each id, the bins being sorted by id
+    starts = np.concatenate(([0], np.cumsum(totals)[:-1]))
+    # first bin with more than quantile * (count - 1) values of the id before it (and in it)
+    found = np.searchsorted(cumulative, starts + quantile * (totals - 1), side='right')
+    values = bin_values(codes[np.minimum(found, len(codes) - 1)])
+    return np.where(totals > 0, values, np.nan)
+
+
+def encode_sketches(ids, codes, counts, size):
+    """Compact text of the sketch of the ids 0 to size - 1, '' for the ids without value"""
+    bounds = np.searchsorted(ids, np.arange(size + 1))
+    if len(counts) and int(counts.max()) > 0xFFFFFFFF:
+        return [encode_sketch(codes[start:end], counts[start:end]) if end > start else ''
+                for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+    # all narrow: the bytes of all the codes and counts are converted at once, then cut by id
+    code_bytes = codes.astype('<u2').tobytes()
+    count_bytes = counts.astype('<u4').tobytes()
+    b64encode = base64.b64encode
+    return [b64encode(code_bytes[2 * start:2 * end] + count_bytes[4 * start:4 * end]).decode('ascii')
+            if end > start else '' for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+
+def encode_sketch(codes, counts):
+    # codes as uint16 then counts as uint32, or as uint64 when too large (text starting with WIDE, not base64)
+    wide = int(counts.max()) > 0xFFFFFFFF
+    data = codes.astype('<u2').tobytes() + counts.astype('<u8' if wide else '<u4').tobytes()
+    return (WIDE if wide else '') + base64.b64encode(data).decode('ascii')
+
+
+def decode_sketch(sketch):
+    """(codes, counts) of a sketch made by encode_sketches"""
+    wide = sketch.startswith(WIDE)
+    data = base64.b64decode(sketch[1:] if wide else sketch)
+    size = len(data) // (10 if wide else 6)
+    codes = np.frombuffer(data, dtype='<u2', count=size).astype(np.int64)
+    counts = np.frombuffer(data, dtype='<u8' if wide else '<u4', offset=2 * size).astype(np.int64)
+    return codes, counts
+
+
+def decode_sketches(sketches, ids):
+    """Bins of encoded sketches, the bins of sketches[i] with the id ids[i]"""
+    narrow_ids, narrow, wide_ids, wide = [], [], [], []
+    for sketch_id, sketch in zip(np.asarray(ids).tolist(), sketches):
+        if not isinstance(sketch, str) or not sketch:
+            continue
+        if sketch.startswith(WIDE):
+            wide_ids.append(sketch_id)
+            wide.append(sketch)
+        else:
+            narrow_ids.append(sketch_id)
+            narrow.append(base64.b64decode(sketch))
+    all_ids, all_codes, all_counts = [], [], []
+    if narrow:
+        # the 6 bytes bins of all the narrow sketches, codes then counts in each sketch
+        sizes = np.array([len(data) // 6 for data in narrow], dtype=np.int64)
+        data = np.frombuffer(b''.join(narrow), dtype=np.uint8)
+        starts = np.repeat(np.cumsum(6 * sizes) - 6 * sizes, sizes)
+        offsets = np.arange(len(starts)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        code_bytes = starts + 2 * offsets
+        count_bytes = starts + 2 * np.repeat(sizes, sizes) + 4 * offsets
+        all_ids.append(np.repeat(np.array(narrow_ids, dtype=np.int64), sizes))
+        all_codes.append(data[code_bytes].astype(np.int64) | data[code_bytes + 1].astype(np.int64) << 8)
+        all_counts.append(sum(data[count_bytes + byte].astype(np.int64) << (8 * byte) for byte in range(4)))
+    for sketch_id, sketch in zip(wide_ids, wide):
+        codes, counts = decode_sketch(sketch)
+        all_ids.append(np.full(len(codes), sketch_id, dtype=np.int64))
+        all_codes.append(codes)
+        all_counts.append(counts)
+    if not all_ids:
+        return reduce_bins([], [], [])
+    return reduce_bins(np.concatenate(all_ids), np.concatenate(all_codes), np.concatenate(all_counts))
+
+
+def merge_sketches(sketches, ids, size):
+    """
+    Sketch columns of encoded sketches merged by id (0 to size - 1): quantile columns by name
+    of QUANTILES and 'sketch'
+    """
+    ids, codes, counts = decode_sketches(sketches, ids)
+    columns = {name: quantiles(ids, codes, counts, size, quantile) for name, quantile in QUANTILES.items()}
+    columns['sketch'] = encode_sketches(ids, codes, counts, size)
+    return columns
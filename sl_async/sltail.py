@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import time
+
+import msgspec
+
+from sl_async.slapi import SlSource, SourceFilter, DefaultSourceFilter
+from sl_async.slframe import LineFramer
+
+tail_log = logging.getLogger("FollowLogSource")
+
+encoder = msgspec.json.Encoder()
+decoder = msgspec.json.Decoder()
+
+
+class FollowLogSource(SlSource):
+    """
+    Follow a growing plain text mongod log like `tail -F`:
+    read what is appended, survive log rotation (rename or copytruncate) and send SourceOffset markers
+    (with the inode of the file) at the end of the file and about every checkpoint_spacing bytes.
+    The byte offset of a marker is kept in state_path by commit_offset, once the lines before it are
+    checkpointed, so that a restart continues where the previous checkpoint stopped.
+    Stops after idle_timeout seconds without new data (0 follows forever) or on stop().
+    """
+    def __init__(self,
+                 file_path,
+                 state_path=None,
+                 poll_interval=1.0,
+                 idle_timeout=0,
+                 line_buffer_size=4096,
+                 line_filter: SourceFilter =None,
+                 batch_size=256,
+                 checkpoint_spacing=4*1024*1024):
+        super().__init__(path=file_path,max_queue_size=line_buffer_size,batch_size=batch_size)
+        self.line_filter=DefaultSourceFilter(self.channel) if line_filter is None else line_filter
+        self.state_path=state_path
+        self.poll_interval=poll_interval
+        self.idle_timeout=idle_timeout
+        self.offset=0  # offset of the first line not read yet in the current file
+        self.inode=None
+        self.running=True
+        self.checkpoint_spacing=checkpoint_spacing
+        self.next_mark=checkpoint_spacing or 0
+        self.marked=None  # (inode, offset) of the last SourceOffset sent
+
+    def load_state(self):
+        if self.state_path is None or not os.path.isfile(self.state_path):
+            return
+        with open(self.state_path, 'rb') as in_file:
+            state = decoder.decode(in_file.read())
+        self.inode = state.get("inode", None)
+        self.offset = state.get("offset", 0)
+
+    def commit_offset(self, source_offset):
+        """Keep the offset of a SourceOffset once every line before it is aggregated or checkpointed"""
+        if self.state_path is None or source_offset is None:
+            return
+        with open(f"{self.state_path}.tmp", 'wb') as out_file:
+            out_file.write(encoder.encode({"path": self.path, "inode": source_offset.inode,
+                                           "offset": source_offset.offset}))
+        os.replace(f"{self.state_path}.tmp", self.state_path)
+
+    async def mark_offset(self, force=False):
+        """Send a SourceOffset at the current offset, at most every checkpoint_spacing bytes unless force"""
+        if self.marked == (self.inode, self.offset):
+            return
+        if not force and (self.checkpoint_spacing is None or self.offset < self.next_mark):
+            return
+        self.next_mark = self.offset + (self.checkpoint_spacing or 0)
+        self.marked = (self.inode, self.offset)
+        await self.line_filter.mark_offset(self.offset, self.inode)
+
+    def stop(self):
+        self.running=False
+
+    def open_current(self):
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        stat = os.fstat(file.fileno())
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            # new file (first run or rotated while we were not running)
+            tail_log.info(f"start following {self.path} from the beginning")
+            self.inode = stat.st_ino
+            self.offset = 0
+            self.next_mark = self.checkpoint_spacing or 0
+        else:
+            tail_log.info(f"continue following {self.path} at offset {self.offset}")
+        file.seek(self.offset)
+        return file
+
+    def rotated(self, file):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False  # being rotated, the new file is not there yet
+        return stat.st_ino != os.fstat(file.fileno()).st_ino
+
+    def truncated(self, file):
+        return os.fstat(file.fileno()).st_size < self.offset
+
+    async def task_fn(self):
+        self.load_state()
+        framer = LineFramer()
+        file = None
+        last_data = time.time()
+        while self.running:
+            if file is None:
+                file = self.open_current()
+                if file is None:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+            read = await asyncio.to_thread(file.readinto, framer.reserve(1024*1024))
+            if read:
+                framer.commit(read)
+                start, end = framer.frame()
+                if end > start:
+                    await self.line_filter.process_block(framer.buffer, start, end)
+                    self.offset += end - start  # complete lines only
+                    await self.mark_offset()
+                last_data = time.time()
+                continue
+            # end of the file for now: send what we have and wait for more
+            await self.line_filter.flush()
+            if self.checkpoint_spacing is not None:
+                await self.mark_offset(True)
+            await self.channel.flush()
+            if self.rotated(file):
+                # everything written to the old file has been read
+                start, end = framer.frame(True)
+                if end > start:
+                    await self.line_filter.process_block(framer.buffer, start, end)
+                tail_log.info(f"{self.path} has been rotated")
+                file.close()
+                file = None
+                self.inode = None
+                continue
+            if self.truncated(file):
+                tail_log.info(f"{self.path} has been truncated")
+                file.seek(0)
+                self.offset = 0
+                framer.frame(True)  # drop the partial line
+                continue
+            if self.idle_timeout and time.time() - last_data > self.idle_timeout:
+                break
+            await asyncio.sleep(self.poll_interval)
+        if file is not None:
+            file.close()
+        framer.close()
+        await self.line_filter.flush()
+        await self.mark_offset(True)
+        tail_log.info(f"stop following {self.path} at offset {self.offset}")
+        await self.channel.close()
@@ -7,6 +7,13 @@ def write_parquet(df_chunk, path):
 
     for col in df_chunk.select_dtypes(include=['object']).columns:
         df_chunk[col] = df_chunk[col].astype(str)
+    # dictionary encoded columns stay dictionary encoded, with string values
+    for col in df_chunk.select_dtypes(include=['category']).columns:
+        categories = df_chunk[col].cat.categories.astype(str)
+        if categories.is_unique:
+            df_chunk[col] = df_chunk[col].cat.rename_categories(categories)
+        else:
+            df_chunk[col] = df_chunk[col].astype(str)
     table = pa.Table.from_pandas(df_chunk)
     pq_writer = pq.ParquetWriter(path, table.schema, compression='SNAPPY')
     pq_writer.write_table(table)
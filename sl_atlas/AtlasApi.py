@@ -123,10 +123,11 @@ class AtlasApi():
         parquet_file_path_base=f"{output_file_path_without_ext}/"
         createDirs(parquet_file_path_base)
 
-        src= BufferedSlAtlasSource(self,groupId,processId)
+        src= BufferedSlAtlasSource(self,groupId,processId,batch_size=self.config.EXTRACT_BATCH_SIZE,
+                                   start_time=self.config.EXTRACT_START_TIME,end_time=self.config.EXTRACT_END_TIME)
         sl_output_file_path = f"{output_file_path}/slow_queries_{groupId}_{processId}.log"
 
-        dest= BufferedGzipWriter(sl_output_file_path)
+        dest= BufferedGzipWriter(sl_output_file_path,batch_size=self.config.EXTRACT_BATCH_SIZE)
         orch=AsyncExtractAndAggregate(processId,shard,src,dest,parquet_file_path_base,chunk_size,save_by_chunk  )
         src.set_dtime(orch.get_dtime())
         orch.run()
@@ -4,6 +4,7 @@ import matplotlib
 import msgspec
 import logging
 import os
+from datetime import datetime, timezone
 
 from sl_utils.utils import createDirs
 
@@ -102,6 +103,24 @@ class Config:
         self.SAVE_BY_CHUNK = self.get_config('SAVE_BY_CHUNK', 'json')
         self.MAX_CHUNK_SIZE = self._validate_type(self.get_config('MAX_CHUNK_SIZE', 50000), int, 50000)
 
+        # ---------------- Extraction options ----------------
+        self.PARALLEL_WORKERS = self._validate_type(self.get_config('extract.parallel_workers', 0), int, 0)
+        self.EXTRACT_BATCH_SIZE = self._validate_type(self.get_config('extract.batch_size', 256), int, 256)
+        self.DECODE_WORKERS = self._validate_type(self.get_config('extract.decode_workers', 0), int, 0)
+        self.AGGREGATE_WORKERS = self._validate_type(self.get_config('extract.aggregate_workers', 0), int, 0)
+        self.TOP_SHAPES = self._validate_type(self.get_config('extract.top_shapes', 0), int, 0)
+        self.GROUP_BY_QUERY_HASH = self._validate_type(self.get_config('extract.group_by_query_hash', False), bool, False)
+        self.SHAPE_REGISTRY = self._validate_type(self.get_config('extract.shape_registry', True), bool, True)
+        self.PARALLEL_FILES = self._validate_type(self.get_config('extract.parallel_files', 1), int, 1)
+        self.MERGE_FILES = self._validate_type(self.get_config('extract.merge_files', False), bool, False)
+        self.EXTRACT_CHECKPOINT = self._validate_type(self.get_config('extract.checkpoint', True), bool, True)
+        self.EXTRACT_START_TIME = self._validate_time(self.get_config('extract.start_time', None))
+        self.EXTRACT_END_TIME = self._validate_time(self.get_config('extract.end_time', None))
+        self.FOLLOW_LOGS = self._validate_type(self.get_config('extract.follow.enabled', False), bool, False)
+        self.FOLLOW_POLL_INTERVAL = self._validate_type(self.get_config('extract.follow.poll_interval', 1), int, 1)
+        self.FOLLOW_FLUSH_INTERVAL = self._validate_type(self.get_config('extract.follow.flush_interval', 60), int, 60)
+        self.FOLLOW_IDLE_TIMEOUT = self._validate_type(self.get_config('extract.follow.idle_timeout', 0), int, 0)
+
         # ---------------- Report generation flags ----------------
         self.LOGS_FILENAME = self._validate_type(self.get_config('LOGS_FILENAME', ['mongodb.log']), list, ['mongodb.log'])
         self.GENERATE_ONE_PDF_PER_CLUSTER_FILE = self._validate_type(self.get_config('GENERATE_ONE_PDF_PER_CLUSTER_FILE', True), bool, True)
@@ -200,6 +219,20 @@ class Config:
         logging.warning(f"Type mismatch: expected {expected_type.__name__}, got {type(value).__name__}. Using default={default}")
         return default
 
+        # ---------------- Time validation ----------------
+    def _validate_time(self, value):
+        """Parse an ISO 8601 time from the config (UTC when no offset is given), None if missing or invalid."""
+        if value is None:
+            return None
+        try:
+            dtime = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            logging.warning(f"Invalid time: {value}, expected ISO 8601 like 2024-05-01T10:00:00+00:00. Ignored")
+            return None
+        if dtime.tzinfo is None:
+            dtime = dtime.replace(tzinfo=timezone.utc)
+        return dtime
+
         # ---------------- General access helpers ----------------
     def get(self, type, config, default, name, default_val):
         def get_nested(dic, path):
@@ -0,0 +1,149 @@
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from sl_json.json import DF_COL
+
+# Column buffers of the slow query rows (DF_COL), the DataFrame of a chunk is built from them without
+# going through a list of rows and without dtype inference.
+# typecode of the array buffer, None for the columns kept as Python objects (values of any type),
+# 'i' for the dictionary encoded strings (code in the StringTable of the column, category dtype in the DataFrame)
+FLOAT_COLS = {'query_targeting'}
+BOOL_COLS = {'changestream'}
+OBJECT_COLS = {'usedDisk', 'fromMultiPlanner', 'replanned', 'replanReason'}
+DICTIONARY_COLS = {'source', 'shard', 'db', 'namespace', 'plan_summary', 'appName', 'readPreference', 'cmdType', 'planCacheShapeHash', 'queryHash', 'planCacheKey', 'queryFramework'}
+
+
+class StringTable(dict):
+    """Code of each distinct value of a column, values holds the value of each code"""
+
+    def __init__(self):
+        super().__init__()
+        self.values = []
+
+    def __missing__(self, value):
+        code = self[value] = len(self.values)
+        self.values.append(value)
+        return code
+
+    def __reduce__(self):
+        return StringTable.from_values, (self.values,)
+
+    @staticmethod
+    def from_values(values):
+        table = StringTable()
+        for value in values:
+            table.__missing__(value)
+        return table
+
+    def copy(self):
+        table = StringTable()
+        table.update(self)
+        table.values = self.values[:]
+        return table
+
+
+def column_typecode(column):
+    if column in OBJECT_COLS:
+        return None
+    if column in DICTIONARY_COLS:
+        return 'i'
+    if column in FLOAT_COLS:
+        return 'd'
+    if column in BOOL_COLS:
+        return 'b'
+    return 'q'  # int64 counters, shape fingerprint, timestamp and hour in milliseconds
+
+
+DF_TYPECODES = [column_typecode(column) for column in DF_COL]
+NP_DTYPES = {'q': np.int64, 'd': np.float64, 'b': np.bool_}
+
+# rows moved at once from the staging list to the column buffers
+STAGING_SIZE = 256
+
+
+class SlowQueryColumns:
+    """
+    Accumulator of slow query rows, one buffer per column of DF_COL, the string columns being dictionary encoded
+    in tables of the chunk: a chunk only holds and pickles its own values, nothing grows with the run.
+    The rows are staged then moved by blocks to the buffers, a column receiving a value of another type
+    (a float counter, a very large number, an unhashable value for a string column) becomes a Python object column
+    with the old values.
+    shapes holds the JSON shapes first seen with these rows, by fingerprint (shape_id),
+    hours the dhour (time zone of the log) of their hours, by epoch milliseconds.
+    """
+    __slots__ = ("columns", "tables", "rows", "size", "shapes", "hours")
+
+    def __init__(self):
+        self.columns = [[] if typecode is None else array(typecode) for typecode in DF_TYPECODES]
+        # StringTable of the dictionary encoded columns, None for the others
+        self.tables = [StringTable() if column in DICTIONARY_COLS else None for column in DF_COL]
+        self.rows = []
+        self.size = 0
+        self.shapes = {}
+        self.hours = {}
+
+    def __len__(self):
+        return self.size + len(self.rows)
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= STAGING_SIZE:
+            self.flush_rows()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def flush_rows(self):
+        rows = self.rows
+        if not rows:
+            return
+        self.rows = []
+        columns = self.columns
+        tables = self.tables
+        for i, values in enumerate(zip(*rows)):
+            column = columns[i]
+            table = tables[i]
+            try:
+                if table is None:
+                    column.extend(values)
+                else:
+                    column.extend(map(table.__getitem__, values))
+            except (TypeError, OverflowError):
+                # keep the values as they are, pandas infers the dtype as before
+                column = column[:self.size]
+                if table is not None:
+                    column = map(table.values.__getitem__, column)
+                    tables[i] = None
+                column = columns[i] = list(column)
+                column.extend(values)
+        self.size += len(rows)
+
+    def copy(self):
+        self.flush_rows()
+        copy = SlowQueryColumns()
+        copy.columns = [column[:] for column in self.columns]
+        # the tables keep growing with the rows appended after the copy
+        copy.tables = [None if table is None else table.copy() for table in self.tables]
+        copy.shapes = dict(self.shapes)
+        copy.hours = dict(self.hours)
+        copy.size = self.size
+        return copy
+
+    def to_frame(self):
+        self.flush_rows()
+        data = {}
+        for column, values, typecode, table in zip(DF_COL, self.columns, DF_TYPECODES, self.tables):
+            if table is not None:
+                # categories limited to the values of the chunk
+                codes, chunk_codes = np.unique(np.frombuffer(values, dtype=np.int32), return_inverse=True)
+                categories = pd.Index([table.values[code] for code in codes.tolist()], dtype=object)
+                data[column] = pd.Categorical.from_codes(chunk_codes.astype(np.int32), categories)
+            elif values.__class__ is array:
+                data[column] = np.frombuffer(values, dtype=NP_DTYPES[typecode]) if values else \
+                    np.empty(0, dtype=NP_DTYPES[typecode])
+            else:
+                data[column] = pd.Series(values, dtype=object if typecode is None else None)
+        return pd.DataFrame(data, columns=DF_COL, copy=False)
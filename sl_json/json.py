@@ -1,8 +1,12 @@
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 import msgspec
 
+from sl_json.shape import get_shape_id, get_hash_shape_id, take_new_shapes, set_resend_shapes
+from sl_json.schema import slow_query_decoder, slow_query_header_decoder, EMPTY_ATTR, EMPTY_STORAGE_DATA, EMPTY_TIME_WAITING, \
+    EMPTY_FLOW_CONTROL
+
 encoder = msgspec.json.Encoder()
 decoder = msgspec.json.Decoder()
 
@@ -13,45 +17,237 @@ def get_time_from_line(line):
         return None
     return datetime.fromisoformat(timestamp)
 
+def get_time_from_prefix(line):
+    """
+    Read the time from the leading {"t":{"$date":...}} of a raw log line (bytes)
+    without decoding the whole line.
+    """
+    start = line.find(b'"$date":"', 0, 64)
+    if start < 0:
+        return None
+    start += 9
+    end = line.find(b'"', start, start + 40)
+    if end < 0:
+        return None
+    try:
+        return datetime.fromisoformat(line[start:end].decode())
+    except ValueError:
+        return None
+
+class LogHour:
+    """Hour of the log times: start of the hour and the keys derived from it, built once per hour"""
+    __slots__ = ("dtime", "epoch", "dhour", "day", "hh")
+
+    def __init__(self, dtime):
+        self.dtime = dtime
+        # naive times are UTC, as for the time window
+        aware = dtime if dtime.tzinfo is not None else dtime.replace(tzinfo=timezone.utc)
+        self.epoch = int(aware.timestamp()) * 1000
+        self.dhour = dtime.strftime('%Y-%m-%d_%H')
+        self.day = dtime.strftime('%Y%m%d')
+        self.hh = dtime.strftime('%H')
+
+
+# LogHour by hour prefix of the $date string ("2024-05-01T10" + "+00:00")
+_log_hours = {}
+
+
+def get_log_hour(dtime):
+    """LogHour of a datetime"""
+    key = (dtime.year, dtime.month, dtime.day, dtime.hour, dtime.utcoffset())
+    log_hour = _log_hours.get(key)
+    if log_hour is None:
+        log_hour = _log_hours[key] = LogHour(dtime.replace(minute=0, second=0, microsecond=0))
+    return log_hour
+
+
+def parse_log_time(timestamp):
+    """
+    (epoch in milliseconds, LogHour) of a $date string.
+    The mongod layout (2024-05-01T10:12:13.456+00:00) is read from fixed positions, only the first time
+    of each hour goes through fromisoformat. Other layouts are fully parsed.
+    """
+    if len(timestamp) >= 24 and timestamp[19] == '.' and timestamp[13] == ':':
+        key = timestamp[:13] + timestamp[23:]
+        log_hour = _log_hours.get(key)
+        try:
+            if log_hour is None:
+                log_hour = _log_hours[key] = LogHour(datetime.fromisoformat(timestamp[:13] + ":00:00" + timestamp[23:]))
+            return log_hour.epoch + int(timestamp[14:16]) * 60000 + int(timestamp[17:19]) * 1000 + int(timestamp[20:23]), log_hour
+        except ValueError:
+            pass
+    return datetime_to_log_time(datetime.fromisoformat(timestamp))
+
+
+def datetime_to_log_time(dtime):
+    """(epoch in milliseconds, LogHour) of a datetime"""
+    log_hour = get_log_hour(dtime)
+    return log_hour.epoch + (dtime - log_hour.dtime) // timedelta(milliseconds=1), log_hour
+
+
+def log_time_to_datetime(epoch, log_hour):
+    """datetime of a time parsed by parse_log_time, in the time zone of the log"""
+    if log_hour is None:
+        return None
+    return log_hour.dtime + timedelta(milliseconds=epoch - log_hour.epoch)
+
+
+# counters of the decode phases:
+# lines given to the decode stage, not JSON, dropped by the header (not a slow query, excluded namespace),
+# fully decoded, dropped after the full decode (excluded database), decoded as dict (unexpected types), rows produced
+DECODE_STATS = ["lines", "invalid", "not_slow", "excluded_ns", "full_decode", "excluded_db", "fallback", "rows"]
+
+
+def new_decode_stats():
+    return dict.fromkeys(DECODE_STATS, 0)
+
+
+def merge_decode_stats(stats, other):
+    for key, value in other.items():
+        stats[key] = stats.get(key, 0) + value
+    return stats
+
+
+def format_decode_stats(stats):
+    return " ".join(f"{key}={stats.get(key, 0)}" for key in DECODE_STATS)
+
+
+EXCLUDED_NS_PREFIXES = ('admin.', 'local.', 'config.')
+
+# sink for the counters when the caller does not keep them
+NO_DECODE_STATS = new_decode_stats()
+
+
 class JsonAndText:
-    def __init__(self,line,source,shard):
+    def __init__(self,line,source,shard,stats=None,by_query_hash=False):
         self.orig=line
         self.source=source
         self.shard=shard
-        self.dtime=None
+        # group by the query hash logged by the server when there is one (get_hash_shape_id)
+        self.by_query_hash=by_query_hash
+        # time of the line in milliseconds since the epoch and its LogHour
+        self.epoch=None
+        self.log_hour=None
         self.dhour = None
         self.log_entry=None
+        self.stats=NO_DECODE_STATS if stats is None else stats
         self.internal_decode()
 
     def internal_decode(self):
+        stats = self.stats
+        try:
+            # phase 1: t, msg and attr.ns only, most of the line is skipped
+            header = slow_query_header_decoder.decode(self.orig)
+            timestamp = None if header.t is None else header.t.date
+            if header.msg != "Slow query" or not timestamp:
+                stats["not_slow"] += 1
+                self.clear()
+                return
+            self.epoch, self.log_hour = parse_log_time(timestamp)
+            self.dhour = self.log_hour.dhour
+            if header.attr is not None and header.attr.ns.startswith(EXCLUDED_NS_PREFIXES):
+                stats["excluded_ns"] += 1
+                return
+            # phase 2: the fields of the row
+            entry = slow_query_decoder.decode(self.orig)
+        except msgspec.ValidationError:
+            # a field with an unexpected type, use the generic decode
+            stats["fallback"] += 1
+            self.internal_decode_dict()
+            if self.log_entry is not None:
+                stats["rows"] += 1
+            return
+        stats["full_decode"] += 1
+        self.log_entry=extractSlowQueryInfosFromEntry(entry,self.orig,self.source,self.shard,self.epoch,self.log_hour,
+                                                      self.by_query_hash)
+        if self.log_entry is None:
+            stats["excluded_db"] += 1
+        else:
+            stats["rows"] += 1
+
+    def internal_decode_dict(self):
         self.log_entry = decoder.decode(self.orig)
         if self.log_entry.get("msg",None) == "Slow query":
             # Fully parse the JSON object since the condition is true
             timestamp = self.log_entry.get("t", {}).get("$date")
             if timestamp:
-                self.dtime = datetime.fromisoformat(timestamp)
-                self.dhour = self.dtime.strftime('%Y-%m-%d_%H')
-                self.log_entry=extractSlowQueryInfos(self.log_entry,self.source,self.shard)
+                self.epoch, self.log_hour = parse_log_time(timestamp)
+                self.dhour = self.log_hour.dhour
+                self.log_entry=extractSlowQueryInfos(self.log_entry,self.source,self.shard,self.epoch,self.log_hour,
+                                                     self.by_query_hash)
                 return
         self.clear()
 
     def set_line(self,line):
         self.orig=line
 
+    @property
+    def dtime(self):
+        return log_time_to_datetime(self.epoch, self.log_hour)
+
     def decode(self):
         return self.dtime,self.dhour,self.log_entry,self.orig
 
     def clear(self):
         self.orig=None
-        self.dtime=None
+        self.epoch=None
+        self.log_hour=None
         self.dhour = None
         self.log_entry=None
         self.source=None
         self.shard=None
 
 
+class DecodedBatch:
+    """
+    Slow query rows of a batch of lines as parallel lists (time, LogHour, row, original line),
+    with the time of the last line of the batch having one and the JSON shapes first seen in the batch
+    """
+    __slots__ = ("epochs", "log_hours", "rows", "lines", "last_epoch", "last_log_hour", "shapes")
+
+    def __init__(self):
+        self.epochs = []
+        self.log_hours = []
+        self.rows = []
+        self.lines = []
+        self.last_epoch = None
+        self.last_log_hour = None
+        self.shapes = None
+
+
+def decode_lines(lines, source, shard, stats=None, by_query_hash=False, resend_shapes=False):
+    """
+    Decode a batch of raw lines into a DecodedBatch, the lines which are not JSON are counted as invalid.
+    Return the batch and the decode counters (stats updated in place when given).
+    by_query_hash groups the rows by the query hash logged by the server when there is one.
+    resend_shapes gives the JSON shapes of all the shapes of the batch (top shapes), not only of the new ones.
+    """
+    set_resend_shapes(resend_shapes)
+    if stats is None:
+        stats = new_decode_stats()
+    stats["lines"] += len(lines)
+    batch = DecodedBatch()
+    for line in lines:
+        try:
+            dline = JsonAndText(line, source, shard, stats, by_query_hash)
+        except msgspec.MsgspecError:
+            stats["invalid"] += 1
+            continue
+        if dline.log_hour is None:
+            continue
+        batch.last_epoch = dline.epoch
+        batch.last_log_hour = dline.log_hour
+        if dline.log_entry is not None:
+            batch.epochs.append(dline.epoch)
+            batch.log_hours.append(dline.log_hour)
+            batch.rows.append(dline.log_entry)
+            batch.lines.append(dline.orig)
+    batch.shapes = take_new_shapes()
+    return batch, stats
+
+
 DF_COL = ['timestamp','hour','source','shard', 'db', 'namespace', 'slow_query', 'workingMillis','durationMillis','cpuNanos','planningTimeMicros', 'has_sort_stage', 'query_targeting',
-          'plan_summary', 'command_shape', 'writeConflicts', 'skip', 'limit', 'appName','readPreference', 'changestream', 'usedDisk',
+          'plan_summary', 'shape_id', 'writeConflicts', 'skip', 'limit', 'appName','readPreference', 'changestream', 'usedDisk',
           'fromMultiPlanner','replanned','replanReason',
           'keys_examined', 'docs_examined', 'nreturned', 'cursorid', 'nBatches', 'numYields',
           'totalOplogSlotDurationMicros', 'waitForWriteConcernDurationMillis', 'ninserted', 'nMatched', 'nModified',
@@ -62,7 +258,7 @@ DF_COL = ['timestamp','hour','source','shard', 'db', 'namespace', 'slow_query',
           'cmdType','count_of_in','max_count_in','sum_of_counts_in','getMore','planCacheShapeHash','queryHash','planCacheKey','queryFramework']
 
 
-def extractSlowQueryInfos(log_entry,source,shard):
+def extractSlowQueryInfos(log_entry,source,shard,epoch=None,log_hour=None,by_query_hash=False):
     start_time = time.time()
     # Extract relevant fields
     getMore=0
@@ -166,7 +362,6 @@ def extractSlowQueryInfos(log_entry,source,shard):
 
     skip = command.get("skip", 0)
     limit = command.get("limit", 0)
-    changestream = check_change_stream(log_entry)
 
     #command.get("readConcern",None)
     #readConcern:
@@ -261,16 +456,20 @@ def extractSlowQueryInfos(log_entry,source,shard):
 #             version: string
 #         }
 # }
-    command_shape, in_counts,db = get_command_shape(command,namespace)
+    shape_command = command
     if first_attribute_name=="getMore":
-        orig_command = attr.get("originatingCommand", {})
+        # the shape is the one of the command which opened the cursor
+        shape_command = attr.get("originatingCommand", {})
         getMore=1
-        command_shape, in_counts,db = get_command_shape(orig_command,namespace)
+    # the $changeStream stage is in the pipeline of the command (of the originating command for a getMore)
+    query_hash = planCacheShapeHash or queryHash
+    if by_query_hash and query_hash and isinstance(query_hash, str):
+        shape_id, in_counts,db,changestream = get_hash_shape_id(shape_command,namespace,query_hash)
+    else:
+        shape_id, in_counts,db,changestream = get_shape_id(shape_command,namespace)
     count_of_in = len(in_counts)
     max_count_in = max(in_counts) if in_counts else 0
     sum_of_counts = sum(in_counts)
-    if command_shape == 0:
-        command_shape = "no_command"
 
     excluded_prefixes=('admin', 'local', 'config')
     if db.startswith(excluded_prefixes):
@@ -279,9 +478,11 @@ def extractSlowQueryInfos(log_entry,source,shard):
     timestamp = log_entry.get("t", {}).get("$date")
 
     if timestamp:
-        hour = datetime.fromisoformat(timestamp).strftime('%Y-%m-%d %H:00:00')
-        return [timestamp,hour, source,shard,db, namespace, 1, workingMillis,duration,cpuNanos,planningTimeMicros, has_sort_stage, query_targeting, plan_summary,
-                     command_shape,writeConflicts,skip,limit,appName,readPreference,changestream,usedDisk,fromMultiPlanner,replanned,replanReason,keys_examined,docs_examined,nreturned,
+        if log_hour is None:
+            epoch, log_hour = parse_log_time(timestamp)
+        # timestamp and hour in milliseconds since the epoch, datetime64 columns of the chunk DataFrame
+        return [epoch,log_hour.epoch, source,shard,db, namespace, 1, workingMillis,duration,cpuNanos,planningTimeMicros, has_sort_stage, query_targeting, plan_summary,
+                     shape_id,writeConflicts,skip,limit,appName,readPreference,changestream,usedDisk,fromMultiPlanner,replanned,replanReason,keys_examined,docs_examined,nreturned,
                      cursorid,nBatches,numYields,totalOplogSlotDurationMicros,waitForWriteConcernDurationMillis,ninserted,
                      nMatched,nModified,nUpserted,ndeleted,keysInserted,keysDeleted,reslen,flowControl_acquireCount,flowControl_timeAcquiringMicros,
                      storage_data_bytesRead,storage_data_timeReadingMicros,storage_data_bytesWritten,storage_data_timeWritingMicros,storage_data_bytesTotalDiskWR,storage_data_timeWRMicros,
@@ -291,97 +492,72 @@ def extractSlowQueryInfos(log_entry,source,shard):
     return None
 
 
-def get_command_shape(command,namespace):
-    in_counts = []
-    db=command.get("$db",namespace.split('.', 1))
-    def replace_valuesAsStr(obj):
-        res=replace_values(obj)
-        if isinstance(res, str):
-            return res
-        return encoder.encode(res)
-    def replace_values(obj):
-        if isinstance(obj, dict):
-            new_obj = {}
-            for k, v in obj.items():
-                if k == "$in" and isinstance(v, list):
-                    in_counts.append(len(v))
-                    # Use a set to collect unique types
-                    unique_types = {replace_valuesAsStr(i) for i in v}
-                    new_obj[k] = list(unique_types)  # Convert set back to list
-                else:
-                    new_obj[k] = replace_values(v)
-            return new_obj
-        elif isinstance(obj, list):
-            return [replace_values(i) for i in obj]
-        elif isinstance(obj, int):
-            return "int"
-        elif isinstance(obj, float):
-            return "float"
-        elif isinstance(obj, str):
-            return "string"
-        elif isinstance(obj, bool):
-            return "bool"
-        else:
-            return "other"
-    def handle_pipeline(pipeline):
-        new_pipeline = []
-        for stage in pipeline:
-            if isinstance(stage, dict):
-                new_stage = {}
-                for k, v in stage.items():
-                    if k == "$group" and isinstance(v, dict):
-                        new_stage[k] = {sub_k: replace_values(sub_v) if sub_k != "_id" else sub_v for sub_k, sub_v in v.items()}
-                    elif k == "$lookup" and isinstance(v, dict):
-                        new_stage[k] = {sub_k: replace_values(sub_v) if sub_k not in ["from", "localField", "foreignField", "as"] else sub_v for sub_k, sub_v in v.items()}
-                    else:
-                        new_stage[k] = replace_values(v)
-                new_pipeline.append(new_stage)
-            else:
-                new_pipeline.append(replace_values(stage))
-        return new_pipeline
-    command_shape = replace_values(command)
-    command_shape.pop('lsid', None)
-    command_shape.pop('$clusterTime', None)
-    command_shape.pop("readConcern",None)
-    command_shape.pop("clientOperationKey",None)
-    command_shape.pop("shardVersion",None)
-    command_shape.pop("$timestamp",None)
-    command_shape.pop("databaseVersion",None)
-    command_shape.pop("$topologyTime",None)
-    command_shape.pop("$configTime",None)
-    command_shape.pop("$audit",None)
-    command_shape.pop("$client",None)
-    command_shape.pop("mayBypassWriteBlocking",None)
-    keys = list(command_shape.keys())
-    # Preserve specific keys in their original form if they are the first key
-    for key in ["insert", "findAndModify", "update","delete"]:
-        if key in command_shape and keys.index(key) == 0:
-            command_shape[key] = command[key]
-    # Preserve other specific keys in their original form
-    for key in ["collection", "aggregate", "find", "ordered", "$db"]:
-        if key in command_shape:
-            command_shape[key] = command[key]
-    # Handle the pipeline separately
-    if "pipeline" in command:
-        command_shape["pipeline"] = handle_pipeline(command["pipeline"])
-    return encoder.encode(command_shape), in_counts, str(db)
-
-
-def check_change_stream(document):
-    changestream = False
-    def search_for_change_stream(subdoc):
-        if isinstance(subdoc, dict):
-            for key, value in subdoc.items():
-                if key == "$changeStream":
-                    return True
-                if isinstance(value, dict) or isinstance(value, list):
-                    if search_for_change_stream(value):
-                        return True
-        elif isinstance(subdoc, list):
-            for item in subdoc:
-                if search_for_change_stream(item):
-                    return True
-        return False
-    if search_for_change_stream(document):
-        changestream = True
-    return changestream
+IN_KEY = '"$in"'
+CHANGE_STREAM_KEY = '"$changeStream"'
+
+
+def extractSlowQueryInfosFromEntry(entry,line,source,shard,epoch,log_hour,by_query_hash=False):
+    """Same row as extractSlowQueryInfos from the typed SlowQueryEntry of line"""
+    getMore=0
+    attr = EMPTY_ATTR if entry.attr is None else entry.attr
+
+    namespace = attr.ns
+    if namespace.startswith(EXCLUDED_NS_PREFIXES):
+        return None
+
+    type_value = attr.type.lower()
+    # the command is only decoded for the rows kept
+    command = decoder.decode(attr.command) if attr.command else {}
+    first_attribute_name = next(iter(command), 'unknown')
+    cmdType = f"{type_value}.{first_attribute_name}"
+
+    keys_examined = attr.keysExamined
+    docs_examined = attr.docsExamined
+    nreturned = attr.nreturned
+    query_targeting = max(keys_examined, docs_examined) / nreturned if nreturned > 0 else 0
+    has_sort_stage = 1 if attr.hasSortStage else 0
+
+    flowControl = EMPTY_FLOW_CONTROL if attr.flowControl is None else attr.flowControl
+    storage_data = EMPTY_STORAGE_DATA if attr.storage is None or attr.storage.data is None else attr.storage.data
+    timeWaitingMicros = EMPTY_TIME_WAITING if storage_data.timeWaitingMicros is None else storage_data.timeWaitingMicros
+    storage_data_bytesTotalDiskWR = storage_data.bytesRead + storage_data.bytesWritten
+    storage_data_timeWRMicros = storage_data.timeReadingMicros + storage_data.timeWritingMicros
+
+    readPreference=command.get("$readPreference",{}).get("mode",'')
+    skip = command.get("skip", 0)
+    limit = command.get("limit", 0)
+
+    shape_command = command
+    if first_attribute_name=="getMore":
+        # the shape is the one of the command which opened the cursor
+        shape_command = decoder.decode(attr.originatingCommand) if attr.originatingCommand else {}
+        getMore=1
+    # same database as get_shape_id, checked before the shape is computed
+    db = str(shape_command.get("$db", namespace.split('.', 1)))
+    excluded_prefixes=('admin', 'local', 'config')
+    if db.startswith(excluded_prefixes):
+        return None
+    query_hash = attr.planCacheShapeHash or attr.queryHash
+    if by_query_hash and query_hash and isinstance(query_hash, str):
+        # the command is walked again only when it may have a $in, the $changeStream flag is the one of the line
+        shape_id, in_counts,db,changestream = get_hash_shape_id(shape_command,namespace,query_hash,IN_KEY in line,
+                                                                CHANGE_STREAM_KEY in line)
+    else:
+        shape_id, in_counts,db,changestream = get_shape_id(shape_command,namespace)
+    count_of_in = len(in_counts)
+    max_count_in = max(in_counts) if in_counts else 0
+    sum_of_counts = sum(in_counts)
+
+    return [epoch,log_hour.epoch, source,shard,db, namespace, 1, attr.workingMillis,attr.durationMillis,attr.cpuNanos,
+            attr.planningTimeMicros, has_sort_stage, query_targeting, attr.planSummary,
+            shape_id,attr.writeConflicts,skip,limit,attr.appName,readPreference,changestream,attr.usedDisk,
+            attr.fromMultiPlanner,attr.replanned,attr.replanReason,keys_examined,docs_examined,nreturned,
+            attr.cursorid,attr.nBatches,attr.numYields,attr.totalOplogSlotDurationMicros,
+            attr.waitForWriteConcernDurationMillis,attr.ninserted,
+            attr.nMatched,attr.nModified,attr.nUpserted,attr.ndeleted,attr.keysInserted,attr.keysDeleted,attr.reslen,
+            flowControl.acquireCount,flowControl.timeAcquiringMicros,
+            storage_data.bytesRead,storage_data.timeReadingMicros,storage_data.bytesWritten,
+            storage_data.timeWritingMicros,storage_data_bytesTotalDiskWR,storage_data_timeWRMicros,
+            timeWaitingMicros.cache,timeWaitingMicros.schemaLock,timeWaitingMicros.handleLock,
+            cmdType,count_of_in,max_count_in,sum_of_counts,getMore,attr.planCacheShapeHash,attr.queryHash,
+            attr.planCacheKey,attr.queryFramework]
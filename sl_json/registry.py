@@ -0,0 +1,75 @@
+import logging
+import os
+
+import msgspec
+
+from sl_json.shape import warm_shapes, shape_of
+
+# Shape registry: the query shapes of all the extractions under OUTPUT_FILE_PATH, by fingerprint (shape_id of the
+# chunk files and aggregations). Loaded before an extraction so the known shapes are not sent with its results,
+# updated with them once the extraction is done.
+
+REGISTRY_FILE = "shape_registry.json"
+
+
+class ShapeRegistryEntry(msgspec.Struct):
+    shape: str
+    # first and last log hour (YYYY-mm-dd_HH) the shape was seen in
+    first_seen: str = ""
+    last_seen: str = ""
+    # one of the namespaces of the shape
+    namespace: str = ""
+
+
+registry_encoder = msgspec.json.Encoder()
+registry_decoder = msgspec.json.Decoder(dict[str, ShapeRegistryEntry])
+
+
+def get_registry_path(output_path):
+    return f"{output_path}/{REGISTRY_FILE}"
+
+
+def load_shape_registry(path):
+    """Entries of the registry at path by fingerprint, {} when there is none. Their shapes are not given again"""
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, "rb") as in_file:
+            entries = {int(fingerprint): entry for fingerprint, entry in registry_decoder.decode(in_file.read()).items()}
+    except (OSError, ValueError, msgspec.DecodeError) as e:
+        logging.warning(f"shape registry {path} not loaded, the shapes are computed again: {e}")
+        return {}
+    warm_shapes({fingerprint: entry.shape.encode() for fingerprint, entry in entries.items()})
+    logging.info(f"{len(entries)} shapes loaded from {path}")
+    return entries
+
+
+def update_shape_registry(entries, result):
+    """Add the shapes of an extraction result to the registry entries, with the log hours they were seen in"""
+    for type in ["groupByCommandShape", "groupByCommandShapeChangeStream"]:
+        hours = result.get(type, {}).get("hours", None)
+        if hours is None or hours.shape[0] == 0:
+            continue
+        seen = hours.groupby("shape_id").agg(first_seen=("hour", "min"), last_seen=("hour", "max"),
+                                             namespace=("namespace", "first"))
+        for fingerprint, first_seen, last_seen, namespace in seen.itertuples():
+            fingerprint = int(fingerprint)
+            entry = entries.get(fingerprint)
+            if entry is None:
+                shape = shape_of(fingerprint, result.get("shapes", {}))
+                if shape is None:
+                    continue
+                namespace = namespace[0] if isinstance(namespace, list) and namespace else namespace
+                entries[fingerprint] = ShapeRegistryEntry(shape.decode(), first_seen, last_seen,
+                                                          namespace if isinstance(namespace, str) else "")
+            else:
+                entry.first_seen = min(entry.first_seen, first_seen) if entry.first_seen else first_seen
+                entry.last_seen = max(entry.last_seen, last_seen)
+    return entries
+
+
+def save_shape_registry(entries, path):
+    with open(f"{path}.tmp", "wb") as out_file:
+        out_file.write(registry_encoder.encode({str(fingerprint): entry for fingerprint, entry in entries.items()}))
+    os.replace(f"{path}.tmp", path)
+    logging.info(f"{len(entries)} shapes saved in {path}")
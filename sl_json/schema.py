@@ -0,0 +1,104 @@
+from typing import Any, Optional, Union
+
+import msgspec
+
+# Typed schema of the "Slow query" log document, only the fields used by extractSlowQueryInfos (DF_COL) are
+# materialised, msgspec skips the others while parsing. command is kept as raw JSON until the shape needs it.
+# The defaults are the ones of the dict based extraction so both give the same rows.
+
+Number = Union[int, float]
+
+
+class LogTime(msgspec.Struct):
+    date: Optional[str] = msgspec.field(name="$date", default=None)
+
+
+class FlowControl(msgspec.Struct):
+    acquireCount: Number = 0
+    timeAcquiringMicros: Number = 0
+
+
+class TimeWaitingMicros(msgspec.Struct):
+    cache: Number = 0
+    schemaLock: Number = 0
+    handleLock: Number = 0
+
+
+class StorageData(msgspec.Struct):
+    bytesRead: Number = 0
+    timeReadingMicros: Number = 0
+    bytesWritten: Number = 0
+    timeWritingMicros: Number = 0
+    timeWaitingMicros: Optional[TimeWaitingMicros] = None
+
+
+class Storage(msgspec.Struct):
+    data: Optional[StorageData] = None
+
+
+class SlowQueryAttr(msgspec.Struct):
+    type: str = "unknown"
+    ns: str = "unknown"
+    appName: Any = "n"
+    # raw JSON, empty when missing (msgspec.Raw can not be Optional)
+    command: msgspec.Raw = msgspec.Raw()
+    originatingCommand: msgspec.Raw = msgspec.Raw()
+    planSummary: Any = "n"
+    planCacheShapeHash: Any = ''
+    queryHash: Any = ''
+    planCacheKey: Any = ''
+    queryFramework: Any = ''
+    durationMillis: Number = 0
+    workingMillis: Number = 0
+    cpuNanos: Number = 0
+    planningTimeMicros: Number = 0
+    hasSortStage: Any = False
+    keysExamined: Number = 0
+    docsExamined: Number = 0
+    nreturned: Number = 0
+    cursorid: Number = 0
+    nBatches: Number = 0
+    numYields: Number = 0
+    ninserted: Number = 0
+    keysInserted: Number = 0
+    keysDeleted: Number = 0
+    nMatched: Number = 0
+    nModified: Number = 0
+    nUpserted: Number = 0
+    ndeleted: Number = 0
+    reslen: Number = 0
+    usedDisk: Any = 0
+    fromMultiPlanner: Any = 0
+    replanned: Any = 0
+    replanReason: Any = 0
+    writeConflicts: Number = 0
+    totalOplogSlotDurationMicros: Number = 0
+    waitForWriteConcernDurationMillis: Number = 0
+    flowControl: Optional[FlowControl] = None
+    storage: Optional[Storage] = None
+
+
+class HeaderAttr(msgspec.Struct):
+    ns: str = "unknown"
+
+
+class SlowQueryHeader(msgspec.Struct):
+    """First decode phase: just what is needed to drop a line before the full decode"""
+    t: Optional[LogTime] = None
+    msg: str = ""
+    attr: Optional[HeaderAttr] = None
+
+
+class SlowQueryEntry(msgspec.Struct):
+    t: Optional[LogTime] = None
+    msg: str = ""
+    attr: Optional[SlowQueryAttr] = None
+
+
+slow_query_header_decoder = msgspec.json.Decoder(SlowQueryHeader)
+slow_query_decoder = msgspec.json.Decoder(SlowQueryEntry)
+
+EMPTY_ATTR = SlowQueryAttr()
+EMPTY_STORAGE_DATA = StorageData()
+EMPTY_TIME_WAITING = TimeWaitingMicros()
+EMPTY_FLOW_CONTROL = FlowControl()
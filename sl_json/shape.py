@@ -0,0 +1,262 @@
+from collections import OrderedDict
+from hashlib import blake2b
+
+import msgspec
+
+encoder = msgspec.json.Encoder()
+
+# Shape engine: a query shape is identified by a 64-bit fingerprint of its JSON shape, the aggregation key.
+# The JSON shape itself is kept in a side table for display, given once per fingerprint (LRU of the ones sent).
+# One walk of the command (scan_command) gives the shape, the $in lengths, the db and the $changeStream flag.
+# The elements of a $in are compared as a set, listed in sorted order in the JSON shape.
+# With get_hash_shape_id the key is the query hash logged by the server, the JSON shape is the one of the first
+# command seen with that hash. The shapes of the previous runs (sl_json.registry) are not given again.
+
+SHAPE_CACHE_SIZE = 4096
+
+# keys removed from the shape
+SHAPE_IGNORED_KEYS = {'lsid', '$clusterTime', 'readConcern', 'clientOperationKey', 'shardVersion', '$timestamp',
+                      'databaseVersion', '$topologyTime', '$configTime', '$audit', '$client', 'mayBypassWriteBlocking'}
+# keys kept as they are, for the first ones only when they are the first key of the command
+SHAPE_RAW_FIRST_KEYS = {'insert', 'findAndModify', 'update', 'delete'}
+SHAPE_RAW_KEYS = {'collection', 'aggregate', 'find', 'ordered', '$db'}
+SHAPE_LOOKUP_RAW_KEYS = {'from', 'localField', 'foreignField', 'as'}
+
+# a value of the shape is its type name, bool being an int
+TYPE_NAMES = {int: "int", bool: "int", float: "float", str: "string"}
+
+# how the values of a container are shaped
+COMMAND = 0   # the command: ignored, raw and pipeline keys
+VALUE = 1     # type names instead of the values
+RAW = 2       # values kept as they are
+IN_SET = 3    # elements of a $in list, compared as a set
+PIPELINE = 4  # stages of the aggregation pipeline
+STAGE = 5     # keys of one stage
+GROUP = 6     # $group stage, _id kept as it is
+LOOKUP = 7    # $lookup stage, from/localField/foreignField/as kept as they are
+
+
+def scan_command(command, namespace):
+    """
+    One walk of command, with an explicit stack so a deep pipeline can not hit the recursion limit.
+    Returns (shape, $in lengths, db, $changeStream flag), shape being the object of the JSON shape.
+    The $in lengths are the ones of the former get_command_shape, the $in of the pipeline counted twice
+    (it walked the pipeline twice). The values left out of the shape (ignored keys, values kept as they are)
+    are still walked for the $in lengths and the $changeStream flag.
+    """
+    in_counts = []
+    changestream = "$changeStream" in command
+    first = True
+    stack = []
+    # container being walked: mode, its items, dict or list, weight of its $in in in_counts,
+    # shape being built (None when the container is left out of the shape or kept as it is)
+    mode, items, is_dict, weight, out = COMMAND, iter(command.items()), True, 1, {}
+    while True:
+        if is_dict:
+            for k, v in items:
+                cls = v.__class__
+                child_mode, child_weight, child_out = VALUE, weight, out
+                if mode is VALUE:
+                    if k == "$in" and cls is list:
+                        in_counts.extend((len(v),) * weight)
+                        child_mode = IN_SET
+                elif mode is RAW:
+                    if k == "$in" and cls is list:
+                        in_counts.extend((len(v),) * weight)
+                    child_mode = RAW
+                elif mode is COMMAND:
+                    if k in SHAPE_IGNORED_KEYS:
+                        child_out = None
+                    elif k == "pipeline" and cls is list:
+                        child_mode, child_weight = PIPELINE, 2
+                    elif k in SHAPE_RAW_KEYS or (first and k in SHAPE_RAW_FIRST_KEYS):
+                        child_mode = RAW
+                    elif k == "$in" and cls is list:
+                        in_counts.append(len(v))
+                        child_mode = IN_SET
+                    if child_out is not None:
+                        first = False
+                else:
+                    # stage keys: the second walk of the pipeline did not count a $in at this level
+                    if k == "$in" and cls is list:
+                        in_counts.append(len(v))
+                    if (mode is GROUP and k == "_id") or (mode is LOOKUP and k in SHAPE_LOOKUP_RAW_KEYS):
+                        child_mode, child_weight = RAW, 1
+                    elif mode is STAGE and cls is dict:
+                        if k == "$group":
+                            child_mode = GROUP
+                        elif k == "$lookup":
+                            child_mode = LOOKUP
+                if cls is dict or cls is list:
+                    if child_mode is IN_SET:
+                        types = {value.__class__ for value in v}
+                        if dict not in types and list not in types:
+                            # only scalars, the usual case
+                            if child_out is not None:
+                                out[k] = sorted({TYPE_NAMES.get(t, "other") for t in types})
+                            continue
+                    if cls is dict and "$changeStream" in v:
+                        changestream = True
+                    if child_out is not None:
+                        if child_mode is RAW:
+                            out[k] = v
+                            child_out = None
+                        else:
+                            child_out = out[k] = {} if cls is dict else []
+                    stack.append((mode, items, is_dict, weight, out))
+                    mode, weight, out = child_mode, child_weight, child_out
+                    is_dict = cls is dict
+                    items = iter(v.items()) if is_dict else iter(v)
+                    break
+                if child_out is not None:
+                    out[k] = v if child_mode is RAW else TYPE_NAMES.get(cls, "other")
+            else:
+                is_dict = None
+        else:
+            for v in items:
+                cls = v.__class__
+                if cls is dict or cls is list:
+                    if mode is IN_SET:
+                        child_mode = VALUE
+                    elif mode is PIPELINE:
+                        child_mode = STAGE if cls is dict else VALUE
+                    else:
+                        child_mode = mode
+                    if cls is dict and "$changeStream" in v:
+                        changestream = True
+                    child_out = None
+                    if out is not None:
+                        child_out = {} if cls is dict else []
+                        if mode is not IN_SET:
+                            out.append(child_out)
+                    stack.append((mode, items, is_dict, weight, out))
+                    mode, out = child_mode, child_out
+                    is_dict = cls is dict
+                    items = iter(v.items()) if is_dict else iter(v)
+                    break
+                if out is not None:
+                    out.append(TYPE_NAMES.get(cls, "other"))
+            else:
+                is_dict = None
+        if is_dict is not None:
+            # went down into a child container
+            continue
+        # end of the container
+        if mode is IN_SET and out is not None:
+            out[:] = sorted(set(out))
+        if not stack:
+            break
+        child_out = out
+        mode, items, is_dict, weight, out = stack.pop()
+        if mode is IN_SET and out is not None:
+            out.append(encoder.encode(child_out).decode())
+    return out, in_counts, str(command.get("$db", namespace.split('.', 1))), changestream
+
+
+def shape_fingerprint(shape):
+    """64-bit fingerprint of the JSON shape, signed to be stored in an int64 column"""
+    return int.from_bytes(blake2b(shape, digest_size=8).digest(), 'little', signed=True)
+
+
+class ShapeCache:
+    """LRU of the JSON shapes by fingerprint (of any value by key)"""
+
+    def __init__(self, max_size=SHAPE_CACHE_SIZE):
+        self.max_size = max_size
+        self.shapes = OrderedDict()
+
+    def get(self, fingerprint):
+        shape = self.shapes.get(fingerprint)
+        if shape is not None:
+            self.shapes.move_to_end(fingerprint)
+        return shape
+
+    def put(self, fingerprint, shape):
+        self.shapes[fingerprint] = shape
+        if len(self.shapes) > self.max_size:
+            self.shapes.popitem(last=False)
+
+
+shape_cache = ShapeCache()
+# JSON shapes computed since the last take_new_shapes, by fingerprint
+_new_shapes = {}
+# JSON shapes known before the extraction (shape registry), by fingerprint: they are not sent again
+known_shapes = {}
+# when set take_new_shapes also gives the JSON shapes of the fingerprints of the LRU seen again: with top shapes the
+# side table of the aggregation only keeps the tracked shapes, a shape back in the top needs its JSON shape again
+resend_shapes = False
+
+
+def set_resend_shapes(enabled):
+    """Give the JSON shape of every fingerprint seen by take_new_shapes (top shapes) or only of the new ones"""
+    global resend_shapes
+    resend_shapes = enabled
+
+
+def warm_shapes(shapes):
+    """Add the JSON shapes of the previous runs (fingerprint -> JSON shape) to known_shapes"""
+    known_shapes.update(shapes)
+
+
+def shape_of(fingerprint, shapes):
+    """JSON shape of fingerprint from the side table shapes of an extraction, or from the known shapes"""
+    shape = shapes.get(fingerprint)
+    return known_shapes.get(fingerprint) if shape is None else shape
+
+
+def get_shape_id(command, namespace):
+    """
+    (fingerprint, $in lengths, db, $changeStream flag) of command, the fingerprint is the aggregation key of the
+    query shape. The JSON shape of a fingerprint missing from the LRU (of any one with resend_shapes) is given by
+    the next take_new_shapes.
+    """
+    shape, in_counts, db, changestream = scan_command(command, namespace)
+    shape = encoder.encode(shape)
+    fingerprint = shape_fingerprint(shape)
+    if shape_cache.get(fingerprint) is None:
+        shape_cache.put(fingerprint, shape)
+        if fingerprint not in known_shapes:
+            _new_shapes[fingerprint] = shape
+    elif resend_shapes and fingerprint not in known_shapes:
+        _new_shapes[fingerprint] = shape
+    return fingerprint, in_counts, db, changestream
+
+
+# (fingerprint, JSON shape) of the exemplar of each (namespace, command, server query hash)
+hash_exemplars = ShapeCache()
+
+
+def get_hash_shape_id(command, namespace, query_hash, has_in=True, changestream=None):
+    """
+    Same as get_shape_id for a command grouped by the query hash logged by the server (planCacheShapeHash or
+    queryHash): only the first command of a hash is normalised, its JSON shape is the one shown for the hash.
+    The next ones are only walked for their $in lengths, when has_in tells they may have some.
+    changestream is the $changeStream flag of the line of each command, None to find it by walking the command.
+    """
+    key = (namespace, next(iter(command), ''), query_hash)
+    exemplar = hash_exemplars.get(key)
+    if exemplar is None:
+        shape, in_counts, db, found = scan_command(command, namespace)
+        fingerprint = shape_fingerprint(encoder.encode(key))
+        shape = encoder.encode(shape)
+        hash_exemplars.put(key, (fingerprint, shape))
+        if fingerprint not in known_shapes:
+            _new_shapes[fingerprint] = shape
+    else:
+        fingerprint, shape = exemplar
+        if resend_shapes and fingerprint not in known_shapes:
+            _new_shapes[fingerprint] = shape
+        in_counts, found = [], False
+        if has_in or changestream is None:
+            _, in_counts, _, found = scan_command(command, namespace)
+        db = str(command.get("$db", namespace.split('.', 1)))
+    return fingerprint, in_counts, db, found if changestream is None else changestream
+
+
+def take_new_shapes():
+    """JSON shapes computed since the previous call, to add to the side table of the aggregation"""
+    global _new_shapes
+    shapes = _new_shapes
+    _new_shapes = {}
+    return shapes
+
@@ -7,6 +7,8 @@ import matplotlib
 import logging
 import pandas as pd
 from datetime import datetime
+
+from sl_async.slsketch import QUANTILES, decode_sketches, quantiles
 graph_logging = logging.getLogger("graphs")
 
 def plot_stats(config, df, value_col, title, ylabel, xlabel='Time', output_file=None, columns=['namespace']):
@@ -79,13 +81,21 @@ def aggregateForGraph(df,groupByConditions):
     for cond in groupByConditions:
         if cond != 'hour':
             df[cond] = df[cond].apply(lambda x: x[0] if isinstance(x, list) and len(x) > 0 else x)
-    return df.groupby(groupByConditions).agg(
+    grouped = df.groupby(groupByConditions)
+    aggregated = grouped.agg(
         slow_query=('slow_query', 'sum'),
         total_duration=('durationMillis_total', 'sum'),
         writeConflicts=('writeConflicts_total', 'sum'),
         has_sort_stage=('has_sort_stage', 'sum'),
         sum_skip=('skip_total', 'sum'),
         query_targeting=('query_targeting_max', 'max')).reset_index()
+    if 'durationMillis_sketch' in df.columns:
+        # p95 of the merged duration sketches of each group, the groups are numbered in the order of aggregated
+        ids = grouped.ngroup().to_numpy()
+        kept = ids >= 0
+        ids, codes, counts = decode_sketches(df['durationMillis_sketch'][kept], ids[kept])
+        aggregated['duration_p95'] = quantiles(ids, codes, counts, len(aggregated), QUANTILES['p95'])
+    return aggregated
 
 
 def createGraphBy(config, result, groupByCondition, prefix, all_plot_args):
@@ -115,6 +125,19 @@ def createGraphBy(config, result, groupByCondition, prefix, all_plot_args):
             f"{prefix}_total_duration_per_hour_and_{groupByCondition}",
             [groupByCondition],
         ),
+    ])
+    if 'duration_p95' in df.columns:
+        all_plot_args.append((
+            config,
+            df,
+            'duration_p95',
+            f"P95 Duration of Slow Queries per Hour per {groupByCondition}",
+            'P95 Duration (ms)',
+            'Time',
+            f"{prefix}_p95_duration_per_hour_and_{groupByCondition}",
+            [groupByCondition],
+        ))
+    all_plot_args.extend([
         (
             config,
             df_plan_summary[df_plan_summary['plan_summary'].str.contains('COLLSCAN')],
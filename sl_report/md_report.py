@@ -1,7 +1,9 @@
 from sl_report.report import AbstractReport
+from sl_async.sldistinct import distinct_text
 import base64
 from pathlib import Path
 import logging
+import pandas as pd
 mdreports_logging = logging.getLogger("md_reports")
 mdreports_logging.setLevel(logging.DEBUG)
 def get_nested_value(data, key):
@@ -88,30 +90,30 @@ class MDReport(AbstractReport):
         # Prepare aggregated values
         aggregated_values = {}
         for col in columns:
-            if col.endswith(('_min', '_max', '_avg', '_total', '_count')):
+            if col.endswith(('_min', '_max', '_avg', '_total', '_count', '_p50', '_p95', '_p99')):
                 base_name = col.rsplit('_', 1)[0]
                 if base_name not in aggregated_values:
                     aggregated_values[base_name] = {}
                 summary_type = col.rsplit('_', 1)[1]
                 value = row.get(col, None)
-                if value:
+                if value and not pd.isna(value):
                     aggregated_values[base_name][summary_type] = value
         # Render unique/non-aggregated values
         self.sub2Chapter_title("Non-Aggregated Values")
-        unique_columns = [col for col in columns if not col.endswith(('_min', '_max', '_avg', '_total', '_count'))]
+        unique_columns = [col for col in columns if not col.endswith(('_min', '_max', '_avg', '_total', '_count', '_p50', '_p95', '_p99'))]
         for col in unique_columns:
             value = row.get(col, '')
             if isinstance(value, list) and len(value) <= 1:  # Handle lists with one or zero elements
                 value = value[0] if value else ''
             if not value:  # Skip empty fields
                 continue
-            self.content.append(f"- **{col}**: {value}")
+            self.content.append(f"- **{col}**: {distinct_text(value, row.get(f'{col}_hll'))}")
         # Render aggregated values in table form
         if aggregated_values:
             self.sub2Chapter_title("Aggregated Values")
 
             # Header and separator
-            headers = ["Metric", "Min", "Max", "Avg", "Total", "Count"]
+            headers = ["Metric", "Min", "Max", "Avg", "Total", "Count", "P50", "P95", "P99"]
             table ="| " + " | ".join(headers) + " |\n"
             table +="|" + "|".join(['---' for _ in headers]) + "|\n"
 
@@ -123,7 +125,10 @@ class MDReport(AbstractReport):
                     metrics.get('max', ''),
                     metrics.get('avg', ''),
                     metrics.get('total', ''),
-                    metrics.get('count', '')
+                    metrics.get('count', ''),
+                    metrics.get('p50', ''),
+                    metrics.get('p95', ''),
+                    metrics.get('p99', '')
                 ]
                 # Ensure that all entries are strings for Markdown
                 table +="| " + " | ".join(map(str, row_data)) + " |\n"
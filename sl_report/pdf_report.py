@@ -4,8 +4,10 @@ from fpdf import *
 from fpdf.enums import XPos,YPos
 from fpdf.pattern import shape_linear_gradient
 import re
+import pandas as pd
 from sl_plot.graphs import plot_sku_monthly_costs
 from sl_report.report import AbstractReport
+from sl_async.sldistinct import distinct_text
 from sl_utils.utils import *
 import msgspec
 
@@ -571,13 +573,13 @@ class PDFReport(FPDF,AbstractReport):
         aggregated_values = {}
         # Process columns to aggregate min, max, avg, total
         for col in columns:
-            if col.endswith(('_min', '_max', '_avg', '_total',"_count")):
+            if col.endswith(('_min', '_max', '_avg', '_total', "_count", '_p50', '_p95', '_p99')):
                 base_name = col.rsplit('_', 1)[0]
                 if base_name not in aggregated_values:
                     aggregated_values[base_name] = {}
                 # Store the value in the appropriate category
                 category = col.rsplit('_', 1)[1]
-                if row.get(col, 0)!=0 :
+                if row.get(col, 0)!=0 and not pd.isna(row.get(col, 0)):
                     if col.endswith("_count"):
                         aggregated_values[base_name][category] = convertToHumanReadable(col,row.get(col, 0))
                     else:
@@ -585,7 +587,7 @@ class PDFReport(FPDF,AbstractReport):
 
         # Process unique columns
         for col in columns:
-            if not col.endswith(('_min', '_max', '_avg', '_total',"_count")):
+            if not col.endswith(('_min', '_max', '_avg', '_total', "_count", '_p50', '_p95', '_p99')):
                 value = row.get(col, 0)
                 if isinstance(value, list) and len(value) <= 1:
                     if len(value) == 0:
@@ -599,7 +601,8 @@ class PDFReport(FPDF,AbstractReport):
                 self.cell(col_width-40, row_height, self.clean_name(col), border=1)
                 # Add the value
                 self.set_font('helvetica', '', 8)
-                self.cell(col_width+40, row_height, convertToHumanReadable(col,value), border=1)
+                self.cell(col_width+40, row_height, distinct_text(convertToHumanReadable(col,value), row.get(f"{col}_hll")),
+                          border=1)
                 self.ln(row_height)
         # Add table header and rows
         for base_name, values in aggregated_values.items():
@@ -57,6 +57,10 @@ class AbstractReport(ABC):
     def table(self, df, column):
         pass
 
+    @abstractmethod
+    def add_table(self, data_list, columns, columns_name=None):
+        pass
+
     @abstractmethod
     def write(self,name):
         pass
@@ -137,6 +141,10 @@ class Report(AbstractReport):
         for report in self.reports:
             report.table(df,column)
 
+    def add_table(self, data_list, columns, columns_name=None):
+        for report in self.reports:
+            report.add_table(data_list, columns, columns_name)
+
     def write(self,name):
         for report in self.reports:
             report.write(name)
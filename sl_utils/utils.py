@@ -1,3 +1,4 @@
+import glob
 import os
 
 
@@ -134,3 +135,27 @@ def remove_extension(file_path):
     if root.endswith(".log"):
         root, _ = os.path.splitext(root)
     return root
+
+
+
+def expand_log_files(input_path, names):
+    """
+    Expand LOGS_FILENAME entries (file name, directory or glob pattern, relative to input_path)
+    into the list of log file names relative to input_path, without duplicates.
+    """
+    files = []
+    for name in names:
+        path = os.path.join(input_path, name)
+        if os.path.isdir(path):
+            matches = sorted(os.path.join(root, file) for root, _, dir_files in os.walk(path) for file in dir_files)
+        elif any(c in name for c in '*?['):
+            matches = sorted(glob.glob(path, recursive=True))
+        else:
+            matches = [path]
+        for match in matches:
+            if match.endswith(('.gzidx', '.gzidx.json')) or (match != path and not os.path.isfile(match)):
+                continue  # gzip index sidecar files
+            file = os.path.relpath(match, input_path)
+            if file not in files:
+                files.append(file)
+    return files
@@ -0,0 +1,201 @@
+"""
+Benchmarks of the extraction stages, each one against the code it replaced:
+    python -m tests.benchmark [channel] [decode] [shape] [merge] [--shapes N]
+channel: lines through three stages, one asyncio.Queue item per line vs SLChannel batches (user-004)
+decode: typed msgspec decode vs json decode of the whole document and extractSlowQueryInfos (user-010)
+shape: one walk scan_command vs the former recursive shape (user-017)
+merge: vectorised merge_command_shape_agg vs the former groupby().apply by shape (user-021)
+Not collected by pytest (not a test_ module), the old and new results are checked equal where they can be.
+"""
+import argparse
+import asyncio
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from sl_async.slag import getCommanShapeAggOp, distinct_values, merge_command_shape_agg
+from sl_async.slapi import SLChannel
+from sl_json.columns import SlowQueryColumns
+from sl_json.json import JsonAndText, decoder, decode_lines, extractSlowQueryInfos
+from sl_json.shape import scan_command, shape_fingerprint, encoder
+
+from tests.test_json import LINES
+from tests.test_shape import legacy_command_shape
+from tests.test_slag import reference_groupby, concat_command
+
+
+def best_of(function, repeat=5):
+    """Best time of repeat runs of function, in seconds, and its last result"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_channel(lines=300_000):
+    async def by_queue():
+        queues = [asyncio.Queue(4096) for _ in range(3)]
+
+        async def source():
+            for line in range(lines):
+                await queues[0].put(line)
+            await queues[0].put(None)
+
+        async def relay(read, write):
+            while (line := await read.get()) is not None:
+                await write.put(line)
+            await write.put(None)
+
+        async def sink():
+            count = 0
+            while await queues[2].get() is not None:
+                count += 1
+            return count
+
+        return (await asyncio.gather(source(), relay(queues[0], queues[1]), relay(queues[1], queues[2]), sink()))[3]
+
+    async def by_channel(batch_size):
+        channels = [SLChannel(16, batch_size) for _ in range(3)]
+
+        async def source():
+            for line in range(lines):
+                await channels[0].put(line)
+            await channels[0].close()
+
+        async def relay(read, write):
+            async for batch in read:
+                await write.put_batch(batch)
+            await write.close()
+
+        async def sink():
+            return sum([len(batch) async for batch in channels[2]])
+
+        return (await asyncio.gather(source(), relay(channels[0], channels[1]), relay(channels[1], channels[2]),
+                                     sink()))[3]
+
+    elapsed, count = best_of(lambda: asyncio.run(by_queue()), 3)
+    assert count == lines
+    print(f"  asyncio.Queue per line  {elapsed / lines * 1e9:6.0f} ns/line")
+    for batch_size in (64, 256):
+        elapsed, count = best_of(lambda: asyncio.run(by_channel(batch_size)), 3)
+        assert count == lines
+        print(f"  SLChannel batch={batch_size:<4}    {elapsed / lines * 1e9:6.0f} ns/line")
+
+
+def bench_decode(lines=20_000):
+    # the slow query lines of the tests with a new time on each line
+    raw = [LINES[index % 3].replace("T10:00:0", f"T1{index // 3600 % 10}:{index // 60 % 60:02d}:{index // 10 % 6}", 1)
+           for index in range(lines)]
+    elapsed_dict, rows_dict = best_of(lambda: [extractSlowQueryInfos(decoder.decode(line), "src", "0") for line in raw])
+    elapsed_typed, rows_typed = best_of(lambda: [JsonAndText(line, "src", "0").log_entry for line in raw])
+    assert rows_dict == rows_typed
+    elapsed_batch, _ = best_of(lambda: decode_lines(raw, "src", "0"))
+    print(f"  dict decode + extractSlowQueryInfos {elapsed_dict / lines * 1e6:6.1f} us/line")
+    print(f"  typed decode (JsonAndText)          {elapsed_typed / lines * 1e6:6.1f} us/line")
+    print(f"  decode_lines                        {elapsed_batch / lines * 1e6:6.1f} us/line")
+
+
+SHAPE_COMMANDS = {
+    "find": {"find": "users", "filter": {"name": "a", "age": {"$gt": 3}, "_id": {"$in": list(range(50))}},
+             "limit": 1, "$db": "shop", "lsid": {"id": 1}, "$clusterTime": {"t": 1}},
+    "aggregate $lookup/$group": {"aggregate": "orders", "pipeline": [
+        {"$match": {"status": {"$in": ["a", "b", "c"]}, "total": {"$gte": 10}}},
+        {"$lookup": {"from": "users", "localField": "user", "foreignField": "_id", "as": "u",
+                     "pipeline": [{"$match": {"active": True}}, {"$project": {"name": 1}}]}},
+        {"$group": {"_id": "$user", "n": {"$sum": 1}, "t": {"$sum": "$total"}}},
+        {"$sort": {"n": -1}}, {"$limit": 10}], "cursor": {}, "$db": "shop"},
+    "getMore (aggregate)": {"aggregate": "orders", "pipeline": [
+        {"$changeStream": {"fullDocument": "updateLookup"}},
+        {"$match": {"operationType": {"$in": ["insert", "update", "replace"]}, "ns.coll": {"$in": ["a", "b"]}}},
+        {"$project": {"fullDocument": 1, "operationType": 1}}], "cursor": {}, "$db": "shop"},
+    "bulk update x20": {"update": "items", "updates": [
+        {"q": {"sku": {"$in": list(range(index, index + 20))}, "store": index}, "u": {"$set": {"qty": index}},
+         "upsert": False, "multi": True} for index in range(20)], "ordered": False, "$db": "shop"},
+}
+
+
+def bench_shape(repeat=2000):
+    for name, command in SHAPE_COMMANDS.items():
+        def legacy():
+            for _ in range(repeat):
+                encoder.encode(legacy_command_shape(command, "shop.users")[0])
+
+        def one_walk():
+            for _ in range(repeat):
+                shape_fingerprint(encoder.encode(scan_command(command, "shop.users")[0]))
+
+        elapsed_legacy, _ = best_of(legacy)
+        elapsed_walk, _ = best_of(one_walk)
+        print(f"  {name:<26} former {elapsed_legacy / repeat * 1e6:6.1f} / one walk {elapsed_walk / repeat * 1e6:6.1f}"
+              f" us/command")
+
+
+def legacy_merge(concatenated):
+    """Merge of the partial aggregations by shape_id before merge_command_shape_agg: one Python call by shape"""
+    agg_operations = getCommanShapeAggOp()
+
+    def aggregate_group(group):
+        final_agg = {"shape_id": group["shape_id"].iloc[0]}
+        for key, (column, operation) in agg_operations.items():
+            if operation in ('sum', 'count'):
+                final_agg[key] = group[key].sum()
+            elif operation == 'mean':
+                final_agg[key] = group[f"{column}_total"].sum() / group[f"{column}_count"].sum()
+            elif operation == 'min':
+                final_agg[key] = group[key].min()
+            elif operation == 'max':
+                final_agg[key] = group[key].max()
+            elif operation is distinct_values:
+                final_agg[key] = distinct_values(group[key])
+            else:
+                final_agg[key] = operation(group[key])
+        return pd.Series(final_agg, name=group.name)
+    with warnings.catch_warnings():
+        # the former code applied on the grouping column too
+        warnings.simplefilter("ignore", FutureWarning)
+        return concatenated.groupby('shape_id').apply(aggregate_group)
+
+
+def bench_merge(shapes=1000, chunks=2):
+    batch, _ = decode_lines(LINES[:3], "src", "0")
+    columns = SlowQueryColumns()
+    for index in range(shapes * 4):
+        columns.append(batch.rows[index % len(batch.rows)])
+    df = columns.to_frame()
+    rng = np.random.default_rng(7)
+    df["shape_id"] = rng.integers(0, shapes, len(df))
+    df["durationMillis"] = rng.integers(0, 5000, len(df))
+    df["has_sort_stage"] = df["shape_id"] % 2
+    df["count_of_in"] = rng.integers(0, 5, len(df))
+    bounds = np.linspace(0, len(df), chunks + 1).astype(int)
+    partials = concat_command([reference_groupby(df.iloc[start:end]) for start, end in zip(bounds[:-1], bounds[1:])])
+    elapsed_legacy, old = best_of(lambda: legacy_merge(partials), 1)
+    elapsed_new, new = best_of(lambda: merge_command_shape_agg(partials), 3)
+    for column in ("slow_query", "durationMillis_total", "durationMillis_max", "durationMillis_avg"):
+        assert np.allclose(old[column].to_numpy(np.float64), new[column].to_numpy(np.float64))
+    print(f"  {shapes} shapes, {chunks} chunks: groupby().apply {elapsed_legacy:.2f} s,"
+          f" merge_command_shape_agg {elapsed_new:.2f} s")
+
+
+BENCHMARKS = {"channel": bench_channel, "decode": bench_decode, "shape": bench_shape, "merge": bench_merge}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the extraction stages")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run among {', '.join(BENCHMARKS)}, all by default")
+    parser.add_argument("--shapes", type=int, default=1000, help="number of shapes of the merge benchmark")
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks {', '.join(sorted(unknown))}")
+    for name in args.names or BENCHMARKS:
+        print(name)
+        if name == "merge":
+            bench_merge(args.shapes)
+        else:
+            BENCHMARKS[name]()
@@ -0,0 +1,43 @@
+import pickle
+
+from sl_json.columns import SlowQueryColumns
+from sl_json.json import decode_lines, DF_COL
+
+from tests.test_json import LINES
+
+
+def chunk_rows():
+    batch, _ = decode_lines(LINES, "src", "0")
+    return batch.rows
+
+
+def test_chunk_frame_survives_pickle():
+    chunk = SlowQueryColumns()
+    chunk.extend(chunk_rows())
+    restored = pickle.loads(pickle.dumps(chunk))
+    assert restored.to_frame().equals(chunk.to_frame())
+    assert chunk.to_frame()["planCacheKey"].tolist()[1] == "DEF"
+
+
+def test_chunk_only_pickles_its_own_values():
+    key = DF_COL.index("planCacheKey")
+    rows = chunk_rows()
+    other = SlowQueryColumns()
+    for i in range(20000):
+        row = list(rows[1])
+        row[key] = f"key{i}"
+        other.append(row)
+    other.flush_rows()
+    chunk = SlowQueryColumns()
+    chunk.extend(chunk_rows())
+    assert len(pickle.dumps(chunk)) < 20000
+    assert all(table is None or len(table.values) <= len(LINES) for table in chunk.tables)
+
+
+def test_copy_is_not_changed_by_the_next_rows():
+    chunk = SlowQueryColumns()
+    chunk.extend(chunk_rows()[:2])
+    copy = chunk.copy()
+    chunk.extend(chunk_rows()[2:])
+    assert len(copy) == 2
+    assert copy.to_frame()["namespace"].tolist() == ["shop.orders", "shop.items"]
@@ -0,0 +1,43 @@
+import pytest
+
+from sl_json.json import JsonAndText, decoder, decode_lines, extractSlowQueryInfos, DF_COL
+
+LINES = [
+    '{"t":{"$date":"2024-05-01T10:00:00.000+00:00"},"s":"I","c":"COMMAND","id":51803,"ctx":"conn9","msg":"Slow query","attr":{"type":"command","ns":"shop.orders","appName":"app","command":{"getMore":123,"collection":"orders","$db":"shop","lsid":{"id":{"$uuid":"x"}}},"originatingCommand":{"aggregate":"orders","pipeline":[{"$changeStream":{}}],"cursor":{},"$db":"shop"},"planSummary":"COLLSCAN","cursorid":8934567234523452345,"keysExamined":0,"docsExamined":10,"nreturned":2,"reslen":345,"flowControl":{"acquireCount":3,"timeAcquiringMicros":7},"storage":{"data":{"bytesRead":100,"timeReadingMicros":5,"timeWaitingMicros":{"cache":9}}},"durationMillis":150.5,"cpuNanos":12345}}',
+    '{"t":{"$date":"2024-05-01T10:00:01.000+00:00"},"s":"I","c":"WRITE","id":51803,"ctx":"conn9","msg":"Slow query","attr":{"type":"update","ns":"shop.items","command":{"q":{"sku":{"$in":[1,2,"a"]}},"u":{"$set":{"x":1}},"multi":false,"upsert":true},"planSummary":"IXSCAN { sku: 1 }","keysExamined":3,"docsExamined":3,"nMatched":1,"nModified":1,"keysInserted":1,"hasSortStage":true,"usedDisk":true,"fromMultiPlanner":true,"replanned":true,"replanReason":"cached plan","writeConflicts":2,"storage":{},"durationMillis":300,"queryHash":"ABC","planCacheKey":"DEF","planCacheShapeHash":"ABC","queryFramework":"classic"}}',
+    '{"t":{"$date":"2024-05-01T10:00:03.000+00:00"},"s":"I","c":"COMMAND","id":51803,"ctx":"conn9","msg":"Slow query","attr":{"type":"command","ns":"shop.$cmd","command":{"find":"x","filter":{"a":1},"skip":5,"limit":10,"$readPreference":{"mode":"secondary"},"$db":"shop"},"durationMillis":300,"storage":{"data":{"bytesRead":1,"bytesWritten":2,"timeWritingMicros":3}}}}',
+    # unexpected type, decoded by the generic decode
+    '{"t":{"$date":"2024-05-01T10:00:04.000+00:00"},"s":"I","c":"COMMAND","id":51803,"ctx":"conn9","msg":"Slow query","attr":{"ns":"shop.c","command":{"find":"c","$db":"shop"},"durationMillis":"weird"}}',
+]
+EXCLUDED_NS = '{"t":{"$date":"2024-05-01T10:00:02.000+00:00"},"s":"I","c":"COMMAND","id":51803,"ctx":"conn9","msg":"Slow query","attr":{"type":"command","ns":"admin.$cmd","command":{"ping":1},"durationMillis":300}}'
+NOT_SLOW = '{"t":{"$date":"2024-05-01T10:00:04.000+00:00"},"s":"I","c":"COMMAND","id":1,"ctx":"conn9","msg":"other","attr":{"note":"Slow query"}}'
+
+
+@pytest.mark.parametrize("line", LINES)
+def test_typed_decode_same_row_as_dict_decode(line):
+    row = JsonAndText(line, "src", "0").log_entry
+    assert len(row) == len(DF_COL)
+    assert row == extractSlowQueryInfos(decoder.decode(line), "src", "0")
+
+
+def test_decode_lines_counters():
+    batch, stats = decode_lines(LINES + [EXCLUDED_NS, NOT_SLOW, "not json"], "src", "0")
+    assert len(batch.rows) == len(LINES)
+    assert stats == {"lines": 7, "invalid": 1, "not_slow": 1, "excluded_ns": 1, "full_decode": 3,
+                     "excluded_db": 0, "fallback": 1, "rows": 4}
+    # time of the last slow query line, even when its row is not kept (excluded namespace)
+    assert batch.last_epoch == JsonAndText(EXCLUDED_NS, "src", "0").epoch
+
+
+def test_change_stream_flag_of_each_line_by_query_hash():
+    line = ('{"t":{"$date":"2024-05-01T10:00:0%d.000+00:00"},"s":"I","c":"COMMAND","id":51803,"ctx":"c",'
+            '"msg":"Slow query","attr":{"type":"command","ns":"shop.orders","command":{"aggregate":"orders",'
+            '"pipeline":[%s],"cursor":{},"$db":"shop"},"durationMillis":5,"queryHash":"CS1"}}')
+    lines = [line % (i, '{"$changeStream":{}},{"$match":{"a":1}}' if i % 2 else '{"$match":{"a":1}}')
+             for i in range(4)]
+    batch, _ = decode_lines(lines, "src", "0", by_query_hash=True)
+    changestream = DF_COL.index("changestream")
+    shape_id = DF_COL.index("shape_id")
+    # one group for the hash, the flag is not the one of its first line
+    assert len({row[shape_id] for row in batch.rows}) == 1
+    assert [row[changestream] for row in batch.rows] == [False, True, False, True]
@@ -0,0 +1,147 @@
+import msgspec
+import pytest
+
+from sl_json.shape import get_shape_id, scan_command, take_new_shapes, set_resend_shapes
+
+encoder = msgspec.json.Encoder()
+decoder = msgspec.json.Decoder()
+
+IGNORED_KEYS = ["lsid", "$clusterTime", "readConcern", "clientOperationKey", "shardVersion", "$timestamp",
+                "databaseVersion", "$topologyTime", "$configTime", "$audit", "$client", "mayBypassWriteBlocking"]
+
+
+def legacy_command_shape(command, namespace):
+    """(JSON shape, $in lengths, db, $changeStream flag) as computed before the one walk scan_command"""
+    in_counts = []
+    db = command.get("$db", namespace.split('.', 1))
+
+    def replace_values_as_str(obj):
+        res = replace_values(obj)
+        return res if isinstance(res, str) else encoder.encode(res).decode()
+
+    def replace_values(obj):
+        if isinstance(obj, dict):
+            new_obj = {}
+            for k, v in obj.items():
+                if k == "$in" and isinstance(v, list):
+                    in_counts.append(len(v))
+                    new_obj[k] = list({replace_values_as_str(i) for i in v})
+                else:
+                    new_obj[k] = replace_values(v)
+            return new_obj
+        if isinstance(obj, list):
+            return [replace_values(i) for i in obj]
+        if isinstance(obj, int):
+            return "int"
+        if isinstance(obj, float):
+            return "float"
+        if isinstance(obj, str):
+            return "string"
+        return "other"
+
+    def handle_pipeline(pipeline):
+        new_pipeline = []
+        for stage in pipeline:
+            if isinstance(stage, dict):
+                new_stage = {}
+                for k, v in stage.items():
+                    if k == "$group" and isinstance(v, dict):
+                        new_stage[k] = {sub_k: replace_values(sub_v) if sub_k != "_id" else sub_v
+                                        for sub_k, sub_v in v.items()}
+                    elif k == "$lookup" and isinstance(v, dict):
+                        new_stage[k] = {sub_k: replace_values(sub_v)
+                                        if sub_k not in ["from", "localField", "foreignField", "as"] else sub_v
+                                        for sub_k, sub_v in v.items()}
+                    else:
+                        new_stage[k] = replace_values(v)
+                new_pipeline.append(new_stage)
+            else:
+                new_pipeline.append(replace_values(stage))
+        return new_pipeline
+
+    def has_change_stream(subdoc):
+        if isinstance(subdoc, dict):
+            return any(key == "$changeStream" or has_change_stream(value) for key, value in subdoc.items())
+        if isinstance(subdoc, list):
+            return any(has_change_stream(item) for item in subdoc)
+        return False
+
+    shape = replace_values(command)
+    for key in IGNORED_KEYS:
+        shape.pop(key, None)
+    keys = list(shape.keys())
+    for key in ["insert", "findAndModify", "update", "delete"]:
+        if key in shape and keys.index(key) == 0:
+            shape[key] = command[key]
+    for key in ["collection", "aggregate", "find", "ordered", "$db"]:
+        if key in shape:
+            shape[key] = command[key]
+    if "pipeline" in command:
+        shape["pipeline"] = handle_pipeline(command["pipeline"])
+    return shape, in_counts, str(db), has_change_stream(command)
+
+
+def sorted_in(obj):
+    """The $in lists of a shape as sorted sets, their order was the one of a Python set"""
+    if isinstance(obj, dict):
+        return {k: sorted(set(v)) if k == "$in" and isinstance(v, list) else sorted_in(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [sorted_in(v) for v in obj]
+    return obj
+
+
+COMMANDS = [
+    {"find": "users", "filter": {"name": "a", "age": {"$gt": 3}}, "limit": 1, "$db": "shop",
+     "lsid": {"id": 1}, "$clusterTime": {"t": 1}},
+    {"find": "users", "filter": {"_id": {"$in": [1, 2, 3, "x", 4.5, True]}}, "$db": "shop"},
+    {"find": "users", "filter": {"tags": {"$elemMatch": {"k": {"$in": [{"a": 1}, {"a": "b"}, [1]]}}}}},
+    {"update": "users", "updates": [{"q": {"_id": {"$in": [1, 2]}}, "u": {"$set": {"x": 1}}}], "ordered": True,
+     "$db": "shop"},
+    {"aggregate": "users", "pipeline": [{"$match": {"s": {"$in": ["a", "b", "c"]}}},
+                                       {"$group": {"_id": "$s", "n": {"$sum": 1}}},
+                                       {"$lookup": {"from": "o", "localField": "a", "foreignField": "b", "as": "c",
+                                                    "pipeline": [{"$match": {"x": {"$in": [1]}}}]}}],
+     "cursor": {}, "$db": "shop"},
+    {"aggregate": "orders", "pipeline": [{"$changeStream": {"fullDocument": "updateLookup"}},
+                                        {"$match": {"operationType": {"$in": ["insert", "update"]}}}],
+     "cursor": {}, "$db": "shop"},
+    {"aggregate": "orders", "pipeline": [{"$lookup": {"from": "o", "as": "c",
+                                                     "pipeline": [{"$changeStream": {}}]}}], "$db": "shop"},
+    {"$changeStream": {}, "find": "orders"},
+    {"find": "orders", "lsid": {"x": {"$in": [1, 2]}}, "readConcern": {"$changeStream": 1}},
+    {"delete": "users", "deletes": [{"q": {"a": {"$in": []}}, "limit": 0}]},
+]
+
+
+@pytest.mark.parametrize("command", COMMANDS)
+def test_shape_same_as_legacy(command):
+    shape, in_counts, db, changestream = legacy_command_shape(command, "shop.users")
+    new_shape, new_counts, new_db, new_changestream = scan_command(command, "shop.users")
+    assert sorted_in(decoder.decode(encoder.encode(new_shape))) == sorted_in(shape)
+    assert sorted(new_counts) == sorted(in_counts)
+    assert new_db == db
+    assert new_changestream == changestream
+
+
+@pytest.mark.parametrize("command", COMMANDS)
+def test_fingerprint_of_the_shape(command):
+    fingerprint, in_counts, db, changestream = get_shape_id(command, "shop.users")
+    # same key whatever the order and the values of a $in
+    reordered = decoder.decode(encoder.encode(command).replace(b'[1,2,3,"x",4.5,true]', b'[7,"y",8.5,false]'))
+    assert get_shape_id(reordered, "shop.users")[0] == fingerprint
+    assert (in_counts, db, changestream) == scan_command(command, "shop.users")[1:]
+
+
+def test_resend_shapes_gives_the_shapes_seen_again():
+    command = {"find": "resend", "filter": {"resendOnly": 1}, "$db": "shop"}
+    take_new_shapes()
+    fingerprint = get_shape_id(command, "shop.resend")[0]
+    assert fingerprint in take_new_shapes()
+    get_shape_id(command, "shop.resend")
+    assert take_new_shapes() == {}
+    set_resend_shapes(True)
+    try:
+        get_shape_id(command, "shop.resend")
+        assert take_new_shapes() == {fingerprint: encoder.encode(scan_command(command, "shop.resend")[0])}
+    finally:
+        set_resend_shapes(False)
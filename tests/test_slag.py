@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sl_async.slag import getCommanShapeAggOp, merge_command_shape_agg, ShapeAccumulator, TABLE_SLACK, \
+    keep_tracked_shapes, OTHER_SHAPE_ID
+from sl_async.sldistinct import DISTINCT_LIMIT, TOP_EXAMPLES, distinct_count
+from sl_json.columns import SlowQueryColumns
+from sl_json.json import decode_lines
+
+from tests.test_json import LINES
+
+
+def reference_groupby(df):
+    """Aggregation of the rows by shape_id with the getCommanShapeAggOp operations, the reference of the merges"""
+    return df.groupby('shape_id').agg(**getCommanShapeAggOp()).reset_index()
+
+
+def concat_command(partials):
+    return pd.concat(partials, ignore_index=True)
+
+
+@pytest.fixture(scope="module")
+def rows_frame():
+    batch, _ = decode_lines(LINES[:3], "src", "0")
+    chunk = SlowQueryColumns()
+    rng = np.random.default_rng(7)
+    for i in range(1200):
+        chunk.append(batch.rows[i % len(batch.rows)])
+    df = chunk.to_frame()
+    df["shape_id"] = rng.integers(0, 20, len(df)) * 7919 - 100
+    df["durationMillis"] = rng.integers(0, 5000, len(df))
+    df["docs_examined"] = rng.integers(0, 100, len(df))
+    # the merge keeps the most frequent value of the partials, the same as the one of the rows when it is by shape
+    df["has_sort_stage"] = df["shape_id"] % 2
+    df["appName"] = pd.Categorical(rng.choice(["a", "b", "c"], len(df)))
+    df["count_of_in"] = rng.integers(0, 5, len(df))
+    return df
+
+
+def split(df, parts):
+    bounds = np.linspace(0, len(df), parts + 1).astype(int)
+    return [df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def normalized(df):
+    df = df.sort_values("shape_id").reset_index(drop=True)
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].map(lambda value: tuple(sorted(map(str, value))) if isinstance(value, list) else value)
+    return df
+
+
+@pytest.mark.parametrize("parts", [1, 2, 7])
+def test_merge_of_split_partials_is_the_aggregation_of_the_whole(rows_frame, parts):
+    expected = normalized(reference_groupby(rows_frame))
+    partials = [reference_groupby(part) for part in split(rows_frame, parts)]
+    merged = normalized(merge_command_shape_agg(concat_command(partials)))
+    assert list(merged.columns[:len(expected.columns)]) == list(expected.columns)
+    assert (merged["app_name_hll"] == "").all()
+    pd.testing.assert_frame_equal(merged[expected.columns], expected, check_exact=False, rtol=1e-12)
+
+
+def test_merge_is_the_same_in_any_order(rows_frame):
+    partials = [reference_groupby(part) for part in split(rows_frame, 5)]
+    forward = normalized(merge_command_shape_agg(concat_command(partials)))
+    backward = normalized(merge_command_shape_agg(concat_command(partials[::-1])))
+    twice = normalized(merge_command_shape_agg(concat_command([merge_command_shape_agg(concat_command(partials[:2])),
+                                                               merge_command_shape_agg(concat_command(partials[2:]))])))
+    pd.testing.assert_frame_equal(forward, backward)
+    pd.testing.assert_frame_equal(forward, twice)
+
+
+def test_distinct_values_bounded_across_chunks(rows_frame):
+    accumulator = ShapeAccumulator()
+    hours = {hour: "2024-05-01_10" for hour in rows_frame["hour"].unique().tolist()}
+    for chunk in range(20):
+        df = rows_frame.iloc[:600].copy()
+        df["shape_id"] = 1
+        # a new plan cache key on every row, as the chunks of a long follow run
+        df["planCacheKey"] = [f"key{chunk}-{row}" for row in range(len(df))]
+        part = ShapeAccumulator()
+        part.add_frame(df, hours)
+        accumulator.merge(part)
+    frame = accumulator.to_frame()
+    assert len(frame) == 1
+    assert len(frame["planCacheKey"].iloc[0]) == TOP_EXAMPLES
+    assert distinct_count(frame["planCacheKey_hll"].iloc[0]) == pytest.approx(12000, rel=0.1)
+    assert len(accumulator.tables["planCacheKey"].values) <= 2 * DISTINCT_LIMIT + TABLE_SLACK
+
+
+def test_top_shapes_side_table_bounded(rows_frame):
+    result = {"hourShapeStats": {"groupByCommandShape": ShapeAccumulator(3)}, "shapes": {}}
+    hours = {hour: "2024-05-01_10" for hour in rows_frame["hour"].unique().tolist()}
+    for chunk in range(20):
+        df = rows_frame.iloc[:100].copy()
+        # one heavy shape and a new shape on every other row
+        df["shape_id"] = [1 if row % 2 else 1000 * (chunk + 1) + row for row in range(len(df))]
+        part = ShapeAccumulator()
+        part.add_frame(df, hours)
+        result["shapes"].update({shape_id: b"{}" for shape_id in df["shape_id"].tolist()})
+        result["hourShapeStats"]["groupByCommandShape"].merge(part)
+        keep_tracked_shapes(result)
+    tracked = result["hourShapeStats"]["groupByCommandShape"].shapes
+    assert 1 in tracked and 1 in result["shapes"]
+    assert len(result["shapes"]) <= 2 * len(tracked) < 100
+    assert OTHER_SHAPE_ID in tracked
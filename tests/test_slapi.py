@@ -0,0 +1,84 @@
+import asyncio
+
+from datetime import datetime, timezone
+
+from sl_async.slapi import SLChannel, SourceOffset, END_OF_STREAM, DefaultSourceFilter
+
+
+def collect(channel):
+    async def read():
+        return [batch async for batch in channel]
+    return read()
+
+
+def test_channel_keeps_the_order_across_batches():
+    async def run():
+        channel = SLChannel(max_batches=100, batch_size=3)
+        for item in range(7):
+            await channel.put(item)
+        await channel.put_all([7, 8])
+        await channel.put_batch(SourceOffset(10))
+        await channel.put(9)
+        await channel.close()
+        return await collect(channel)
+
+    batches = asyncio.run(run())
+    assert [batch for batch in batches if batch.__class__ is not SourceOffset] == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+    # a ready made batch comes after the items put before it
+    assert [repr(batch) for batch in batches] == ["[0, 1, 2]", "[3, 4, 5]", "[6, 7, 8]", "SourceOffset(10)", "[9]"]
+
+
+def test_channel_end_of_stream():
+    async def run():
+        channel = SLChannel(max_batches=4, batch_size=10)
+        await channel.put("a")
+        await channel.close()
+        first = await channel.get_batch()
+        end = await channel.get_batch()
+        return first, end
+
+    first, end = asyncio.run(run())
+    # close sends the pending items then END_OF_STREAM, given as None
+    assert first == ["a"]
+    assert end is None
+    assert repr(END_OF_STREAM) == "END_OF_STREAM"
+
+
+def test_channel_bounded_with_a_concurrent_reader():
+    async def run():
+        channel = SLChannel(max_batches=1, batch_size=2)
+
+        async def write():
+            for item in range(101):
+                await channel.put(item)
+            await channel.close()
+        writer = asyncio.create_task(write())
+        batches = await collect(channel)
+        await writer
+        return batches
+
+    batches = asyncio.run(run())
+    assert [item for batch in batches for item in batch] == list(range(101))
+    assert all(len(batch) == 2 for batch in batches[:-1])
+
+
+def test_filter_window_on_lines_and_blocks():
+    lines = ['{"t":{"$date":"2024-05-01T10:00:0%d.000+00:00"},"msg":"Slow query","attr":{}}\n' % second
+             for second in range(5)]
+    window = dict(start_time=datetime(2024, 5, 1, 10, 0, 1, tzinfo=timezone.utc),
+                  end_time=datetime(2024, 5, 1, 10, 0, 3, tzinfo=timezone.utc))
+
+    async def run(by_block):
+        channel = SLChannel(max_batches=100)
+        line_filter = DefaultSourceFilter(channel, **window)
+        if by_block:
+            block = "".join(lines).encode()
+            await line_filter.process_block(block, 0, len(block))
+        else:
+            for line in lines:
+                await line_filter.process(line)
+        await channel.close()
+        return [line for batch in await collect(channel) for line in batch], line_filter.done
+
+    # the lines given one by one (Atlas) are filtered as the blocks of the files
+    assert asyncio.run(run(False)) == asyncio.run(run(True)) == (lines[1:3], True)
@@ -0,0 +1,44 @@
+import os
+
+from sl_async.slag import updateCommandShapeGroupGlobal
+from sl_async.slorch import follow_slow_queries_from_file
+
+from tests.test_json import LINES
+
+
+def log_lines(count, first=0):
+    """count slow query lines of the tests, one second apart"""
+    return [LINES[index % 3].replace("T10:00:0", f"T1{index // 3600}:{index // 60 % 60:02d}:{index // 10 % 6}", 1)
+            .replace(".000+", f".{index % 10}00+", 1) + "\n" for index in range(first, first + count)]
+
+
+def follow(log_path, output_path):
+    result = follow_slow_queries_from_file(str(log_path), str(output_path), chunk_size=50, poll_interval=0.05,
+                                           flush_interval=0, idle_timeout=0.3)
+    updateCommandShapeGroupGlobal(result)
+    return result
+
+
+def totals(result):
+    stats = result["groupByCommandShape"]["global"].set_index("shape_id").sort_index()
+    return result["countOfSlow"], stats[["slow_query", "durationMillis_total", "docs_examined_total"]].to_dict()
+
+
+def test_follow_restart_keeps_the_aggregations(tmp_path):
+    first, second = log_lines(170), log_lines(130, 170)
+    whole_log = tmp_path / "whole" / "mongod.log"
+    os.makedirs(whole_log.parent)
+    whole_log.write_text("".join(first + second))
+    whole = follow(whole_log, tmp_path / "whole" / "out.log")
+
+    log = tmp_path / "restarted" / "mongod.log"
+    os.makedirs(log.parent)
+    log.write_text("".join(first))
+    stopped = follow(log, tmp_path / "restarted" / "out.log")
+    assert stopped["countOfSlow"] == 170
+    with open(log, "a") as out_file:
+        out_file.write("".join(second))
+    restarted = follow(log, tmp_path / "restarted" / "out.log")
+
+    assert restarted["countOfSlow"] == whole["countOfSlow"] == 300
+    assert totals(restarted) == totals(whole)
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sl_async.slsketch import RELATIVE_ACCURACY, QUANTILES, sketch_bins, encode_sketches, merge_sketches, \
+    decode_sketches, reduce_bins
+
+
+def encoded(ids, values, size):
+    return encode_sketches(*sketch_bins(np.asarray(ids), values), size)
+
+
+@pytest.fixture(scope="module")
+def latencies():
+    rng = np.random.default_rng(3)
+    # 3 slots with different distributions, some zeros
+    values = np.concatenate([rng.lognormal(3, 1.5, 20000), rng.exponential(200, 20000),
+                             rng.integers(0, 5, 20000).astype(np.float64)])
+    ids = np.repeat(np.arange(3), 20000)
+    order = rng.permutation(len(values))
+    return ids[order], values[order]
+
+
+def test_quantiles_within_relative_accuracy(latencies):
+    ids, values = latencies
+    sketch = merge_sketches(encoded(ids, values, 3), np.arange(3), 3)
+    for slot in range(3):
+        slot_values = np.sort(values[ids == slot])
+        for name, quantile in QUANTILES.items():
+            exact = slot_values[int(quantile * (len(slot_values) - 1))]
+            assert sketch[name][slot] == pytest.approx(exact, rel=RELATIVE_ACCURACY, abs=1e-9)
+
+
+def test_merge_is_associative_and_commutative(latencies):
+    ids, values = latencies
+    parts = [encoded(ids[start:start + 6000], values[start:start + 6000], 3) for start in range(0, len(ids), 6000)]
+    whole = merge_sketches(encoded(ids, values, 3), np.arange(3), 3)
+
+    def merged(sketches):
+        return merge_sketches([sketch for part in sketches for sketch in part],
+                              np.tile(np.arange(3), len(sketches)), 3)
+
+    left = merged([merged(parts[:4])['sketch'], merged(parts[4:])['sketch']])
+    right = merged(parts[::-1])
+    for name in list(QUANTILES) + ['sketch']:
+        assert list(left[name]) == list(whole[name])
+        assert list(right[name]) == list(whole[name])
+
+
+def test_missing_and_wide_counts():
+    # a slot without value and a count too large for the narrow encoding
+    ids, codes, counts = reduce_bins(np.array([0, 0, 2]), np.array([40000, 40001, 40000]),
+                                     np.array([1, 1 << 33, 5]))
+    sketches = encode_sketches(ids, codes, counts, 3)
+    assert sketches[1] == ''
+    assert all(np.array_equal(a, b) for a, b in zip(decode_sketches(sketches, np.arange(3)), (ids, codes, counts)))
+    merged = merge_sketches(pd.Series(sketches), np.arange(3), 3)
+    assert np.isnan(merged['p50'][1])